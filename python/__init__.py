@@ -1,18 +1,21 @@
 
-from network import localhost, Ngrok
+from network import localhost, host_workers, Ngrok
 
 import asyncio
 
-async def main( ngrok : bool = False, port : int = 5100, api_key : str = None ) -> None:
+async def main( ngrok : bool = False, port : int = 5100, api_key : str = None, workers : int = 1, admin_api_key : str = None ) -> None:
 	if ngrok is True:
 		Ngrok.set_port(port)
 		Ngrok.open_tunnel()
 		print(f'Ngrok tunnel has been opened: {Ngrok.await_ngrok_addr()}')
-	await localhost(host='0.0.0.0', port=port, api_key=api_key)
+	if workers > 1:
+		host_workers(host='0.0.0.0', port=port, workers=workers, api_key=api_key, admin_api_key=admin_api_key)
+	else:
+		await localhost(host='0.0.0.0', port=port, api_key=api_key, admin_api_key=admin_api_key)
 	if ngrok is True:
 		Ngrok.close_tunnel()
 
 if __name__ == '__main__':
 	asyncio.run(
-		main(ngrok=False, port=5100, api_key=None)
+		main(ngrok=False, port=5100, api_key=None, workers=1, admin_api_key=None)
 	)
@@ -0,0 +1,241 @@
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Union
+
+import asyncio
+import sqlite3
+import json
+import time
+
+LEADER_LEASE : float = 5 # seconds a leader stays leader without renewing, another process takes over after this
+FINAL_STATES : tuple[int, ...] = (2, 3, 4) # completed, canceled and errored, the only states that expire
+
+class MemoryBackend:
+	'''
+	Operation state kept only in this process, which is always the scheduler leader.
+	Every method is a no-op (or trivial) so the single process setup pays nothing for the shared backend hooks.
+	Operations are passed in and out as json strings / dicts so backends never construct models.
+	The distributor goes through call / post so a backend that blocks can run its methods off the event loop.
+	'''
+	shared : bool = False # state is shared with other processes, which follow the leader
+	persistent : bool = False # operations are saved to the backend and outlive the process
+	values : dict[str, Any]
+
+	def __init__( self ) -> None:
+		self.values = dict()
+
+	async def call( self, function : Callable, *args ) -> Any:
+		'''Run one of the backend's methods and return its result.'''
+		return function(*args)
+
+	def post( self, function : Callable, *args ) -> None:
+		'''Run one of the backend's (write) methods without waiting for it.'''
+		function(*args)
+
+	# leadership
+	def acquire_leadership( self, owner : str, lease : float = LEADER_LEASE ) -> bool:
+		'''Become (or stay) the leader, False if another live process is the leader.'''
+		return True
+
+	def release_leadership( self, owner : str ) -> None:
+		pass
+
+	# operations
+	def save_operation( self, uuid : str, timestamp : int, state : int, data : str ) -> None:
+		pass
+
+	def submit_operation( self, uuid : str, timestamp : int, state : int, data : str ) -> None:
+		'''Store a new operation for the leader to pick up (used by followers).'''
+		raise NotImplementedError('Only the leader queues operations with the memory backend.')
+
+	def take_submissions( self ) -> list[dict]:
+		return []
+
+	def is_submitted( self, uuid : str ) -> bool:
+		'''The operation was submitted by a follower and the leader has not picked it up yet.'''
+		return False
+
+	def take_unfinished( self ) -> list[dict]:
+		'''Queued and in-progress operations, loaded by a process that has just become the leader.'''
+		return []
+
+	def load_operation( self, uuid : str ) -> Union[dict, None]:
+		return None
+
+	def save_results( self, uuid : str, timestamp : int, data : str ) -> None:
+		pass
+
+	def load_results( self, uuid : str ) -> Union[dict, None]:
+		return None
+
+	def delete_expired( self, before : float ) -> None:
+		'''Delete operations (and their results) that finished before `before`, queued and running ones never expire.'''
+		pass
+
+	# commands from followers to the leader
+	def push_command( self, kind : str, payload : dict ) -> None:
+		raise NotImplementedError('Only the leader runs commands with the memory backend.')
+
+	def take_commands( self ) -> list[tuple[str, dict]]:
+		return []
+
+	# shared values
+	def set_value( self, key : str, value : Any ) -> None:
+		self.values[key] = value
+
+	def get_value( self, key : str ) -> Any:
+		return self.values.get(key)
+
+	def close( self ) -> None:
+		pass
+
+class SQLiteBackend(MemoryBackend):
+	'''
+	Operation state in a SQLite database (WAL mode) shared by every process on the machine.
+	One process holds a renewable lease and is the scheduler leader, the others (followers) serve reads,
+	submit new operations and send commands (cancel, instance changes) for the leader to apply.
+	'''
+	shared : bool = True
+	persistent : bool = True
+	filepath : str
+	connection : sqlite3.Connection
+	executor : ThreadPoolExecutor # every query runs on this single thread, in submission order, never on the event loop
+
+	def __init__( self, filepath : str ) -> None:
+		super().__init__()
+		self.filepath = filepath
+		# autocommit mode, multi-statement writes use explicit BEGIN IMMEDIATE transactions
+		self.connection = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False, timeout=5)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute('PRAGMA synchronous=NORMAL')
+		self.connection.executescript('''
+			CREATE TABLE IF NOT EXISTS operations (uuid TEXT PRIMARY KEY, timestamp INTEGER, state INTEGER, submitted INTEGER DEFAULT 0, data TEXT, finished_at REAL);
+			CREATE INDEX IF NOT EXISTS operations_submitted ON operations (submitted) WHERE submitted = 1;
+			CREATE INDEX IF NOT EXISTS operations_state ON operations (state);
+			CREATE INDEX IF NOT EXISTS operations_timestamp ON operations (timestamp);
+			CREATE TABLE IF NOT EXISTS results (uuid TEXT PRIMARY KEY, timestamp INTEGER, data TEXT);
+			CREATE INDEX IF NOT EXISTS results_timestamp ON results (timestamp);
+			CREATE TABLE IF NOT EXISTS commands (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, payload TEXT);
+			CREATE TABLE IF NOT EXISTS leader (id INTEGER PRIMARY KEY CHECK (id = 1), owner TEXT, expires_at REAL);
+			CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT);
+		''')
+		# databases created before operations recorded when they finished
+		if 'finished_at' not in [ row[1] for row in self.connection.execute('PRAGMA table_info(operations)') ]:
+			self.connection.execute('ALTER TABLE operations ADD COLUMN finished_at REAL')
+			self.connection.execute(f'UPDATE operations SET finished_at = timestamp WHERE state IN {FINAL_STATES}')
+		self.connection.execute('CREATE INDEX IF NOT EXISTS operations_finished_at ON operations (finished_at) WHERE finished_at IS NOT NULL')
+		self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-backend')
+
+	async def call( self, function : Callable, *args ) -> Any:
+		return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+	def post( self, function : Callable, *args ) -> None:
+		future : Future = self.executor.submit(function, *args)
+		future.add_done_callback(self._report_failure)
+
+	def _report_failure( self, future : Future ) -> None:
+		if future.exception() is not None:
+			print(f'State database write failed: {future.exception()}')
+
+	def _transaction( self ) -> sqlite3.Connection:
+		self.connection.execute('BEGIN IMMEDIATE')
+		return self.connection
+
+	def acquire_leadership( self, owner : str, lease : float = LEADER_LEASE ) -> bool:
+		now = time.time()
+		connection = self._transaction()
+		try:
+			row = connection.execute('SELECT owner, expires_at FROM leader WHERE id = 1').fetchone()
+			if row is not None and row[0] != owner and row[1] > now:
+				connection.execute('COMMIT')
+				return False
+			connection.execute('INSERT OR REPLACE INTO leader (id, owner, expires_at) VALUES (1, ?, ?)', (owner, now + lease))
+			connection.execute('COMMIT')
+			return True
+		except Exception:
+			connection.execute('ROLLBACK')
+			raise
+
+	def release_leadership( self, owner : str ) -> None:
+		self.connection.execute('DELETE FROM leader WHERE id = 1 AND owner = ?', (owner,))
+
+	def save_operation( self, uuid : str, timestamp : int, state : int, data : str ) -> None:
+		# the first save in a final state records when the operation finished, expiry counts from then
+		finished_at : Union[float, None] = time.time() if state in FINAL_STATES else None
+		self.connection.execute(
+			'INSERT INTO operations (uuid, timestamp, state, submitted, data, finished_at) VALUES (?, ?, ?, 0, ?, ?) '
+			'ON CONFLICT (uuid) DO UPDATE SET state = excluded.state, data = excluded.data, '
+			'finished_at = CASE WHEN excluded.finished_at IS NULL THEN NULL ELSE COALESCE(operations.finished_at, excluded.finished_at) END',
+			(uuid, timestamp, state, data, finished_at)
+		)
+
+	def submit_operation( self, uuid : str, timestamp : int, state : int, data : str ) -> None:
+		self.connection.execute('INSERT INTO operations (uuid, timestamp, state, submitted, data) VALUES (?, ?, ?, 1, ?)', (uuid, timestamp, state, data))
+
+	def _take_operations( self, where : str ) -> list[dict]:
+		connection = self._transaction()
+		try:
+			rows = connection.execute(f'SELECT data FROM operations WHERE {where} ORDER BY timestamp').fetchall()
+			connection.execute('UPDATE operations SET submitted = 0 WHERE submitted = 1')
+			connection.execute('COMMIT')
+		except Exception:
+			connection.execute('ROLLBACK')
+			raise
+		return [ json.loads(row[0]) for row in rows ]
+
+	def take_submissions( self ) -> list[dict]:
+		return self._take_operations('submitted = 1')
+
+	def take_unfinished( self ) -> list[dict]:
+		return self._take_operations('state IN (0, 1)')
+
+	def is_submitted( self, uuid : str ) -> bool:
+		row = self.connection.execute('SELECT submitted FROM operations WHERE uuid = ?', (uuid,)).fetchone()
+		return row is not None and row[0] == 1
+
+	def load_operation( self, uuid : str ) -> Union[dict, None]:
+		row = self.connection.execute('SELECT data FROM operations WHERE uuid = ?', (uuid,)).fetchone()
+		return json.loads(row[0]) if row is not None else None
+
+	def save_results( self, uuid : str, timestamp : int, data : str ) -> None:
+		self.connection.execute('INSERT OR REPLACE INTO results (uuid, timestamp, data) VALUES (?, ?, ?)', (uuid, timestamp, data))
+
+	def load_results( self, uuid : str ) -> Union[dict, None]:
+		row = self.connection.execute('SELECT data FROM results WHERE uuid = ?', (uuid,)).fetchone()
+		return json.loads(row[0]) if row is not None else None
+
+	def delete_expired( self, before : float ) -> None:
+		connection = self._transaction()
+		try:
+			connection.execute('DELETE FROM results WHERE uuid IN (SELECT uuid FROM operations WHERE finished_at < ?)', (before,))
+			connection.execute('DELETE FROM operations WHERE finished_at < ?', (before,))
+			connection.execute('COMMIT')
+		except Exception:
+			connection.execute('ROLLBACK')
+			raise
+
+	def push_command( self, kind : str, payload : dict ) -> None:
+		self.connection.execute('INSERT INTO commands (kind, payload) VALUES (?, ?)', (kind, json.dumps(payload)))
+
+	def take_commands( self ) -> list[tuple[str, dict]]:
+		connection = self._transaction()
+		try:
+			rows = connection.execute('SELECT id, kind, payload FROM commands ORDER BY id').fetchall()
+			if len(rows) > 0:
+				connection.execute('DELETE FROM commands WHERE id <= ?', (rows[-1][0],))
+			connection.execute('COMMIT')
+		except Exception:
+			connection.execute('ROLLBACK')
+			raise
+		return [ (kind, json.loads(payload)) for _, kind, payload in rows ]
+
+	def set_value( self, key : str, value : Any ) -> None:
+		self.connection.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+	def get_value( self, key : str ) -> Any:
+		row = self.connection.execute('SELECT value FROM kv WHERE key = ?', (key,)).fetchone()
+		return json.loads(row[0]) if row is not None else None
+
+	def close( self ) -> None:
+		self.executor.shutdown(wait=True) # pending writes go through first
+		self.connection.close()
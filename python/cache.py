@@ -0,0 +1,172 @@
+from __future__ import annotations
+from typing import Any, Awaitable, Callable, Union
+from collections import OrderedDict
+
+import asyncio
+import json
+import time
+import os
+
+class StaleWhileRevalidate:
+	'''
+	A single cached value produced by an async fetcher.
+	Once the value is older than `ttl` it is still served, but a background refresh is started.
+	The fetcher returns None on failure, in which case the previous value is kept.
+	'''
+	fetcher : Callable[[], Awaitable[Any]]
+	ttl : float
+
+	value : Any
+	expires_at : float
+	_task : Union[asyncio.Task, None]
+
+	def __init__( self, fetcher : Callable[[], Awaitable[Any]], ttl : float ) -> None:
+		self.fetcher = fetcher
+		self.ttl = ttl
+		self.value = None
+		self.expires_at = -1
+		self._task = None
+
+	def is_stale( self ) -> bool:
+		return time.time() >= self.expires_at
+
+	def is_refreshing( self ) -> bool:
+		return self._task is not None and self._task.done() is False
+
+	async def refresh( self ) -> Any:
+		'''Fetch a new value now and return the (possibly unchanged) cached value.'''
+		value = await self.fetcher()
+		if value is not None:
+			self.value = value
+			self.expires_at = time.time() + self.ttl
+		return self.value
+
+	def revalidate( self ) -> asyncio.Task:
+		'''Start a background refresh unless one is already running.'''
+		if self.is_refreshing() is False:
+			self._task = asyncio.create_task(self.refresh())
+		return self._task
+
+	def invalidate( self ) -> None:
+		'''Mark the value as stale; it is still served until a refresh replaces it.'''
+		self.expires_at = -1
+
+	def get( self ) -> Any:
+		'''Return the cached value immediately, revalidating in the background if it is stale.'''
+		if self.is_stale() is True:
+			self.revalidate()
+		return self.value
+
+	async def get_async( self ) -> Any:
+		'''Return the cached value, only waiting for a refresh if nothing has been fetched yet.'''
+		if self.value is None:
+			return await asyncio.shield(self.revalidate())
+		return self.get()
+
+	async def close( self ) -> None:
+		if self._task is not None:
+			self._task.cancel()
+			await asyncio.gather(self._task, return_exceptions=True)
+			self._task = None
+
+class ResultCache:
+	'''
+	Least-recently-used cache of generation results bounded by a byte budget.
+	When a directory is given, entries are also written there as json so they survive restarts,
+	with the directory bounded by its own byte budget (oldest files removed first).
+	'''
+	memory_budget : int
+	directory : Union[str, None]
+	disk_budget : int
+
+	entries : OrderedDict[str, tuple[Any, int]]
+	memory_bytes : int
+	disk_entries : OrderedDict[str, int]
+	disk_bytes : int
+
+	stats : dict[str, int]
+
+	def __init__( self, memory_budget : int = 256 * 1024 * 1024, directory : str = None, disk_budget : int = 2 * 1024 * 1024 * 1024 ) -> None:
+		self.memory_budget = memory_budget
+		self.directory = directory
+		self.disk_budget = disk_budget
+		self.entries = OrderedDict()
+		self.memory_bytes = 0
+		self.disk_entries = OrderedDict()
+		self.disk_bytes = 0
+		self.stats = { "hits" : 0, "disk_hits" : 0, "misses" : 0, "evictions" : 0 }
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+			files = [ entry for entry in os.scandir(directory) if entry.name.endswith('.json') ]
+			for entry in sorted(files, key=lambda entry : entry.stat().st_mtime):
+				self.disk_entries[entry.name[:-5]] = entry.stat().st_size
+				self.disk_bytes += entry.stat().st_size
+
+	def _path( self, key : str ) -> str:
+		return os.path.join(self.directory, f'{key}.json')
+
+	def _store_memory( self, key : str, value : Any, nbytes : int ) -> None:
+		if key in self.entries:
+			self.memory_bytes -= self.entries.pop(key)[1]
+		if nbytes > self.memory_budget:
+			return
+		self.entries[key] = (value, nbytes)
+		self.memory_bytes += nbytes
+		while self.memory_bytes > self.memory_budget:
+			_, (_, evicted_bytes) = self.entries.popitem(last=False)
+			self.memory_bytes -= evicted_bytes
+			self.stats["evictions"] += 1
+
+	def _store_disk( self, key : str, value : Any ) -> None:
+		try:
+			with open(self._path(key), 'w') as file:
+				json.dump(value, file)
+		except (OSError, TypeError):
+			return
+		if key in self.disk_entries:
+			self.disk_bytes -= self.disk_entries.pop(key)
+		self.disk_entries[key] = os.path.getsize(self._path(key))
+		self.disk_bytes += self.disk_entries[key]
+		while self.disk_bytes > self.disk_budget and len(self.disk_entries) > 0:
+			evicted_key, evicted_bytes = self.disk_entries.popitem(last=False)
+			self.disk_bytes -= evicted_bytes
+			try:
+				os.remove(self._path(evicted_key))
+			except OSError:
+				pass
+
+	def get( self, key : str ) -> Any:
+		'''Get the cached value for the key, or None on a miss.'''
+		entry = self.entries.get(key)
+		if entry is not None:
+			self.entries.move_to_end(key)
+			self.stats["hits"] += 1
+			return entry[0]
+		if self.directory is not None and key in self.disk_entries:
+			try:
+				with open(self._path(key), 'r') as file:
+					value = json.load(file)
+			except (OSError, ValueError):
+				value = None
+			if value is not None:
+				self.disk_entries.move_to_end(key)
+				self._store_memory(key, value, self.disk_entries[key])
+				self.stats["disk_hits"] += 1
+				return value
+		self.stats["misses"] += 1
+		return None
+
+	def put( self, key : str, value : Any, nbytes : int ) -> None:
+		'''Cache the value, `nbytes` is its approximate size in memory.'''
+		self._store_memory(key, value, nbytes)
+		if self.directory is not None:
+			self._store_disk(key, value)
+
+	def get_stats( self ) -> dict[str, int]:
+		return {
+			**self.stats,
+			"entries" : len(self.entries),
+			"memory_bytes" : self.memory_bytes,
+			"disk_entries" : len(self.disk_entries),
+			"disk_bytes" : self.disk_bytes,
+		}
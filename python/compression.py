@@ -0,0 +1,255 @@
+'''
+Vectorized palette/run-length image compression.
+
+Produces the same format as the original pure python implementation (temp/python/image.py):
+- pixels are quantized with round(channel / round_n)
+- each row is run-length encoded, runs of at least `min_usage_count` become "{count}y{index}" strings
+  where index is the 1-based position of the color in the palette (in order of first use)
+- shorter runs are written out as raw [r, g, b] quantized pixels
+
+It also implements the compact binary tile format (see encode_compact_tile and the README).
+'''
+
+from __future__ import annotations
+from typing import Union
+from PIL import Image
+
+import numpy
+import base64
+import struct
+import time
+import zlib
+
+ENCODING_LEGACY = 'legacy' # palette/RLE string -> zlib -> hex
+ENCODING_PALETTE = 'palette' # <= 256 color palette + uint8 indexes -> zlib -> base64
+ENCODING_RGB565 = 'rgb565' # 16 bit pixels -> zlib -> base64
+IMAGE_ENCODINGS : tuple[str, ...] = (ENCODING_LEGACY, ENCODING_PALETTE, ENCODING_RGB565)
+
+COMPACT_FORMAT_VERSION : int = 1
+COMPACT_MODES : dict[str, int] = { ENCODING_PALETTE : 0, ENCODING_RGB565 : 1 }
+
+class CompressedImage:
+	'''Run-length encoded image, held as flat numpy arrays in row-major order.'''
+	size : tuple[int, int] # (width, height)
+	palette : numpy.ndarray # (N, 3) quantized colors used by long runs, in order of first use
+	run_rows : numpy.ndarray # row of each run
+	run_lengths : numpy.ndarray # length of each run
+	run_colors : numpy.ndarray # (R, 3) quantized color of each run
+	run_indexes : numpy.ndarray # 1-based palette index of each run, 0 for runs written out as raw pixels
+
+	def __init__( self, size : tuple[int, int], palette : numpy.ndarray, run_rows : numpy.ndarray, run_lengths : numpy.ndarray, run_colors : numpy.ndarray, run_indexes : numpy.ndarray ) -> None:
+		self.size = size
+		self.palette = palette
+		self.run_rows = run_rows
+		self.run_lengths = run_lengths
+		self.run_colors = run_colors
+		self.run_indexes = run_indexes
+
+def quantize_pixels( pixels : numpy.ndarray, round_n : int = 5 ) -> numpy.ndarray:
+	'''Quantize the channels, rint rounds half to even exactly like python's round.'''
+	return numpy.rint( pixels / round_n ).astype(numpy.int32)
+
+def compress_pixels( pixels : numpy.ndarray, min_usage_count : int = 3 ) -> CompressedImage:
+	'''Run-length encode already quantized (height, width, 3) pixels.'''
+	height, width, _ = pixels.shape
+	# pack each quantized color into a single integer so runs can be found with one comparison
+	codes : numpy.ndarray = ((pixels[..., 0].astype(numpy.int64) << 32) | (pixels[..., 1].astype(numpy.int64) << 16) | pixels[..., 2]).reshape(-1)
+
+	# a run starts at the start of every row and wherever the color changes
+	starts_mask = numpy.ones(codes.size, dtype=bool)
+	starts_mask[1:] = codes[1:] != codes[:-1]
+	starts_mask[::width] = True
+	starts : numpy.ndarray = numpy.flatnonzero(starts_mask)
+	run_lengths : numpy.ndarray = numpy.diff( numpy.append(starts, codes.size) )
+	run_rows : numpy.ndarray = starts // width
+	run_colors : numpy.ndarray = pixels.reshape(-1, 3)[starts]
+
+	# palette of long run colors in order of first use
+	long_runs : numpy.ndarray = run_lengths >= min_usage_count
+	run_indexes = numpy.zeros(starts.size, dtype=numpy.int64)
+	palette = numpy.zeros((0, 3), dtype=numpy.int32)
+	if long_runs.any():
+		unique_codes, first_use, inverse = numpy.unique(codes[starts[long_runs]], return_index=True, return_inverse=True)
+		order : numpy.ndarray = numpy.argsort(first_use, kind='stable')
+		rank = numpy.empty(unique_codes.size, dtype=numpy.int64)
+		rank[order] = numpy.arange(unique_codes.size)
+		run_indexes[long_runs] = rank[inverse.reshape(-1)] + 1
+		palette = run_colors[long_runs][first_use[order]]
+
+	return CompressedImage((width, height), palette, run_rows, run_lengths, run_colors, run_indexes)
+
+def _expanded_tokens( compressed : CompressedImage, raw_tokens : numpy.ndarray, long_tokens : list ) -> list[list]:
+	'''Expand per-run tokens into per-row lists, raw runs are repeated once per pixel.'''
+	long_runs : numpy.ndarray = compressed.run_indexes > 0
+	tokens = raw_tokens.copy()
+	tokens[long_runs] = long_tokens
+	repeats : numpy.ndarray = numpy.where(long_runs, 1, compressed.run_lengths)
+	expanded : numpy.ndarray = numpy.repeat(tokens, repeats)
+	row_sizes : numpy.ndarray = numpy.bincount(compressed.run_rows, weights=repeats, minlength=compressed.size[1]).astype(numpy.int64)
+	return [ row.tolist() for row in numpy.split(expanded, numpy.cumsum(row_sizes)[:-1]) ]
+
+def _color_tokens( compressed : CompressedImage, as_string : bool ) -> numpy.ndarray:
+	'''One token per run for its raw color, built once per unique color.'''
+	colors : numpy.ndarray = compressed.run_colors.astype(numpy.int64)
+	_, first_use, inverse = numpy.unique((colors[:, 0] << 32) | (colors[:, 1] << 16) | colors[:, 2], return_index=True, return_inverse=True)
+	unique_colors : numpy.ndarray = compressed.run_colors[first_use]
+	if as_string is True:
+		lookup = [ f'[{r},{g},{b}]' for r, g, b in unique_colors.tolist() ]
+	else:
+		lookup = unique_colors.tolist()
+	table = numpy.empty(len(lookup), dtype=object)
+	table[:] = lookup
+	return table[inverse.reshape(-1)]
+
+def to_legacy_format( compressed : CompressedImage ) -> tuple[tuple[int, int], list, list]:
+	'''Convert to the (size, pallete, pixels) lists returned by the original implementation.'''
+	long_runs : numpy.ndarray = compressed.run_indexes > 0
+	long_tokens = [ f'{count}y{index}' for count, index in zip(compressed.run_lengths[long_runs].tolist(), compressed.run_indexes[long_runs].tolist()) ]
+	rows = _expanded_tokens(compressed, _color_tokens(compressed, as_string=False), long_tokens)
+	return compressed.size, compressed.palette.tolist(), rows
+
+def to_transmission_string( compressed : CompressedImage ) -> str:
+	'''
+	Serialize exactly like `(str(pallete) + "|" + str(pixels)).replace(' ', '')` on the legacy lists,
+	without building the intermediate python lists.
+	'''
+	long_runs : numpy.ndarray = compressed.run_indexes > 0
+	long_tokens = [ f"'{count}y{index}'" for count, index in zip(compressed.run_lengths[long_runs].tolist(), compressed.run_indexes[long_runs].tolist()) ]
+	rows = _expanded_tokens(compressed, _color_tokens(compressed, as_string=True), long_tokens)
+	palette = ','.join( f'[{r},{g},{b}]' for r, g, b in compressed.palette.tolist() )
+	return f'[{palette}]|[' + ','.join( '[' + ','.join(row) + ']' for row in rows ) + ']'
+
+def compress_image_complete( image : Union[Image.Image, numpy.ndarray], round_n : int = 5, min_usage_count : int = 3 ) -> tuple:
+	'''Drop-in replacement for the original compress_image_complete.'''
+	pixels = numpy.asarray(image)
+	return to_legacy_format( compress_pixels( quantize_pixels(pixels, round_n=round_n), min_usage_count=min_usage_count ) )
+
+def compress_str_transmission( value : str ) -> str:
+	'''zlib + hex, which is what the roblox client (SDApi.lua) undoes for the `data` field.'''
+	return zlib.compress( value.encode('utf-8'), level=9 ).hex()
+
+def _palette_pixels( pixels : numpy.ndarray ) -> tuple[numpy.ndarray, numpy.ndarray]:
+	'''(palette, indexes) for the pixels, exact when there are at most 256 colors, median cut otherwise.'''
+	height, width, _ = pixels.shape
+	codes : numpy.ndarray = (pixels[..., 0].astype(numpy.int32) << 16) | (pixels[..., 1].astype(numpy.int32) << 8) | pixels[..., 2]
+	unique_codes, inverse = numpy.unique(codes.reshape(-1), return_inverse=True)
+	if unique_codes.size <= 256:
+		palette = numpy.stack([ unique_codes >> 16, (unique_codes >> 8) & 255, unique_codes & 255 ], axis=-1).astype(numpy.uint8)
+		return palette, inverse.reshape(height, width).astype(numpy.uint8)
+	quantized : Image.Image = Image.fromarray(pixels).quantize(colors=256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+	indexes = numpy.asarray(quantized, dtype=numpy.uint8)
+	palette = numpy.asarray(quantized.getpalette()[: 3 * (int(indexes.max()) + 1)], dtype=numpy.uint8).reshape(-1, 3)
+	return palette, indexes
+
+def encode_compact_tile( pixels : numpy.ndarray, encoding : str = ENCODING_PALETTE ) -> str:
+	'''
+	Encode (height, width, 3) uint8 pixels in the compact format, base64(zlib(payload)) where payload is
+	little-endian:
+	- u8 version (1), u8 mode (0 = palette, 1 = rgb565), u16 width, u16 height
+	- palette mode: u16 color count N, N * (u8 r, u8 g, u8 b), then width * height u8 palette indexes
+	- rgb565 mode: width * height u16 pixels (r5 g6 b5, red in the high bits)
+	Pixels are row-major starting at the top left.
+	'''
+	height, width, _ = pixels.shape
+	pixels = numpy.ascontiguousarray(pixels, dtype=numpy.uint8)
+	header : bytes = struct.pack('<BBHH', COMPACT_FORMAT_VERSION, COMPACT_MODES[encoding], width, height)
+	if encoding == ENCODING_PALETTE:
+		palette, indexes = _palette_pixels(pixels)
+		body : bytes = struct.pack('<H', palette.shape[0]) + palette.tobytes() + indexes.tobytes()
+	else:
+		channels = pixels.astype(numpy.uint16)
+		packed = ((channels[..., 0] >> 3) << 11) | ((channels[..., 1] >> 2) << 5) | (channels[..., 2] >> 3)
+		body : bytes = packed.astype('<u2').tobytes()
+	return base64.b64encode( zlib.compress(header + body, level=9) ).decode('ascii')
+
+def decode_compact_tile( data : str ) -> numpy.ndarray:
+	'''Reference decoder for encode_compact_tile, returns (height, width, 3) uint8 pixels.'''
+	payload : bytes = zlib.decompress( base64.b64decode(data) )
+	version, mode, width, height = struct.unpack_from('<BBHH', payload, 0)
+	if version != COMPACT_FORMAT_VERSION:
+		raise ValueError(f'Unsupported compact image format version {version}.')
+	if mode == COMPACT_MODES[ENCODING_PALETTE]:
+		(count,) = struct.unpack_from('<H', payload, 6)
+		palette = numpy.frombuffer(payload, dtype=numpy.uint8, count=count * 3, offset=8).reshape(-1, 3)
+		indexes = numpy.frombuffer(payload, dtype=numpy.uint8, count=width * height, offset=8 + count * 3)
+		return palette[indexes].reshape(height, width, 3)
+	packed = numpy.frombuffer(payload, dtype='<u2', count=width * height, offset=6).astype(numpy.uint16)
+	red, green, blue = (packed >> 11) & 31, (packed >> 5) & 63, packed & 31
+	pixels = numpy.stack([ (red << 3) | (red >> 2), (green << 2) | (green >> 4), (blue << 3) | (blue >> 2) ], axis=-1)
+	return pixels.astype(numpy.uint8).reshape(height, width, 3)
+
+def encode_tile( pixels : numpy.ndarray, encoding : str = ENCODING_LEGACY, round_n : int = 5, min_usage_count : int = 3 ) -> str:
+	'''Encode one (height, width, 3) uint8 block in the given wire encoding.'''
+	if encoding == ENCODING_LEGACY:
+		return compress_str_transmission( to_transmission_string( compress_pixels(quantize_pixels(pixels, round_n=round_n), min_usage_count=min_usage_count) ) )
+	return encode_compact_tile(pixels, encoding)
+
+def tile_block( pixels : numpy.ndarray, tile_size : int, tile_x : int, tile_y : int ) -> numpy.ndarray:
+	return pixels[tile_y * tile_size : (tile_y + 1) * tile_size, tile_x * tile_size : (tile_x + 1) * tile_size]
+
+def encode_image_tiles( pixels : numpy.ndarray, tile_size : int = 128, encodings : tuple[str, ...] = (ENCODING_LEGACY,), round_n : int = 5, min_usage_count : int = 3 ) -> dict:
+	'''
+	Split (height, width, 3) pixels into tile_size blocks and compress each one independently in every given encoding.
+	Tiles are stored row-major, edge tiles are smaller when the size is not a multiple of tile_size.
+	'''
+	height, width, _ = pixels.shape
+	columns : int = (width + tile_size - 1) // tile_size
+	rows : int = (height + tile_size - 1) // tile_size
+	tiles : dict[str, list[str]] = { encoding : [] for encoding in encodings }
+	for tile_y in range(rows):
+		for tile_x in range(columns):
+			block = tile_block(pixels, tile_size, tile_x, tile_y)
+			for encoding in encodings:
+				tiles[encoding].append( encode_tile(block, encoding, round_n=round_n, min_usage_count=min_usage_count) )
+	return { 'size' : (width, height), 'tile_size' : tile_size, 'columns' : columns, 'rows' : rows, 'tiles' : tiles }
+
+def decompress_image_complete( size : tuple[int, int], pallete : list, pixels : list ) -> numpy.ndarray:
+	'''Reference decoder for the legacy format, returns the quantized (height, width, 3) pixels.'''
+	width, height = size
+	output = numpy.zeros((height, width, 3), dtype=numpy.int32)
+	for y, row in enumerate(pixels):
+		x = 0
+		for token in row:
+			if isinstance(token, str):
+				count, index = token.split('y')
+				output[y, x:x + int(count)] = pallete[int(index) - 1]
+				x += int(count)
+			else:
+				output[y, x] = token
+				x += 1
+	return output
+
+def benchmark( sizes : tuple[int, ...] = (512, 768, 1024), repeats : int = 3 ) -> None:
+	'''Compare against the original implementation in temp/python/image.py on synthetic images.'''
+	import importlib.util
+	import os
+
+	legacy_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'temp', 'python', 'image.py')
+	spec = importlib.util.spec_from_file_location('legacy_image', legacy_path)
+	legacy = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(legacy)
+
+	generator = numpy.random.default_rng(0)
+	for size in sizes:
+		# smooth gradients with flat regions and noise, roughly like a generated image
+		y, x = numpy.mgrid[0:size, 0:size]
+		base = numpy.stack([ x * 255 // size, y * 255 // size, (x + y) * 127 // size ], axis=-1)
+		base[size // 4 : size // 2, size // 4 : size // 2] = (200, 30, 60)
+		noise = generator.integers(-4, 5, size=base.shape)
+		image = Image.fromarray( numpy.clip(base + noise, 0, 255).astype(numpy.uint8) )
+
+		start = time.perf_counter()
+		for _ in range(repeats):
+			expected = legacy.compress_image_complete(image, round_n=5, min_usage_count=3)
+		legacy_time = (time.perf_counter() - start) / repeats
+
+		start = time.perf_counter()
+		for _ in range(repeats):
+			result = compress_image_complete(image, round_n=5, min_usage_count=3)
+		vector_time = (time.perf_counter() - start) / repeats
+
+		assert tuple(result[0]) == tuple(expected[0]) and result[1] == expected[1] and result[2] == expected[2], 'output does not match the original implementation'
+		print(f'{size}x{size}: original {legacy_time * 1000:.1f}ms, vectorized {vector_time * 1000:.1f}ms ({legacy_time / vector_time:.1f}x)')
+
+if __name__ == '__main__':
+	benchmark()
@@ -0,0 +1,85 @@
+from __future__ import annotations
+from collections import deque
+from typing import Union
+
+import time
+
+BREAKER_CLOSED : str = 'closed' # healthy, operations are dispatched to the instance
+BREAKER_OPEN : str = 'open' # unhealthy, not probed again until the backoff has passed
+BREAKER_HALF_OPEN : str = 'half_open' # backoff passed, the next probe decides between closed and open
+
+class CircuitBreaker:
+	'''
+	Health state of a single instance.
+	`failure_threshold` consecutive failures open the breaker. After the backoff the breaker is half-open,
+	and a successful probe closes it while a failed one re-opens it with the backoff doubled (up to `max_backoff`).
+	Every transition is recorded in `history`.
+	'''
+	failure_threshold : int
+	base_backoff : float
+	max_backoff : float
+
+	state : str
+	consecutive_failures : int
+	consecutive_opens : int
+	retry_at : float
+	last_error : Union[str, None]
+	history : deque[dict]
+
+	def __init__( self, failure_threshold : int, base_backoff : float, max_backoff : float, history_length : int = 50, state : str = BREAKER_CLOSED ) -> None:
+		self.failure_threshold = failure_threshold
+		self.base_backoff = base_backoff
+		self.max_backoff = max_backoff
+		self.state = state
+		self.consecutive_failures = 0
+		self.consecutive_opens = 0
+		self.retry_at = 0
+		self.last_error = None
+		self.history = deque(maxlen=history_length)
+
+	def _transition( self, state : str, reason : str ) -> None:
+		self.history.append({ "timestamp" : time.time(), "from" : self.state, "to" : state, "reason" : reason })
+		self.state = state
+
+	def is_closed( self ) -> bool:
+		return self.state == BREAKER_CLOSED
+
+	def should_probe( self ) -> bool:
+		'''Closed breakers are always probed, open ones only once their backoff has passed (moving them to half-open).'''
+		if self.state == BREAKER_OPEN:
+			if time.time() < self.retry_at:
+				return False
+			self._transition(BREAKER_HALF_OPEN, 'backoff elapsed')
+		return True
+
+	def record_success( self ) -> bool:
+		'''Returns True if this closed the breaker.'''
+		self.consecutive_failures = 0
+		if self.state == BREAKER_CLOSED:
+			return False
+		self.consecutive_opens = 0
+		self.last_error = None
+		self._transition(BREAKER_CLOSED, 'probe succeeded')
+		return True
+
+	def record_failure( self, reason : str ) -> bool:
+		'''Returns True if this opened the breaker.'''
+		self.consecutive_failures += 1
+		self.last_error = reason
+		if self.state == BREAKER_OPEN:
+			return False
+		if self.state == BREAKER_CLOSED and self.consecutive_failures < self.failure_threshold:
+			return False
+		self.consecutive_opens += 1
+		self.retry_at = time.time() + min(self.max_backoff, self.base_backoff * 2 ** (self.consecutive_opens - 1))
+		self._transition(BREAKER_OPEN, reason)
+		return True
+
+	def get_status( self ) -> dict:
+		return {
+			"state" : self.state,
+			"consecutive_failures" : self.consecutive_failures,
+			"retry_at" : self.retry_at if self.state == BREAKER_OPEN else None,
+			"last_error" : self.last_error,
+			"history" : list(self.history),
+		}
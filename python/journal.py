@@ -0,0 +1,283 @@
+from __future__ import annotations
+from collections import deque
+from typing import Union
+
+from backend import FINAL_STATES, MemoryBackend
+
+import threading
+import json
+import time
+import os
+
+JOURNAL_FILE : str = 'journal.jsonl' # operation journal of the single process setup
+JOURNAL_FLUSH_INTERVAL : float = 0.05 # appended records are written and fsynced in batches this often
+JOURNAL_COMPACT_MIN_SIZE : int = 16 * 1024 * 1024 # journals smaller than this are never compacted
+JOURNAL_COMPACT_RATIO : float = 2 # compact once the journal is this many times larger than its live records
+
+RECORD_OPERATION : str = 'op' # latest state of an operation, the data is the operation json without results
+RECORD_RESULTS : str = 'res' # results (images and tiles) of a completed operation
+RECORD_EXPIRE : str = 'exp' # every operation with an older timestamp is deleted
+
+class JournalBackend(MemoryBackend):
+	'''
+	Single process backend persisting every operation state change to an append-only journal file,
+	so a restart replays the queue and the completed results instead of losing them.
+	Records are one json object per line and are written and fsynced in batches by a background thread,
+	so appending only costs building the line. Once it is mostly superseded records, the journal is
+	rewritten with only the live records in the same thread.
+	The event loop never waits on the flush lock: records are handed over through a deque, and results are
+	read from the file under a separate lock that compaction only holds while swapping the file.
+	Each record carries its change to `live_size`, which the flush thread applies.
+	'''
+	persistent : bool = True
+	filepath : str
+	flush_interval : float
+
+	operations : dict[str, tuple[int, int, str, Union[float, None], int]] # uuid -> (timestamp, state, operation json, finished at, record length) of every live operation
+	results_records : dict[str, tuple[int, int]] # uuid -> (file offset, length) of the results record
+	pending : deque[tuple[Union[str, None], bytes, int]] # records not written to the file yet, with the uuid for results records and the change to live_size
+	pending_results : dict[str, bytes] # results records not written to the file yet
+	size : int # bytes written to the file
+	live_size : int # estimate of the bytes a compacted journal would take, only changed by the flush thread once replayed
+
+	_file : Union[object, None]
+	_lock : threading.Lock # held by the flush thread while writing and compacting
+	_read_lock : threading.Lock # held while reading a results record and while compaction replaces the file
+	_stop : threading.Event
+	_thread : Union[threading.Thread, None]
+
+	def __init__( self, filepath : str = JOURNAL_FILE, flush_interval : float = JOURNAL_FLUSH_INTERVAL ) -> None:
+		super().__init__()
+		self.filepath = filepath
+		self.flush_interval = flush_interval
+		self.operations = dict()
+		self.results_records = dict()
+		self.pending = deque()
+		self.pending_results = dict()
+		self.size = 0
+		self.live_size = 0
+		self._lock = threading.Lock()
+		self._read_lock = threading.Lock()
+		self._stop = threading.Event()
+		self.replay()
+		self._file = open(self.filepath, 'ab')
+		self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+		self._thread.start()
+
+	def _apply( self, header : dict, data : Union[bytes, None], line : bytes, offset : int ) -> None:
+		uuid : Union[str, None] = header.get('uuid')
+		if header['t'] == RECORD_OPERATION:
+			previous = self.operations.get(uuid)
+			finished_at : Union[float, None] = header.get('fin')
+			if finished_at is None and header['state'] in FINAL_STATES:
+				finished_at = header['ts'] # written before records had the finish time
+			self.operations[uuid] = (header['ts'], header['state'], data.decode('utf-8'), finished_at, len(line))
+			self.live_size += len(line) - (previous[4] if previous is not None else 0)
+		elif header['t'] == RECORD_RESULTS:
+			previous = self.results_records.get(uuid)
+			self.results_records[uuid] = (offset, len(line))
+			self.live_size += len(line) - (previous[1] if previous is not None else 0)
+		elif header['t'] == RECORD_EXPIRE:
+			self.live_size -= self._expire(header['before'])
+
+	def replay( self ) -> None:
+		'''Rebuild the live operations from the journal, a partially written last record (crash mid write) is cut off.'''
+		if os.path.exists(self.filepath) is False:
+			return
+		offset : int = 0
+		with open(self.filepath, 'rb') as file:
+			for line in file:
+				if line.endswith(b'\n') is False:
+					break
+				try:
+					# only the header is parsed, operation data is kept as is and results are only indexed
+					split : int = line.find(b',"data":')
+					header : dict = json.loads(line[:split] + b'}') if split != -1 else json.loads(line)
+				except ValueError:
+					break
+				self._apply(header, line[split + 8:-2] if split != -1 else None, line, offset)
+				offset += len(line)
+		if offset != os.path.getsize(self.filepath):
+			print(f'Journal {self.filepath} has a partial record at {offset}, truncating it.')
+			os.truncate(self.filepath, offset)
+		self.size = offset
+
+	def _append( self, record : bytes, live_delta : int, results_uuid : Union[str, None] = None ) -> None:
+		self.pending.append((results_uuid, record, live_delta))
+
+	def _flush( self ) -> None:
+		with self._lock:
+			if len(self.pending) == 0 or self._file is None:
+				return
+			# only this thread pops, so the records appended meanwhile are left for the next flush
+			records : list[tuple[Union[str, None], bytes, int]] = [ self.pending.popleft() for _ in range(len(self.pending)) ]
+			self._file.write(b''.join( record for _, record, _ in records ))
+			self._file.flush()
+			os.fsync(self._file.fileno())
+			# results are readable from the file now, index them before dropping the pending copies
+			offset : int = self.size
+			for uuid, record, live_delta in records:
+				self.live_size += live_delta
+				if uuid is not None and uuid in self.operations:
+					self.results_records[uuid] = (offset, len(record))
+					if self.pending_results.get(uuid) is record:
+						del self.pending_results[uuid]
+				offset += len(record)
+			self.size = offset
+
+	def _flush_loop( self ) -> None:
+		while self._stop.wait(self.flush_interval) is False:
+			try:
+				self._flush()
+				if self.size > JOURNAL_COMPACT_MIN_SIZE and self.size > self.live_size * JOURNAL_COMPACT_RATIO:
+					self.compact()
+			except Exception as exception:
+				print(f'Journal flush failed: {exception}')
+
+	def _read_record( self, offset : int, length : int ) -> bytes:
+		with open(self.filepath, 'rb') as file:
+			file.seek(offset)
+			return file.read(length)
+
+	def compact( self ) -> None:
+		'''Rewrite the journal with only the live records, records appended meanwhile stay pending until it is done.'''
+		with self._lock:
+			temporary : str = self.filepath + '.compact'
+			records : dict[str, tuple[int, int]] = dict()
+			offset : int = 0
+			with open(self.filepath, 'rb') as source, open(temporary, 'wb') as file:
+				for uuid, (timestamp, state, data, finished_at, _) in list(self.operations.items()):
+					record : bytes = self._operation_record(uuid, timestamp, state, data, finished_at)
+					file.write(record)
+					offset += len(record)
+				for uuid, (results_offset, length) in list(self.results_records.items()):
+					source.seek(results_offset)
+					file.write(source.read(length))
+					records[uuid] = (offset, length)
+					offset += length
+				file.flush()
+				os.fsync(file.fileno())
+			with self._read_lock:
+				self._file.close()
+				os.replace(temporary, self.filepath)
+				self._file = open(self.filepath, 'ab')
+				for uuid, record in records.items():
+					if uuid in self.results_records:
+						self.results_records[uuid] = record
+			self.size = offset
+			self.live_size = offset
+
+	def _operation_record( self, uuid : str, timestamp : int, state : int, data : str, finished_at : Union[float, None] ) -> bytes:
+		finished : str = f',"fin":{finished_at}' if finished_at is not None else ''
+		return f'{{"t":"{RECORD_OPERATION}","uuid":"{uuid}","ts":{timestamp},"state":{state}{finished},"data":{data}}}\n'.encode('utf-8')
+
+	def save_operation( self, uuid : str, timestamp : int, state : int, data : str ) -> None:
+		previous = self.operations.get(uuid)
+		# the first save in a final state records when the operation finished, expiry counts from then
+		finished_at : Union[float, None] = None
+		if state in FINAL_STATES:
+			finished_at = previous[3] if previous is not None and previous[3] is not None else round(time.time(), 3)
+		record : bytes = self._operation_record(uuid, timestamp, state, data, finished_at)
+		self.operations[uuid] = (timestamp, state, data, finished_at, len(record))
+		self._append(record, len(record) - (previous[4] if previous is not None else 0))
+
+	def take_unfinished( self ) -> list[dict]:
+		unfinished = [ (timestamp, data) for timestamp, state, data, _, _ in self.operations.values() if state in (0, 1) ]
+		unfinished.sort(key=lambda item : item[0])
+		return [ json.loads(data) for _, data in unfinished ]
+
+	def load_operation( self, uuid : str ) -> Union[dict, None]:
+		entry : Union[tuple[int, int, str, Union[float, None], int], None] = self.operations.get(uuid)
+		return json.loads(entry[2]) if entry is not None else None
+
+	def save_results( self, uuid : str, timestamp : int, data : str ) -> None:
+		record : bytes = f'{{"t":"{RECORD_RESULTS}","uuid":"{uuid}","ts":{timestamp},"data":{data}}}\n'.encode('utf-8')
+		live_delta : int = len(record) - self._results_length(uuid)
+		self.pending_results[uuid] = record
+		self._append(record, live_delta, results_uuid=uuid)
+
+	def _results_length( self, uuid : str ) -> int:
+		'''Length of the operation's latest results record, written or pending.'''
+		record : Union[bytes, None] = self.pending_results.get(uuid)
+		if record is not None:
+			return len(record)
+		location : Union[tuple[int, int], None] = self.results_records.get(uuid)
+		return location[1] if location is not None else 0
+
+	def load_results( self, uuid : str ) -> Union[dict, None]:
+		record : Union[bytes, None] = self.pending_results.get(uuid)
+		if record is None:
+			with self._read_lock:
+				location : Union[tuple[int, int], None] = self.results_records.get(uuid)
+				if location is None:
+					return None
+				record = self._read_record(*location)
+		return json.loads(record)['data']
+
+	def _expire( self, before : float ) -> int:
+		'''Delete the operations that finished before `before`, returns the record bytes they took (0 if none expired).'''
+		expired : list[str] = [ uuid for uuid, entry in self.operations.items() if entry[3] is not None and entry[3] < before ]
+		freed : int = 0
+		for uuid in expired:
+			freed += self._results_length(uuid) + self.operations.pop(uuid)[4]
+			_ = self.results_records.pop(uuid, None)
+			_ = self.pending_results.pop(uuid, None)
+		return freed
+
+	def delete_expired( self, before : float ) -> None:
+		freed : int = self._expire(before)
+		if freed > 0:
+			self._append(f'{{"t":"{RECORD_EXPIRE}","before":{before}}}\n'.encode('utf-8'), -freed)
+
+	def close( self ) -> None:
+		'''Stop the flush thread and write the remaining records.'''
+		self._stop.set()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		self._flush()
+		with self._lock:
+			if self._file is not None:
+				self._file.close()
+				self._file = None
+
+def benchmark( count : int = 10_000, filepath : str = 'journal_benchmark.jsonl' ) -> None:
+	'''Journal cost per enqueue (building and appending the record), then flush, replay and compaction times.'''
+	from sdapi import Operation, SDTxt2ImgParams
+
+	if os.path.exists(filepath):
+		os.remove(filepath)
+	journal = JournalBackend(filepath)
+	operations = [ Operation(params=SDTxt2ImgParams(checkpoint=f'model-{index % 8}', prompt=f'prompt {index}', negative='')) for index in range(count) ]
+
+	start = time.perf_counter()
+	for operation in operations:
+		journal.save_operation(operation.uuid, operation.timestamp, operation.state, operation.model_dump_json(exclude_none=True))
+	enqueue_time = time.perf_counter() - start
+	for operation in operations:
+		journal.save_operation(operation.uuid, operation.timestamp, 2, operation.model_dump_json(exclude_none=True))
+		journal.save_results(operation.uuid, operation.timestamp, json.dumps({ 'images' : [], 'tiles' : [ 'x' * 1024 ] }))
+	start = time.perf_counter()
+	journal.close()
+	flush_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	journal = JournalBackend(filepath)
+	replay_time = time.perf_counter() - start
+	assert len(journal.take_unfinished()) == 0 and journal.load_results(operations[-1].uuid) is not None
+	size : int = journal.size
+	start = time.perf_counter()
+	journal.compact() # every queued record was superseded by its completed one
+	compact_time = time.perf_counter() - start
+	assert journal.load_results(operations[-1].uuid) is not None
+	compacted_size : int = journal.size
+	journal.close()
+	os.remove(filepath)
+
+	print(
+		f'{count} operations: enqueue {enqueue_time / count * 1e6:.2f}us, flush + fsync {flush_time * 1000:.1f}ms, '
+		f'replay {replay_time * 1000:.1f}ms, compact {size // 1024}KB to {compacted_size // 1024}KB in {compact_time * 1000:.1f}ms'
+	)
+
+if __name__ == '__main__':
+	benchmark()
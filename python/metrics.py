@@ -0,0 +1,192 @@
+from __future__ import annotations
+from bisect import bisect_left
+from typing import Callable, Union
+
+import asyncio
+import time
+
+LATENCY_BUCKETS : tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # webui http requests
+DURATION_BUCKETS : tuple[float, ...] = (0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600) # queue waits, generations and checkpoint switches
+EVENT_LOOP_LAG_BUCKETS : tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+EVENT_LOOP_LAG_INTERVAL : float = 0.25 # how often the event loop lag is sampled
+OTHER_LABEL : str = 'other' # label value of checkpoints missing from the instance catalog and of removed instances
+
+def format_value( value : float ) -> str:
+	if value == int(value) and abs(value) < 1e15:
+		return str(int(value))
+	return repr(float(value))
+
+def escape_label( value : str ) -> str:
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Metric:
+	'''
+	A metric family with fixed label names, rendered in the Prometheus text format.
+	Values are keyed by the tuple of label values, so recording is a dict update. A metric given a
+	`function` instead reads its values ({label values : value}) when it is rendered.
+	'''
+	kind : str = 'untyped'
+	name : str
+	help : str
+	label_names : tuple[str, ...]
+	values : dict[tuple[str, ...], float]
+	function : Union[Callable[[], dict[tuple[str, ...], float]], None]
+	_label_cache : dict[tuple[str, ...], str]
+
+	def __init__( self, name : str, help : str, label_names : tuple[str, ...] = (), function : Union[Callable[[], dict[tuple[str, ...], float]], None] = None ) -> None:
+		self.name = name
+		self.help = help
+		self.label_names = label_names
+		self.values = dict()
+		self.function = function
+		self._label_cache = dict()
+
+	def _labels( self, labels : tuple[str, ...] ) -> str:
+		'''The rendered label pairs (without braces) of a label values tuple, cached as the label sets are few.'''
+		rendered : Union[str, None] = self._label_cache.get(labels)
+		if rendered is None:
+			rendered = ','.join( f'{name}="{escape_label(str(value))}"' for name, value in zip(self.label_names, labels) )
+			self._label_cache[labels] = rendered
+		return rendered
+
+	def render( self, lines : list[str] ) -> None:
+		lines.append(f'# HELP {self.name} {self.help}')
+		lines.append(f'# TYPE {self.name} {self.kind}')
+		values : dict[tuple[str, ...], float] = self.function() if self.function is not None else self.values
+		for labels, value in list(values.items()):
+			pairs : str = self._labels(labels)
+			lines.append(f'{self.name}{{{pairs}}} {format_value(value)}' if pairs != '' else f'{self.name} {format_value(value)}')
+
+class Counter(Metric):
+	kind : str = 'counter'
+
+	def inc( self, *labels : str, amount : float = 1 ) -> None:
+		self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+	kind : str = 'gauge'
+
+	def set( self, value : float, *labels : str ) -> None:
+		self.values[labels] = value
+
+class Histogram(Metric):
+	'''Per bucket counts (cumulated when rendered), the sum and the count of the observed values.'''
+	kind : str = 'histogram'
+	buckets : tuple[float, ...]
+	counts : dict[tuple[str, ...], list[int]]
+	sums : dict[tuple[str, ...], float]
+
+	def __init__( self, name : str, help : str, label_names : tuple[str, ...] = (), buckets : tuple[float, ...] = DURATION_BUCKETS ) -> None:
+		super().__init__(name, help, label_names)
+		self.buckets = tuple(sorted(buckets))
+		self.counts = dict()
+		self.sums = dict()
+
+	def observe( self, value : float, *labels : str ) -> None:
+		counts : Union[list[int], None] = self.counts.get(labels)
+		if counts is None:
+			counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+			self.counts[labels] = counts
+			self.sums[labels] = 0.0
+		counts[bisect_left(self.buckets, value)] += 1
+		self.sums[labels] += value
+
+	def render( self, lines : list[str] ) -> None:
+		lines.append(f'# HELP {self.name} {self.help}')
+		lines.append(f'# TYPE {self.name} {self.kind}')
+		bounds : list[str] = [ f'le="{format_value(bound)}"' for bound in self.buckets ] + [ 'le="+Inf"' ]
+		for labels, counts in list(self.counts.items()):
+			pairs : str = self._labels(labels)
+			prefix : str = f'{self.name}_bucket{{{pairs},' if pairs != '' else f'{self.name}_bucket{{'
+			suffix : str = f'{{{pairs}}}' if pairs != '' else ''
+			total : int = 0
+			for bound, count in zip(bounds, counts):
+				total += count
+				lines.append(f'{prefix}{bound}}} {total}')
+			lines.append(f'{self.name}_sum{suffix} {format_value(self.sums[labels])}')
+			lines.append(f'{self.name}_count{suffix} {total}')
+
+class MetricsRegistry:
+	'''The metrics of a process, rendered together for the /metrics endpoint.'''
+	metrics : dict[str, Metric]
+
+	def __init__( self ) -> None:
+		self.metrics = dict()
+
+	def register( self, metric : Metric ) -> Metric:
+		self.metrics[metric.name] = metric
+		return metric
+
+	def counter( self, name : str, help : str, label_names : tuple[str, ...] = (), function : Union[Callable[[], dict[tuple[str, ...], float]], None] = None ) -> Counter:
+		return self.register(Counter(name, help, label_names, function))
+
+	def gauge( self, name : str, help : str, label_names : tuple[str, ...] = (), function : Union[Callable[[], dict[tuple[str, ...], float]], None] = None ) -> Gauge:
+		return self.register(Gauge(name, help, label_names, function))
+
+	def histogram( self, name : str, help : str, label_names : tuple[str, ...] = (), buckets : tuple[float, ...] = DURATION_BUCKETS ) -> Histogram:
+		return self.register(Histogram(name, help, label_names, buckets))
+
+	def render( self ) -> str:
+		lines : list[str] = []
+		for metric in list(self.metrics.values()):
+			metric.render(lines)
+		return '\n'.join(lines) + '\n'
+
+class DistributorMetrics(MetricsRegistry):
+	'''The series recorded by the distributor and its instances, scrape time gauges are registered by the distributor.'''
+	queue_wait : Histogram
+	generation_time : Histogram
+	checkpoint_switches : Counter
+	checkpoint_switch_time : Histogram
+	webui_request_time : Histogram
+	webui_request_failures : Counter
+	operations_completed : Counter
+	operations_failed : Counter
+	operations_expired : Counter
+	event_loop_lag : Histogram
+
+	def __init__( self ) -> None:
+		super().__init__()
+		self.queue_wait = self.histogram('sdhook_queue_wait_seconds', 'Time operations spent queued before being dispatched.', ('instance', 'checkpoint'))
+		self.generation_time = self.histogram('sdhook_generation_seconds', 'Duration of txt2img generations, checkpoint switch included.', ('instance', 'checkpoint'))
+		self.checkpoint_switches = self.counter('sdhook_checkpoint_switches_total', 'Checkpoint loads requested from an instance.', ('instance', 'checkpoint'))
+		self.checkpoint_switch_time = self.histogram('sdhook_checkpoint_switch_seconds', 'Duration of checkpoint loads.', ('instance', 'checkpoint'))
+		self.webui_request_time = self.histogram('sdhook_webui_request_seconds', 'Latency of webui http requests.', ('instance', 'endpoint'), LATENCY_BUCKETS)
+		self.webui_request_failures = self.counter('sdhook_webui_request_failures_total', 'Failed webui http requests by failure kind.', ('instance', 'endpoint', 'kind'))
+		self.operations_completed = self.counter('sdhook_operations_completed_total', 'Operations completed by an instance.', ('instance',))
+		self.operations_failed = self.counter('sdhook_operations_failed_total', 'Failed txt2img attempts by failure kind.', ('instance', 'kind'))
+		self.operations_expired = self.counter('sdhook_operations_expired_total', 'Operations deleted once their deadline passed.')
+		self.event_loop_lag = self.histogram('sdhook_event_loop_lag_seconds', 'How late the event loop ran a timer, sampled every EVENT_LOOP_LAG_INTERVAL.', buckets=EVENT_LOOP_LAG_BUCKETS)
+
+	async def monitor_event_loop( self, interval : float = EVENT_LOOP_LAG_INTERVAL ) -> None:
+		'''Sample the event loop lag until canceled, a blocked loop shows up as a late wake up.'''
+		while True:
+			start : float = time.perf_counter()
+			await asyncio.sleep(interval)
+			self.event_loop_lag.observe(max(0.0, time.perf_counter() - start - interval))
+
+def benchmark( count : int = 1_000_000 ) -> None:
+	'''Cost of recording a histogram observation and a counter increment, and of rendering a realistic registry.'''
+	metrics = DistributorMetrics()
+	start = time.perf_counter()
+	for index in range(count):
+		metrics.webui_request_time.observe(index % 100 / 1000, 'http://127.0.0.1:7860', '/sdapi/v1/progress')
+	observe_time = time.perf_counter() - start
+	start = time.perf_counter()
+	for _ in range(count):
+		metrics.checkpoint_switches.inc('http://127.0.0.1:7860', 'model')
+	inc_time = time.perf_counter() - start
+	for instance in range(8):
+		for checkpoint in range(16):
+			metrics.queue_wait.observe(instance + checkpoint, f'http://10.0.0.{instance}:7860', f'model-{checkpoint}')
+			metrics.generation_time.observe(instance + checkpoint, f'http://10.0.0.{instance}:7860', f'model-{checkpoint}')
+	start = time.perf_counter()
+	text : str = metrics.render()
+	render_time = time.perf_counter() - start
+	print(
+		f'observe {observe_time / count * 1e9:.0f}ns, inc {inc_time / count * 1e9:.0f}ns, '
+		f'render {len(text.splitlines())} lines in {render_time * 1000:.2f}ms'
+	)
+
+if __name__ == '__main__':
+	benchmark()
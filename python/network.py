@@ -4,19 +4,37 @@ from typing import Any, Literal, Union
 from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel, Field
 from fastapi import FastAPI
-from fastapi import Depends, FastAPI, Body, HTTPException, Header, Request, Security
+from fastapi import Depends, FastAPI, Body, HTTPException, Header, Request, Response, Security
 from fastapi.security import api_key
 from pyngrok import ngrok
 from threading import Thread
-
+from contextlib import asynccontextmanager
+
+from backend import MemoryBackend, SQLiteBackend
+from journal import JOURNAL_FILE, JournalBackend
+from ratelimit import RateLimited
+from registry import InstanceConfig, load_fair_share, load_instances, load_user_weights
+from timeline import TimelineExporter
+from compression import ENCODING_LEGACY, IMAGE_ENCODINGS
 from sdapi import SDTxt2ImgParams, StableDiffusionInstance, StableDiffusionDistributor, SDImage, Operation, OperationStatus, load_bs4_image, timestamp
 
 import json
+import secrets
+import math
+import os
 import uvicorn
-import zlib
 import rsa
 import time
 
+STATE_DATABASE_ENV : str = 'SDHOOK_STATE_DATABASE' # sqlite database shared by the worker processes, unset = in-memory single process state
+API_KEY_ENV : str = 'SDHOOK_API_KEY' # api key passed on to the worker processes
+ADMIN_API_KEY_ENV : str = 'SDHOOK_ADMIN_API_KEY' # key of the /admin endpoints, unset = the /admin endpoints are disabled
+STATE_DATABASE_FILE : str = 'state.db' # default database when hosting several workers
+JOURNAL_ENV : str = 'SDHOOK_JOURNAL' # journal file of the single process setup, empty = keep the state in memory only
+LOG_REQUESTS_ENV : str = 'SDHOOK_LOG_REQUESTS' # set to 1 to print the parameters of every queued Roblox request
+TIMELINE_EXPORT_ENV : str = 'SDHOOK_TIMELINE_EXPORT' # json lines file the operation timelines are appended to, unset = no export
+FAIR_SHARE_ENV : str = 'SDHOOK_FAIR_SHARE' # set to 1 to turn on fair share scheduling without the instances config
+
 ASPECT_RATIO_MAP : dict[str, tuple[int, int]] = {
 	"512x512" : (512, 512),
 	"512x768" : (512, 768),
@@ -29,6 +47,8 @@ ASPECT_RATIO_MAP : dict[str, tuple[int, int]] = {
 	"1024x1024" : (1024, 1024),
 }
 
+LOG_REQUESTS : bool = os.environ.get(LOG_REQUESTS_ENV) == '1'
+
 def log_roblox_params( params : RobloxParameters ) -> None:
 	print(params.model_dump_json())
 
@@ -52,26 +72,88 @@ class RobloxParameters(BaseModel):
 	size : str = Field("512x512")
 	seed : int = Field(-1)
 
-LOCAL_DISTRIBUTOR = StableDiffusionDistributor([StableDiffusionInstance('http://127.0.0.1:7860')])
-APP_API_KEY : str = None
+def create_backend() -> MemoryBackend:
+	database : Union[str, None] = os.environ.get(STATE_DATABASE_ENV)
+	if database is not None:
+		return SQLiteBackend(database)
+	journal : str = os.environ.get(JOURNAL_ENV, JOURNAL_FILE)
+	if journal == '':
+		return MemoryBackend()
+	return JournalBackend(journal)
+
+def create_timeline_exporter() -> Union[TimelineExporter, None]:
+	filepath : Union[str, None] = os.environ.get(TIMELINE_EXPORT_ENV)
+	if filepath is None or filepath == '':
+		return None
+	return TimelineExporter(filepath)
+
+def create_distributor() -> StableDiffusionDistributor:
+	'''The distributor of this process, created by the app lifespan so the environment (state database, journal) is configured first.'''
+	fair_share : bool = os.environ.get(FAIR_SHARE_ENV) == '1' or load_fair_share()
+	return StableDiffusionDistributor(load_instances(), fair_share=fair_share, user_weights=load_user_weights(), backend=create_backend(), timeline_exporter=create_timeline_exporter())
+
+LOCAL_DISTRIBUTOR : Union[StableDiffusionDistributor, None] = None # set while the app is running
+APP_API_KEY : str = os.environ.get(API_KEY_ENV)
+APP_ADMIN_API_KEY : str = os.environ.get(ADMIN_API_KEY_ENV)
 
 async def set_api_key( value : Union[str, None] ) -> None:
 	global APP_API_KEY
 	APP_API_KEY = value
 
+async def set_admin_api_key( value : Union[str, None] ) -> None:
+	global APP_ADMIN_API_KEY
+	APP_ADMIN_API_KEY = value
+
 async def validate_api_key(key : Union[str, None] = Security(api_key.APIKeyHeader(name="X-API-KEY", auto_error=False))) -> None:
 	if APP_API_KEY is not None and key != APP_API_KEY:
 		raise HTTPException(status_code=401, detail="Unauthorized")
 	return None
 
+async def validate_admin_api_key(key : Union[str, None] = Security(api_key.APIKeyHeader(name="X-ADMIN-KEY", auto_error=False))) -> None:
+	'''The /admin endpoints change the instance pool, so they need their own key and are refused when it is not set.'''
+	if APP_ADMIN_API_KEY is None or APP_ADMIN_API_KEY == '':
+		raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+	if key is None or secrets.compare_digest(key, APP_ADMIN_API_KEY) is False:
+		raise HTTPException(status_code=401, detail="Unauthorized")
+	return None
+
 async def host_fastapp(app : FastAPI, host : str, port : int) -> None:
 	print(f"Hosting App: {app.title}")
-	await uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level='debug')).serve()
+	await uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level='info')).serve()
+
+def host_workers( host : str, port : int, workers : int, api_key : Union[str, None] = None, database : str = STATE_DATABASE_FILE, admin_api_key : Union[str, None] = None ) -> None:
+	'''Serve the API from several worker processes sharing their state through the sqlite database (blocks until stopped).'''
+	print(f"Hosting App with {workers} workers, shared state in {database}")
+	os.environ[STATE_DATABASE_ENV] = database
+	if api_key is not None:
+		os.environ[API_KEY_ENV] = api_key
+	if admin_api_key is not None:
+		os.environ[ADMIN_API_KEY_ENV] = admin_api_key
+	uvicorn.run('network:sdapi_hook_v2', host=host, port=port, workers=workers, log_level='info')
+
+@asynccontextmanager
+async def lifespan( app : FastAPI ):
+	global LOCAL_DISTRIBUTOR
+	LOCAL_DISTRIBUTOR = create_distributor()
+	await LOCAL_DISTRIBUTOR.initialize()
+	if LOCAL_DISTRIBUTOR.is_leader is True:
+		_ = await LOCAL_DISTRIBUTOR.find_unavailable_instances()
+	yield
+	await LOCAL_DISTRIBUTOR.shutdown()
+	LOCAL_DISTRIBUTOR.backend.close()
+
+sdapi_hook_v2 = FastAPI(title='Stable Diffusion Hook V2', summary='Hooking onto Stable Diffusion WebUI for Roblox', version='0.1.0', lifespan=lifespan)
 
-sdapi_hook_v2 = FastAPI(title='Stable Diffusion Hook V2', summary='Hooking onto Stable Diffusion WebUI for Roblox', version='0.1.0')
+async def save_rsa_keys( identifier : str, client_public : rsa.PublicKey, server_public : rsa.PublicKey, server_private : rsa.PrivateKey ) -> None:
+	'''Keys are kept in the state backend so every worker process can use them.'''
+	await LOCAL_DISTRIBUTOR.backend.call(LOCAL_DISTRIBUTOR.backend.set_value, f'rsa:{identifier}', {
+		'client' : [client_public.n, client_public.e], # for server to use to communicate with client
+		'public' : [server_public.n, server_public.e], # for clients to use
+		'private' : server_private.save_pkcs1().decode('utf-8'), # to decrypt with
+	})
 
-client_rsa : dict = {} # public keys for server to use to communicate with client
-server_rsa : dict = {} # public key for clients to use, private keys to decrypt with
+async def load_rsa_keys( identifier : str ) -> Union[dict, None]:
+	return await LOCAL_DISTRIBUTOR.backend.call(LOCAL_DISTRIBUTOR.backend.get_value, f'rsa:{identifier}')
 
 # TODO: implement properly
 # async def rsa_decrypt_pass(request : Request) -> None:
@@ -115,32 +197,58 @@ async def root() -> str:
 
 @sdapi_hook_v2.post('/setup_rsa')
 async def setup_rsa( identifier : str = Body(None, embed=True), public_key : str = Body(None, embed=True) ) -> Union[str, None]:
-	if identifier in server_rsa.keys():
+	if await load_rsa_keys(identifier) is not None:
 		return None
 	public, private = rsa.newkeys(1024)
 	n, e = public_key.split(',')
-	client_rsa[identifier] = rsa.PublicKey(n=int(n[1:]), e=int(e[:-1])) # for server to use
-	server_rsa[identifier] = (public, private) # for clients to use
+	await save_rsa_keys(identifier, rsa.PublicKey(n=int(n[1:]), e=int(e[:-1])), public, private)
 	return f'{public.n},{public.e}'
 
 @sdapi_hook_v2.post('/get_public_key')
 async def get_public_key( identifier : str = Body(None, embed=True) ) -> Union[str, None]:
-	if identifier in server_rsa.keys():
-		public : rsa.PublicKey = server_rsa[identifier][0]
-		return f'{public.n},{public.e}'
+	keys : Union[dict, None] = await load_rsa_keys(identifier)
+	if keys is not None:
+		n, e = keys['public']
+		return f'{n},{e}'
 	return None
 
 @sdapi_hook_v2.get('/total_instances', dependencies=[Depends(validate_api_key)])
 async def total_instances() -> int:
-	return len(LOCAL_DISTRIBUTOR.instances)
+	return LOCAL_DISTRIBUTOR.get_instance_count()
 
 @sdapi_hook_v2.get('/queue_length', dependencies=[Depends(validate_api_key)])
 async def queue_length() -> int:
-	return len(LOCAL_DISTRIBUTOR.queue)
+	return LOCAL_DISTRIBUTOR.get_queue_length()
 
 @sdapi_hook_v2.get('/total_operations', dependencies=[Depends(validate_api_key)])
 async def total_operations() -> int:
-	return len(LOCAL_DISTRIBUTOR.operations.keys())
+	return LOCAL_DISTRIBUTOR.get_operation_count()
+
+@sdapi_hook_v2.get('/get_scheduler_stats', dependencies=[Depends(validate_api_key)])
+async def get_scheduler_stats() -> dict[str, int]:
+	return LOCAL_DISTRIBUTOR.get_scheduler_stats()
+
+@sdapi_hook_v2.get('/get_result_cache_stats', dependencies=[Depends(validate_api_key)])
+async def get_result_cache_stats() -> dict[str, int]:
+	return LOCAL_DISTRIBUTOR.result_cache.get_stats()
+
+@sdapi_hook_v2.get('/get_result_store_stats', dependencies=[Depends(validate_api_key)])
+async def get_result_store_stats() -> dict[str, int]:
+	return LOCAL_DISTRIBUTOR.results.get_stats()
+
+@sdapi_hook_v2.get('/metrics', dependencies=[Depends(validate_api_key)])
+async def metrics() -> Response:
+	'''Queue, scheduler and instance metrics of this process in the Prometheus text format.'''
+	return Response(content=LOCAL_DISTRIBUTOR.metrics.render(), media_type='text/plain; version=0.0.4')
+
+@sdapi_hook_v2.get('/get_postprocess_stats', dependencies=[Depends(validate_api_key)])
+async def get_postprocess_stats() -> dict[str, dict[str, float]]:
+	return LOCAL_DISTRIBUTOR.postprocessor.get_stats()
+
+@sdapi_hook_v2.get('/get_instances_health', dependencies=[Depends(validate_api_key)])
+async def get_instances_health() -> list[dict]:
+	'''Circuit breaker state of each instance (closed = healthy) and its recent transitions.'''
+	return LOCAL_DISTRIBUTOR.get_instances_health()
 
 @sdapi_hook_v2.get('/get_instance_infos', dependencies=[Depends(validate_api_key)])
 async def get_instance_infos() -> list[dict]:
@@ -156,31 +264,99 @@ async def is_operation_completed( operation_id : str = Body(embed=True) ) -> boo
 
 @sdapi_hook_v2.post('/get_operation_metadata', dependencies=[Depends(validate_api_key)])
 async def get_operation_metadata( operation_id : str = Body(embed=True) ) -> dict:
-	operation : Union[Operation, None] = LOCAL_DISTRIBUTOR.operations.get(operation_id)
+	operation : Union[Operation, None] = await LOCAL_DISTRIBUTOR.get_operation(operation_id)
 	if operation is None:
 		return None
 	return {"state" : operation.state, "timestamp" : operation.timestamp, "error" : operation.error}
 
+@sdapi_hook_v2.post('/get_operations_status', dependencies=[Depends(validate_api_key)])
+async def get_operations_status( operation_ids : list[str] = Body(embed=True) ) -> dict[str, Union[dict, None]]:
+	'''Bulk {state, error, progress, queue_position, eta} for many operations in one request.'''
+	return await LOCAL_DISTRIBUTOR.get_operations_status(operation_ids)
+
 @sdapi_hook_v2.post('/get_operation_progress', dependencies=[Depends(validate_api_key)])
 async def get_operation_progress( operation_id : str = Body(embed=True) ) -> Union[dict, str, None]:
 	return await LOCAL_DISTRIBUTOR.get_operation_progress(operation_id)
 
+@sdapi_hook_v2.post('/wait_operation', dependencies=[Depends(validate_api_key)])
+async def wait_operation(
+	operation_id : str = Body(embed=True),
+	last_state : Union[int, None] = Body(None, embed=True),
+	last_progress : Union[float, None] = Body(None, embed=True),
+	timeout : float = Body(20, embed=True),
+) -> Union[dict, None]:
+	'''Long-poll: returns {state, error, progress} once the state or progress changes, or after the timeout.'''
+	return await LOCAL_DISTRIBUTOR.wait_operation(operation_id, last_state=last_state, last_progress=last_progress, timeout=timeout)
+
 @sdapi_hook_v2.post('/cancel_operation', dependencies=[Depends(validate_api_key)])
 async def cancel_operation( operation_id : str = Body(embed=True) ) -> None:
 	await LOCAL_DISTRIBUTOR.cancel_operation(operation_id)
 	return None
 
-# TODO: implement properly
 @sdapi_hook_v2.post('/get_operation_images', dependencies=[Depends(validate_api_key)])
 async def get_operation_images( operation_id : str = Body(embed=True) ) -> Union[list[dict], None]:
-	images : Union[list[SDImage], None] = await LOCAL_DISTRIBUTOR.get_operation_images(operation_id)
-	if images is None:
+	'''Tile layout of each image, fetch the tiles themselves with /get_operation_tile.'''
+	tiles : Union[list[dict], None] = await LOCAL_DISTRIBUTOR.get_operation_tiles(operation_id)
+	if tiles is None:
+		return None
+	return [{'size' : item['size'], 'tile_size' : item['tile_size'], 'columns' : item['columns'], 'rows' : item['rows']} for item in tiles]
+
+@sdapi_hook_v2.post('/get_operation_image', dependencies=[Depends(validate_api_key)])
+async def get_operation_image( operation_id : str = Body(embed=True), image_index : int = Body(0, embed=True) ) -> Response:
+	'''The raw png of a single image, the body is the stored bytes without base64 or json wrapping.'''
+	data : Union[bytes, None] = await LOCAL_DISTRIBUTOR.get_operation_image(operation_id, image_index)
+	if data is None:
+		raise HTTPException(status_code=404, detail="Image not found")
+	return Response(content=data, media_type='image/png')
+
+@sdapi_hook_v2.post('/get_operation_tile', dependencies=[Depends(validate_api_key)])
+async def get_operation_tile(
+	operation_id : str = Body(embed=True),
+	image_index : int = Body(0, embed=True),
+	tile_x : int = Body(embed=True),
+	tile_y : int = Body(embed=True),
+	image_encoding : Union[str, None] = Header(None, alias='X-Image-Encoding'),
+) -> Union[dict, None]:
+	'''
+	A single compressed tile. The X-Image-Encoding header picks the format of `data`:
+	- legacy (default): zlib + hex encoded palette string
+	- palette / rgb565: the compact binary format (zlib + base64), see the README
+	'''
+	encoding : str = image_encoding if image_encoding in IMAGE_ENCODINGS else ENCODING_LEGACY
+	data : Union[str, None] = await LOCAL_DISTRIBUTOR.get_operation_tile(operation_id, image_index, tile_x, tile_y, encoding=encoding)
+	if data is None:
 		return None
-	return [{'size' : item.size, 'image' : len(zlib.compress(item.data.encode('utf-8')))} for item in images]
+	if encoding == ENCODING_LEGACY:
+		return {'tile_x' : tile_x, 'tile_y' : tile_y, 'data' : data}
+	return {'tile_x' : tile_x, 'tile_y' : tile_y, 'encoding' : encoding, 'data' : data}
+
+@sdapi_hook_v2.post('/admin/get_operation_timeline', dependencies=[Depends(validate_admin_api_key)])
+async def admin_get_operation_timeline( operation_id : str = Body(embed=True) ) -> Union[dict, None]:
+	'''Where the operation's time went: each step with its start, duration, instance and offset from queueing.'''
+	return await LOCAL_DISTRIBUTOR.get_operation_timeline(operation_id)
+
+@sdapi_hook_v2.get('/admin/list_instances', dependencies=[Depends(validate_admin_api_key)])
+async def admin_list_instances() -> list[dict]:
+	return LOCAL_DISTRIBUTOR.list_instances()
+
+@sdapi_hook_v2.post('/admin/add_instance', dependencies=[Depends(validate_admin_api_key)])
+async def admin_add_instance( config : InstanceConfig = Body(embed=False) ) -> str:
+	'''Add an instance to the pool, returns its id. It takes operations once its first health probe succeeds.'''
+	return await LOCAL_DISTRIBUTOR.request_add_instance(config.create_instance())
+
+@sdapi_hook_v2.post('/admin/drain_instance', dependencies=[Depends(validate_admin_api_key)])
+async def admin_drain_instance( instance_id : str = Body(embed=True) ) -> bool:
+	'''Stop sending the instance new operations, it is removed once its in-flight operations finish.'''
+	return await LOCAL_DISTRIBUTOR.request_drain_instance(instance_id)
+
+@sdapi_hook_v2.post('/admin/remove_instance', dependencies=[Depends(validate_admin_api_key)])
+async def admin_remove_instance( instance_id : str = Body(embed=True) ) -> bool:
+	'''Remove the instance now, operations it was generating are requeued.'''
+	return await LOCAL_DISTRIBUTOR.request_remove_instance(instance_id)
 
 @sdapi_hook_v2.post('/queue_txt2img', dependencies=[Depends(validate_api_key)])
 async def queue_txt2img( params : RobloxParameters = Body(embed=False) ) -> str:
-	if params.roblox_user is not None:
+	if params.roblox_user is not None and LOG_REQUESTS is True:
 		log_roblox_params(params)
 
 	if params.size not in ASPECT_RATIO_MAP.keys():
@@ -190,8 +366,7 @@ async def queue_txt2img( params : RobloxParameters = Body(embed=False) ) -> str:
 		return False, 'Invalid steps parameter - must be between 1 and 30.'
 
 	width, height = ASPECT_RATIO_MAP.get(params.size)
-
-	print(f'Queueing Roblox txt2img parameters: {params.model_dump_json(indent=None)}')
+	user_id : Union[int, None] = params.roblox_user.user_id if params.roblox_user is not None else None
 
 	params = SDTxt2ImgParams(
 		checkpoint=params.checkpoint,
@@ -205,7 +380,10 @@ async def queue_txt2img( params : RobloxParameters = Body(embed=False) ) -> str:
 		seed=params.seed,
 	)
 
-	return await LOCAL_DISTRIBUTOR.queue_txt2img(params)
+	try:
+		return await LOCAL_DISTRIBUTOR.queue_txt2img(params, user_id=user_id)
+	except RateLimited as exception:
+		raise HTTPException(status_code=429, detail=str(exception), headers={'Retry-After' : str(math.ceil(exception.retry_after))})
 
 class Ngrok:
 	'''Ngrok singleton class - manages the ngrok tunnel - old code xd'''
@@ -266,10 +444,9 @@ class Ngrok:
 			time.sleep( 0.25 )
 		return Ngrok.tunnel.public_url
 
-async def localhost( host : str = '0.0.0.0', port : int = 5100, api_key : str = None ) -> None:
+async def localhost( host : str = '0.0.0.0', port : int = 5100, api_key : str = None, admin_api_key : str = None ) -> None:
 	print(f'Setting API_Key to "{api_key}"')
-	await LOCAL_DISTRIBUTOR.initialize()
-	_ = await LOCAL_DISTRIBUTOR.find_unavailable_instances()
 	await set_api_key(api_key)
-	await host_fastapp(sdapi_hook_v2, host, port)
-	await LOCAL_DISTRIBUTOR.shutdown()
+	if admin_api_key is not None:
+		await set_admin_api_key(admin_api_key)
+	await host_fastapp(sdapi_hook_v2, host, port) # the distributor is started and stopped by the app lifespan
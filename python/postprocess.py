@@ -0,0 +1,90 @@
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Union
+from io import BytesIO
+from PIL import Image
+
+from compression import encode_image_tiles
+
+import asyncio
+import numpy
+import time
+import os
+
+POSTPROCESS_WORKERS : int = max(1, (os.cpu_count() or 2) - 1) # processes used for image decode/encode work
+
+def encode_png_image_tiles( data : bytes, tile_size : int, encodings : tuple[str, ...] ) -> dict:
+	'''Decode a png and encode its tiles, runs inside a pool process.'''
+	pixels = numpy.asarray( Image.open( BytesIO( data ) ).convert('RGB') )
+	return encode_image_tiles(pixels, tile_size=tile_size, encodings=encodings)
+
+def _timed_call( function : Callable, *args ) -> tuple[float, Any]:
+	'''Run the function and also return how long it took inside the pool process.'''
+	start = time.perf_counter()
+	result = function(*args)
+	return time.perf_counter() - start, result
+
+class PostProcessor:
+	'''
+	Runs CPU-bound image transforms in a process pool so they never block the event loop.
+	Work is passed in and out as plain strings/bytes/dicts, never as PIL objects.
+	Tracks the queue depth and the wait/run time of each named stage.
+	'''
+	max_workers : int
+	executor : Union[ProcessPoolExecutor, None]
+	stats : dict[str, dict[str, float]]
+
+	def __init__( self, max_workers : int = None ) -> None:
+		self.max_workers = max_workers or POSTPROCESS_WORKERS
+		self.executor = None
+		self.stats = dict()
+
+	def start( self ) -> None:
+		if self.executor is None:
+			self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+	async def shutdown( self ) -> None:
+		if self.executor is not None:
+			executor, self.executor = self.executor, None
+			await asyncio.to_thread(executor.shutdown, True, cancel_futures=True)
+
+	def _stage_stats( self, stage : str ) -> dict[str, float]:
+		if stage not in self.stats:
+			self.stats[stage] = { "pending" : 0, "completed" : 0, "failed" : 0, "wait_time" : 0.0, "run_time" : 0.0, "max_run_time" : 0.0 }
+		return self.stats[stage]
+
+	async def run( self, stage : str, function : Callable, *args ) -> Any:
+		'''Run a picklable top-level function in the pool (or a thread if the pool is not started).'''
+		stats = self._stage_stats(stage)
+		stats["pending"] += 1
+		start = time.perf_counter()
+		try:
+			if self.executor is not None:
+				run_time, result = await asyncio.get_running_loop().run_in_executor(self.executor, _timed_call, function, *args)
+			else:
+				run_time, result = await asyncio.to_thread(_timed_call, function, *args)
+		except Exception:
+			stats["failed"] += 1
+			raise
+		finally:
+			stats["pending"] -= 1
+		stats["completed"] += 1
+		stats["run_time"] += run_time
+		stats["wait_time"] += max(0.0, time.perf_counter() - start - run_time)
+		stats["max_run_time"] = max(stats["max_run_time"], run_time)
+		return result
+
+	def get_stats( self ) -> dict[str, dict[str, float]]:
+		'''Per stage: pending (queue depth), completed, failed, average wait/run time and max run time in seconds.'''
+		output : dict[str, dict[str, float]] = {}
+		for stage, stats in self.stats.items():
+			completed = max(1, stats["completed"])
+			output[stage] = {
+				"pending" : stats["pending"],
+				"completed" : stats["completed"],
+				"failed" : stats["failed"],
+				"average_wait_time" : round(stats["wait_time"] / completed, 4),
+				"average_run_time" : round(stats["run_time"] / completed, 4),
+				"max_run_time" : round(stats["max_run_time"], 4),
+			}
+		return output
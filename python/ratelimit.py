@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import time
+
+class RateLimited(Exception):
+	'''A request was rejected by a limit, `retry_after` is how many seconds until it would be accepted.'''
+	retry_after : float
+
+	def __init__( self, message : str, retry_after : float ) -> None:
+		super().__init__(message)
+		self.retry_after = retry_after
+
+class TokenBucket:
+	'''
+	Holds up to `capacity` tokens and refills `refill_rate` tokens per second.
+	Each accepted request consumes one token, so bursts of `capacity` are allowed
+	but the sustained rate is bounded by `refill_rate`.
+	'''
+	capacity : float
+	refill_rate : float
+	tokens : float
+	updated_at : float
+
+	def __init__( self, capacity : float, refill_rate : float ) -> None:
+		self.capacity = capacity
+		self.refill_rate = refill_rate
+		self.tokens = capacity
+		self.updated_at = time.monotonic()
+
+	def _refill( self ) -> None:
+		now = time.monotonic()
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+		self.updated_at = now
+
+	def try_consume( self, amount : float = 1 ) -> float:
+		'''Consume the tokens and return 0, or return the seconds until enough tokens are available.'''
+		self._refill()
+		if self.tokens >= amount:
+			self.tokens -= amount
+			return 0
+		return (amount - self.tokens) / self.refill_rate
+
+	def is_full( self ) -> bool:
+		self._refill()
+		return self.tokens >= self.capacity
@@ -0,0 +1,64 @@
+from __future__ import annotations
+from pydantic import BaseModel, Field
+from typing import Union
+
+from sdapi import StableDiffusionInstance
+
+import json
+import os
+
+INSTANCES_CONFIG_FILE : str = 'instances.json' # instances loaded at startup, see instances.example.json
+
+class InstanceConfig(BaseModel):
+	'''A stable diffusion webui instance in the pool.'''
+	endpoint : str = Field(None)
+	headers : Union[dict, None] = Field(None)
+	cookies : Union[dict, None] = Field(None)
+	weight : int = Field(1)
+	max_concurrency : int = Field(1)
+	tags : list[str] = Field(default_factory=list)
+
+	def create_instance( self ) -> StableDiffusionInstance:
+		return StableDiffusionInstance(
+			self.endpoint,
+			headers=self.headers,
+			cookies=self.cookies,
+			weight=self.weight,
+			max_concurrency=self.max_concurrency,
+			tags=self.tags,
+		)
+
+def load_instances_config( filepath : str = INSTANCES_CONFIG_FILE ) -> Union[list[InstanceConfig], None]:
+	'''Read the instances config (a list of InstanceConfig, or {"instances" : [...]}), None if there is no config file.'''
+	if os.path.exists(filepath) is False:
+		return None
+	with open(filepath, 'r') as file:
+		data = json.load(file)
+	if isinstance(data, dict):
+		data = data.get('instances', [])
+	return [ InstanceConfig(**item) for item in data ]
+
+def load_fair_share( filepath : str = INSTANCES_CONFIG_FILE ) -> bool:
+	'''Whether the config turns on fair share scheduling ("fair_share" : true), off by default.'''
+	if os.path.exists(filepath) is False:
+		return False
+	with open(filepath, 'r') as file:
+		data = json.load(file)
+	return isinstance(data, dict) is True and data.get('fair_share') is True
+
+def load_user_weights( filepath : str = INSTANCES_CONFIG_FILE ) -> dict[int, int]:
+	'''The fair share weight of each Roblox user id from the config's "user_weights", users not listed have a weight of 1.'''
+	if os.path.exists(filepath) is False:
+		return {}
+	with open(filepath, 'r') as file:
+		data = json.load(file)
+	if isinstance(data, dict) is False:
+		return {}
+	return { int(user_id) : int(weight) for user_id, weight in data.get('user_weights', {}).items() }
+
+def load_instances( filepath : str = INSTANCES_CONFIG_FILE, default_endpoint : str = 'http://127.0.0.1:7860' ) -> list[StableDiffusionInstance]:
+	'''Create the instances from the config file, or a single local instance if there is none.'''
+	configs : Union[list[InstanceConfig], None] = load_instances_config(filepath)
+	if configs is None:
+		return [ StableDiffusionInstance(default_endpoint) ]
+	return [ config.create_instance() for config in configs ]
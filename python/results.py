@@ -0,0 +1,428 @@
+from __future__ import annotations
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Union
+
+import shutil
+import struct
+import mmap
+import json
+import time
+import os
+
+if TYPE_CHECKING:
+	from sdapi import SDImage
+
+RESULT_STORE_MEMORY_BUDGET : int = 256 * 1024 * 1024 # bytes of completed results kept in memory, colder ones are spilled to disk
+RESULT_STORE_DISK_BUDGET : int = 4 * 1024 * 1024 * 1024 # bytes of spilled results, the least recently used are deleted past this
+RESULT_STORE_DIRECTORY : str = 'results' # where results are spilled, cleared on startup
+RESULT_STORE_OPEN_MAPS : int = 32 # spilled results kept memory-mapped at once
+
+SPILL_MAGIC : bytes = b'SDR1'
+SPILL_EXTENSION : str = '.result'
+
+def remove_file( filepath : str ) -> None:
+	try:
+		os.remove(filepath)
+	except OSError:
+		pass
+
+def pid_exists( pid : int ) -> bool:
+	'''If a process with this pid is running, a process that cannot be queried counts as running.'''
+	if os.name == 'nt':
+		import ctypes
+		handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid) # PROCESS_QUERY_LIMITED_INFORMATION
+		if handle == 0:
+			return ctypes.windll.kernel32.GetLastError() == 5 # ERROR_ACCESS_DENIED
+		ctypes.windll.kernel32.CloseHandle(handle)
+		return True
+	try:
+		os.kill(pid, 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		return True
+	return True
+
+def remove_stale_directories( directory : str ) -> None:
+	'''Delete the per process spill directories (named by pid) of processes that are no longer running.'''
+	if os.path.isdir(directory) is False:
+		return
+	for entry in os.scandir(directory):
+		if entry.is_dir() is False or entry.name.isdigit() is False:
+			continue
+		pid : int = int(entry.name)
+		if pid != os.getpid() and pid_exists(pid) is False:
+			shutil.rmtree(entry.path, ignore_errors=True)
+
+class StoredResult:
+	'''The decoded images and encoded tiles of a completed operation held in memory.'''
+	images : list[SDImage]
+	tiles : list[dict]
+	nbytes : int
+
+	def __init__( self, images : list[SDImage], tiles : list[dict] ) -> None:
+		self.images = images
+		self.tiles = tiles
+		self.nbytes = sum( len(image.data) for image in images ) + sum( len(tile) for image in tiles for encoded in image['tiles'].values() for tile in encoded )
+
+class SpilledResult:
+	'''
+	A result spilled to a memory-mapped file:
+	magic, u32 header length, json header (image/tile offsets), then the image bytes and ascii tiles.
+	Only the requested image or tile is read from the map.
+	'''
+	file : object
+	map : mmap.mmap
+	header : dict
+	base : int
+
+	def __init__( self, filepath : str ) -> None:
+		self.file = open(filepath, 'rb')
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		length, = struct.unpack_from('<I', self.map, len(SPILL_MAGIC))
+		start : int = len(SPILL_MAGIC) + 4
+		self.header = json.loads(self.map[start:start + length])
+		self.base = start + length
+
+	@staticmethod
+	def write( filepath : str, result : StoredResult ) -> int:
+		'''Write the result in the spill format and return the file size.'''
+		blobs : list[bytes] = []
+		offset : int = 0
+		images : list[dict] = []
+		for image in result.images:
+			images.append({ 'size' : image.size, 'offset' : offset, 'length' : len(image.data) })
+			blobs.append(image.data)
+			offset += len(image.data)
+		tiles : list[dict] = []
+		for image_tiles in result.tiles:
+			encodings : dict[str, list[int]] = {}
+			for encoding, encoded in image_tiles['tiles'].items():
+				bounds : list[int] = [ offset ]
+				for tile in encoded:
+					data : bytes = tile.encode('ascii')
+					blobs.append(data)
+					offset += len(data)
+					bounds.append(offset)
+				encodings[encoding] = bounds
+			tiles.append({ **{ key : value for key, value in image_tiles.items() if key != 'tiles' }, 'tiles' : encodings })
+		header : bytes = json.dumps({ 'images' : images, 'tiles' : tiles }).encode('utf-8')
+		with open(filepath, 'wb') as file:
+			file.write(SPILL_MAGIC)
+			file.write(struct.pack('<I', len(header)))
+			file.write(header)
+			for blob in blobs:
+				file.write(blob)
+		return len(SPILL_MAGIC) + 4 + len(header) + offset
+
+	def read( self, offset : int, length : int ) -> bytes:
+		return self.map[self.base + offset:self.base + offset + length]
+
+	def get_tile( self, image_index : int, encoding : str, index : int ) -> Union[str, None]:
+		bounds : Union[list[int], None] = self.header['tiles'][image_index]['tiles'].get(encoding)
+		if bounds is None:
+			return None
+		return self.read(bounds[index], bounds[index + 1] - bounds[index]).decode('ascii')
+
+	def load( self ) -> tuple[list[tuple[tuple[int, int], bytes]], list[dict]]:
+		'''Every image (size, bytes) and the tiles in their in-memory layout.'''
+		images = [ (tuple(image['size']), self.read(image['offset'], image['length'])) for image in self.header['images'] ]
+		tiles : list[dict] = []
+		for image_tiles in self.header['tiles']:
+			encodings : dict[str, list[str]] = {}
+			for encoding, bounds in image_tiles['tiles'].items():
+				encodings[encoding] = [ self.read(bounds[index], bounds[index + 1] - bounds[index]).decode('ascii') for index in range(len(bounds) - 1) ]
+			tiles.append({ **{ key : value for key, value in image_tiles.items() if key != 'tiles' }, 'size' : tuple(image_tiles['size']), 'tiles' : encodings })
+		return images, tiles
+
+	def close( self ) -> None:
+		self.map.close()
+		self.file.close()
+
+class ResultStore:
+	'''
+	Completed results bounded by a memory budget instead of a fixed lifetime.
+	Images are held once as decoded bytes. Past the memory budget, the least recently used results
+	are spilled to memory-mapped files, and past the disk budget the least recently used spilled
+	results are deleted (reported by `pop_evicted`).
+	Spill files are written by a background thread. Until its file is written, a spilling result is
+	still served from memory, and it is counted as spilled once the write finishes.
+	'''
+	memory_budget : int
+	directory : Union[str, None]
+	disk_budget : int
+
+	entries : OrderedDict[str, StoredResult]
+	memory_bytes : int
+	spilled : OrderedDict[str, int] # uuid -> file size
+	disk_bytes : int
+	evicted : list[str]
+	stats : dict[str, int]
+	_maps : OrderedDict[str, SpilledResult]
+	_writes : OrderedDict[str, tuple[StoredResult, Future]] # results being spilled, in spill order
+	_executor : Union[ThreadPoolExecutor, None]
+
+	def __init__( self, memory_budget : int = RESULT_STORE_MEMORY_BUDGET, directory : Union[str, None] = RESULT_STORE_DIRECTORY, disk_budget : int = RESULT_STORE_DISK_BUDGET ) -> None:
+		self.memory_budget = memory_budget
+		self.directory = directory
+		self.disk_budget = disk_budget
+		self.entries = OrderedDict()
+		self.memory_bytes = 0
+		self.spilled = OrderedDict()
+		self.disk_bytes = 0
+		self.evicted = list()
+		self.stats = { "hits" : 0, "disk_hits" : 0, "misses" : 0, "spills" : 0, "evictions" : 0 }
+		self._maps = OrderedDict()
+		self._writes = OrderedDict()
+		self._executor = None
+		if directory is not None:
+			os.makedirs(directory, exist_ok=True)
+			for entry in os.scandir(directory):
+				if entry.name.endswith(SPILL_EXTENSION):
+					os.remove(entry.path) # left over from a previous run, nothing refers to them anymore
+
+	def _path( self, uuid : str ) -> str:
+		return os.path.join(self.directory, f'{uuid}{SPILL_EXTENSION}')
+
+	def _open( self, uuid : str ) -> SpilledResult:
+		spilled : Union[SpilledResult, None] = self._maps.get(uuid)
+		if spilled is not None:
+			self._maps.move_to_end(uuid)
+			return spilled
+		spilled = SpilledResult(self._path(uuid))
+		self._maps[uuid] = spilled
+		while len(self._maps) > RESULT_STORE_OPEN_MAPS:
+			_, closed = self._maps.popitem(last=False)
+			closed.close()
+		return spilled
+
+	def _delete_spilled( self, uuid : str ) -> None:
+		self.disk_bytes -= self.spilled.pop(uuid)
+		spilled : Union[SpilledResult, None] = self._maps.pop(uuid, None)
+		if spilled is not None:
+			spilled.close()
+		remove_file(self._path(uuid))
+
+	def _spill( self, uuid : str, result : StoredResult ) -> None:
+		if self.directory is None:
+			self.evicted.append(uuid)
+			self.stats["evictions"] += 1
+			return
+		if self._executor is None:
+			# a single thread, so writes and the deletion of abandoned writes' files happen in order
+			self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='result-spill')
+		self._writes[uuid] = (result, self._executor.submit(SpilledResult.write, self._path(uuid), result))
+
+	def _abandon_write( self, uuid : str ) -> Union[StoredResult, None]:
+		'''Stop tracking a spill in progress, its file is deleted once written. Returns the result.'''
+		entry : Union[tuple[StoredResult, Future], None] = self._writes.pop(uuid, None)
+		if entry is None:
+			return None
+		filepath : str = self._path(uuid)
+		entry[1].add_done_callback(lambda _ : remove_file(filepath))
+		return entry[0]
+
+	def _collect_writes( self ) -> None:
+		'''Account the finished spill writes, in spill order so the disk budget evicts the oldest first.'''
+		while len(self._writes) > 0:
+			uuid, (result, future) = next(iter(self._writes.items()))
+			if future.done() is False:
+				return
+			del self._writes[uuid]
+			exception : Union[BaseException, None] = future.exception()
+			if exception is not None:
+				print(f'Failed to spill result {uuid}: {exception}')
+				self.evicted.append(uuid)
+				self.stats["evictions"] += 1
+				continue
+			self._add_spilled(uuid, future.result())
+
+	def flush( self ) -> None:
+		'''Wait for the spill writes in progress.'''
+		for _, future in list(self._writes.values()):
+			future.exception()
+		self._collect_writes()
+
+	def _add_spilled( self, uuid : str, nbytes : int ) -> None:
+		self.spilled[uuid] = nbytes
+		self.disk_bytes += nbytes
+		self.stats["spills"] += 1
+		while self.disk_bytes > self.disk_budget and len(self.spilled) > 0:
+			evicted_uuid : str = next(iter(self.spilled))
+			self._delete_spilled(evicted_uuid)
+			self.evicted.append(evicted_uuid)
+			self.stats["evictions"] += 1
+
+	def _memory_result( self, uuid : str ) -> Union[StoredResult, None]:
+		'''The result if it is in memory, including while its spill is being written.'''
+		result : Union[StoredResult, None] = self.entries.get(uuid)
+		if result is not None:
+			self.entries.move_to_end(uuid)
+			return result
+		entry : Union[tuple[StoredResult, Future], None] = self._writes.get(uuid)
+		return entry[0] if entry is not None else None
+
+	def _store_memory( self, uuid : str, result : StoredResult ) -> None:
+		self.entries[uuid] = result
+		self.memory_bytes += result.nbytes
+		while self.memory_bytes > self.memory_budget and len(self.entries) > 0:
+			spilled_uuid, spilled_result = self.entries.popitem(last=False)
+			self.memory_bytes -= spilled_result.nbytes
+			self._spill(spilled_uuid, spilled_result)
+
+	def put( self, uuid : str, images : list[SDImage], tiles : list[dict] ) -> None:
+		self._collect_writes()
+		self.remove(uuid)
+		self._store_memory(uuid, StoredResult(images, tiles))
+
+	def has( self, uuid : str ) -> bool:
+		return uuid in self.entries or uuid in self._writes or uuid in self.spilled
+
+	def get( self, uuid : str ) -> Union[StoredResult, None]:
+		'''The whole result, read back from disk (without moving it into memory) when it was spilled.'''
+		from sdapi import SDImage
+		result : Union[StoredResult, None] = self._memory_result(uuid)
+		if result is not None:
+			self.stats["hits"] += 1
+			return result
+		if uuid not in self.spilled:
+			self.stats["misses"] += 1
+			return None
+		self.spilled.move_to_end(uuid)
+		self.stats["disk_hits"] += 1
+		images, tiles = self._open(uuid).load()
+		return StoredResult([ SDImage(size=size, data=data) for size, data in images ], tiles)
+
+	def get_image( self, uuid : str, image_index : int ) -> Union[bytes, None]:
+		'''The png bytes of a single image, the stored object itself when in memory or read from its map when spilled.'''
+		result : Union[StoredResult, None] = self._memory_result(uuid)
+		if result is not None:
+			self.stats["hits"] += 1
+			return result.images[image_index].data if 0 <= image_index < len(result.images) else None
+		if uuid not in self.spilled:
+			self.stats["misses"] += 1
+			return None
+		self.spilled.move_to_end(uuid)
+		self.stats["disk_hits"] += 1
+		spilled : SpilledResult = self._open(uuid)
+		if image_index < 0 or image_index >= len(spilled.header['images']):
+			return None
+		image : dict = spilled.header['images'][image_index]
+		return spilled.read(image['offset'], image['length'])
+
+	def get_layout( self, uuid : str ) -> Union[list[dict], None]:
+		'''Size, tile size, columns and rows of each image.'''
+		result : Union[StoredResult, None] = self._memory_result(uuid)
+		if result is not None:
+			tiles : list[dict] = result.tiles
+		elif uuid in self.spilled:
+			tiles : list[dict] = self._open(uuid).header['tiles']
+		else:
+			return None
+		return [ { 'size' : tuple(item['size']), 'tile_size' : item['tile_size'], 'columns' : item['columns'], 'rows' : item['rows'] } for item in tiles ]
+
+	def get_tile( self, uuid : str, image_index : int, encoding : str, index : int ) -> Union[str, None]:
+		'''A single encoded tile, None if the result or the encoding does not exist.'''
+		result : Union[StoredResult, None] = self._memory_result(uuid)
+		if result is not None:
+			self.stats["hits"] += 1
+			encoded : Union[list[str], None] = result.tiles[image_index]['tiles'].get(encoding)
+			return encoded[index] if encoded is not None else None
+		if uuid not in self.spilled:
+			self.stats["misses"] += 1
+			return None
+		self.spilled.move_to_end(uuid)
+		self.stats["disk_hits"] += 1
+		return self._open(uuid).get_tile(image_index, encoding, index)
+
+	def add_encoding( self, uuid : str, image_index : int, encoding : str, encoded : list[str] ) -> None:
+		'''Add tiles encoded after completion, a spilled result is moved back into memory for it.'''
+		result : Union[StoredResult, None] = self.entries.get(uuid)
+		if result is not None:
+			self.memory_bytes -= self.entries.pop(uuid).nbytes
+		elif uuid in self._writes:
+			result = self._abandon_write(uuid)
+		else:
+			result = self.get(uuid)
+			if result is None:
+				return
+			self._delete_spilled(uuid)
+		result.tiles[image_index]['tiles'][encoding] = encoded
+		result.nbytes += sum( len(tile) for tile in encoded )
+		self._store_memory(uuid, result)
+
+	def remove( self, uuid : str ) -> None:
+		result : Union[StoredResult, None] = self.entries.pop(uuid, None)
+		if result is not None:
+			self.memory_bytes -= result.nbytes
+		_ = self._abandon_write(uuid)
+		if uuid in self.spilled:
+			self._delete_spilled(uuid)
+
+	def pop_evicted( self ) -> list[str]:
+		'''Results deleted to stay within the budgets since the last call.'''
+		self._collect_writes()
+		evicted, self.evicted = self.evicted, list()
+		return evicted
+
+	def get_stats( self ) -> dict[str, int]:
+		self._collect_writes()
+		return {
+			**self.stats,
+			"entries" : len(self.entries),
+			"memory_bytes" : self.memory_bytes,
+			"spilling_entries" : len(self._writes),
+			"spilled_entries" : len(self.spilled),
+			"disk_bytes" : self.disk_bytes,
+		}
+
+	def close( self ) -> None:
+		'''Wait for the spill writes and close the maps, the store can still be used afterwards.'''
+		if self._executor is not None:
+			self._executor.shutdown(wait=True)
+			self._executor = None
+		self._collect_writes()
+		for spilled in self._maps.values():
+			spilled.close()
+		self._maps.clear()
+
+def benchmark( count : int = 200, image_bytes : int = 2 * 1024 * 1024, memory_budget : int = 64 * 1024 * 1024, directory : str = 'results_benchmark' ) -> None:
+	'''Memory stays at the budget while `count` results are stored, then tile reads from memory and from spilled results.'''
+	from sdapi import SDImage
+
+	tiles_per_image : int = 64
+	tile : str = 'x' * 4096
+	store = ResultStore(memory_budget=memory_budget, directory=directory, disk_budget=count * (image_bytes + tiles_per_image * len(tile)))
+	data : bytes = os.urandom(image_bytes)
+	start = time.perf_counter()
+	for index in range(count):
+		image = SDImage(size=(1024, 1024), data=data)
+		tiles = [{ 'size' : (1024, 1024), 'tile_size' : 128, 'columns' : 8, 'rows' : 8, 'tiles' : { 'palette' : [ tile ] * tiles_per_image } }]
+		store.put(f'{index:032x}', [ image ], tiles)
+	put_time = time.perf_counter() - start
+	store.flush()
+	stats = store.get_stats()
+
+	start = time.perf_counter()
+	for index in range(count - 1, count - 11, -1):
+		for tile_index in range(tiles_per_image):
+			store.get_tile(f'{index:032x}', 0, 'palette', tile_index)
+	memory_tile_time = (time.perf_counter() - start) / (10 * tiles_per_image)
+	start = time.perf_counter()
+	for index in range(10):
+		for tile_index in range(tiles_per_image):
+			store.get_tile(f'{index:032x}', 0, 'palette', tile_index)
+	disk_tile_time = (time.perf_counter() - start) / (10 * tiles_per_image)
+	store.close()
+	shutil.rmtree(directory)
+
+	print(
+		f'{count} results of {image_bytes // 1024}KB: put {put_time / count * 1000:.2f}ms each, '
+		f'{stats["memory_bytes"] // (1024 * 1024)}MB in memory (budget {memory_budget // (1024 * 1024)}MB), '
+		f'{stats["spilled_entries"]} spilled ({stats["disk_bytes"] // (1024 * 1024)}MB), '
+		f'tile read {memory_tile_time * 1e6:.1f}us from memory, {disk_tile_time * 1e6:.1f}us spilled'
+	)
+
+if __name__ == '__main__':
+	benchmark()
@@ -2,20 +2,82 @@
 from __future__ import annotations
 from uuid import uuid4
 from pydantic import BaseModel, Field
-from typing import Union
+from typing import Any, Coroutine, Union
+from collections import OrderedDict
 from enum import Enum
 from PIL import Image
-from threading import Thread
 from io import BytesIO
-from base64 import b64decode
+from base64 import b64decode, b64encode
+from cache import ResultCache, StaleWhileRevalidate
+from compression import ENCODING_LEGACY, ENCODING_PALETTE, IMAGE_ENCODINGS
+from health import BREAKER_HALF_OPEN, CircuitBreaker
+from ratelimit import RateLimited, TokenBucket
+from postprocess import PostProcessor, encode_png_image_tiles
+from results import RESULT_STORE_DIRECTORY, ResultStore, remove_stale_directories
+from store import OperationStore
+from payload import decode_images
+from metrics import OTHER_LABEL, DistributorMetrics
+from timeline import TimelineExporter, TimelineSpan, create_span, describe_timeline
+from backend import MemoryBackend
 
 import json
+import os
+import hashlib
 import datetime
 import asyncio
 import aiohttp
 import time
 
-OPERATION_AUTO_EXPIRY : int = 60 # time before operations are auto-deleted
+OPERATION_AUTO_EXPIRY : int = 60 # time canceled and errored operations are kept after finishing
+RESULT_RETENTION : int = 3600 # completed operations are kept this long unless the result store evicts their results first
+OPERATION_EXPIRY_INTERVAL : float = 3 # how often expired operations are swept
+
+SYSINFO_CACHE_TTL : float = 60 # system info is served from memory and revalidated in the background after this long
+INSTANCE_INFO_CACHE_TTL : float = 30 # same for the checkpoint/embedding/lora/sampler catalogs
+OPTIONS_CACHE_TTL : float = 300 # re-fetch cached instance options after this long in case they were changed elsewhere
+
+FANOUT_CONCURRENCY_LIMIT : int = 16 # max concurrent calls when querying many instances at once
+FANOUT_CALL_TIMEOUT : float = 10 # max time a single instance may take to answer a fanned-out query
+
+AFFINITY_MAX_SKIPS : int = 3 # how many times the head of the queue can be passed over before it must be served
+
+HEALTH_PROBE_INTERVAL : float = 5 # how often instances are health checked
+HEALTH_FAILURE_THRESHOLD : int = 2 # consecutive failed probes before a healthy instance is taken out of rotation
+HEALTH_BACKOFF_BASE : float = 5 # first wait before re-probing an unhealthy instance, doubled after each failed re-probe
+HEALTH_BACKOFF_MAX : float = 300 # longest wait between re-probes of an unhealthy instance
+HEALTH_HISTORY_LENGTH : int = 50 # health transitions kept per instance
+
+RETRY_MAX_ATTEMPTS : int = 3 # times an operation is dispatched before a transient failure errors it
+RETRY_BACKOFF_BASE : float = 1 # wait before requeueing a failed operation, doubled after each attempt
+RETRY_BACKOFF_MAX : float = 30 # longest wait before requeueing a failed operation
+
+HEDGE_DELAY_FACTOR : float = 3 # hedge mode: re-dispatch operations running this many times longer than the average generation
+HEDGE_MIN_DELAY : float = 30 # hedge mode: never re-dispatch operations that have been running for less than this
+HEDGE_CHECK_INTERVAL : float = 1 # hedge mode: how often running operations are checked
+
+USER_RATE_LIMIT_BURST : int = 5 # fair share mode: operations a user can queue in a burst
+USER_RATE_LIMIT_REFILL : float = 0.2 # fair share mode: sustained operations per second a user can queue
+USER_MAX_QUEUED : int = 8 # fair share mode: max operations a user can have waiting in the queue
+USER_MAX_IN_FLIGHT : int = 1 # fair share mode: max operations of a user generating at the same time
+AFFINITY_SCAN_DEPTH : int = 64 # fair share mode: queued operations of the loaded checkpoint checked for a user below their in-flight cap
+
+COALESCE_MAX_BATCH_SIZE : int = 4 # max queued operations merged into one webui batch when coalescing is enabled
+COALESCE_SCAN_DEPTH : int = 64 # how many queued operations of the same checkpoint are checked for compatibility
+
+IMAGE_TILE_SIZE : int = 128 # finished images are pre-encoded into independently compressed tiles of this size
+IMAGE_TILE_ENCODINGS : tuple[str, ...] = (ENCODING_LEGACY, ENCODING_PALETTE) # encoded at completion, others on first request
+
+PROGRESS_POLL_INTERVAL : float = 0.5 # how often a busy instance's progress is polled (shared by every watcher)
+PROGRESS_DEMAND_WINDOW : float = 10 # keep polling this long after the last progress request or waiter
+WAIT_OPERATION_MAX_TIMEOUT : float = 25 # longest a /wait_operation request is held
+WAIT_OPERATION_PROGRESS_STEP : float = 0.05 # progress change that releases a waiter
+
+SHARED_SYNC_INTERVAL : float = 0.5 # shared backend: how often the leader picks up submissions/commands and publishes its status
+
+BULK_STATUS_MAX_OPERATIONS : int = 256 # max operation ids per bulk status request
+GENERATION_TIME_SMOOTHING : float = 0.2 # weight of the newest sample in the average generation time (used for eta)
+
+RESULT_CACHE_MEMORY_BUDGET : int = 256 * 1024 * 1024 # bytes of deterministic (fixed seed) results kept in memory
 
 def load_bs4_image( data : str ) -> Image.Image:
 	return Image.open( BytesIO( b64decode(data) ) ).convert('RGB')
@@ -23,6 +85,19 @@ def load_bs4_image( data : str ) -> Image.Image:
 def timestamp() -> int:
 	return int(round(datetime.datetime.now(datetime.timezone.utc).timestamp()))
 
+async def gather_bounded( coroutines : list[Coroutine], limit : int = None, timeout : float = None, default : Any = None ) -> list:
+	'''Run the coroutines concurrently with at most `limit` in flight, substituting `default` for any that time out or raise.'''
+	limit = limit or FANOUT_CONCURRENCY_LIMIT
+	timeout = timeout or FANOUT_CALL_TIMEOUT
+	semaphore = asyncio.Semaphore(limit)
+	async def run( coroutine : Coroutine ) -> Any:
+		async with semaphore:
+			try:
+				return await asyncio.wait_for(coroutine, timeout)
+			except Exception:
+				return default
+	return await asyncio.gather(*[ run(coroutine) for coroutine in coroutines ])
+
 def pop_indexes( value : dict, indexes : list[str] ) -> None:
 	for index in indexes:
 		if index in value:
@@ -52,9 +127,54 @@ class APIEndpoints:
 
 	unload_active_checkpoint = '/sdapi/v1/unload-checkpoint'
 
+# per-endpoint request timeouts (seconds), anything not listed uses DEFAULT_REQUEST_TIMEOUT
+DEFAULT_REQUEST_TIMEOUT : float = 30
+ENDPOINT_TIMEOUTS : dict[str, float] = {
+	APIEndpoints.ping : 5,
+	APIEndpoints.queue_status : 5,
+	APIEndpoints.progress.split('?')[0] : 5,
+	APIEndpoints.skip : 5,
+	APIEndpoints.interrupt : 5,
+	APIEndpoints.memory : 10,
+	APIEndpoints.sysinfo : 30,
+	APIEndpoints.options : 120, # posting a new checkpoint blocks until the model is loaded
+	APIEndpoints.txt2img : 600,
+	APIEndpoints.refresh_checkpoints : 60,
+	APIEndpoints.refresh_vae : 60,
+	APIEndpoints.refresh_loras : 60,
+	APIEndpoints.refresh_embeddings : 60,
+	APIEndpoints.unload_active_checkpoint : 60,
+}
+
 class APIErrors:
 	INSTANCE_NOT_AVAILABLE = "Stable Diffusion Instance is not available - failed to connect."
+	INSTANCE_TIMED_OUT = "Stable Diffusion Instance did not respond in time."
 	JSON_DECODE_FAIL = "Failed to JSON decode response from Stable Diffusion Instance."
+	INFO_NOT_CACHED = "Stable Diffusion Instance information has not been fetched yet."
+
+class FailureKind:
+	CONNECTION = 'connection' # refused, reset or dropped connection
+	TIMEOUT = 'timeout' # no response in time
+	SERVER_ERROR = 'server_error' # 5xx response
+	BAD_REQUEST = 'bad_request' # 4xx response, e.g. invalid parameters
+	INVALID_RESPONSE = 'invalid_response' # the response could not be used
+	REMOVED = 'removed' # the instance was removed from the pool mid-generation
+	UNKNOWN = 'unknown'
+
+TRANSIENT_FAILURES : tuple[str, ...] = (FailureKind.CONNECTION, FailureKind.TIMEOUT, FailureKind.SERVER_ERROR, FailureKind.REMOVED) # worth retrying elsewhere
+INSTANCE_FAILURES : tuple[str, ...] = (FailureKind.CONNECTION, FailureKind.TIMEOUT) # count against the instance's health
+
+class InstanceError(str):
+	'''An error message that also records what kind of failure caused it.'''
+	kind : str
+
+	def __new__( cls, message : str, kind : str ) -> InstanceError:
+		error = super().__new__(cls, message)
+		error.kind = kind
+		return error
+
+def failure_kind( error : Any ) -> str:
+	return getattr(error, 'kind', FailureKind.UNKNOWN)
 
 class SDTxt2ImgParams(BaseModel):
 	checkpoint : str = Field(None)
@@ -70,80 +190,165 @@ class SDTxt2ImgParams(BaseModel):
 	height : int = Field(512)
 	seed : int = Field(-1)
 
-	# batch_size : int = Field(1)
-	# n_iter : int = Field(1)
+	batch_size : int = Field(1)
+	n_iter : int = Field(1)
+
+	def coalesce_key( self ) -> Union[tuple, None]:
+		'''Parameters that must match for generations to share a webui batch, None if this cannot be batched.'''
+		if self.batch_size != 1 or self.n_iter != 1:
+			return None
+		return (self.checkpoint, self.prompt, self.negative, self.steps, self.cfg_scale, self.sampler_name, self.width, self.height, self.seed == -1)
+
+	def result_key( self ) -> Union[str, None]:
+		'''Content hash of the parameters (checkpoint included), None if the result is not deterministic.'''
+		if self.seed == -1:
+			return None
+		return hashlib.sha256( json.dumps(self.model_dump(), sort_keys=True).encode('utf-8') ).hexdigest()
 
 class StableDiffusionInstance:
 	uuid : str
 	endpoint : str
-	busy : bool
+	running : int
+	loaded_checkpoint : Union[str, None]
+
+	progress : Union[dict, None]
+	progress_demand_until : float
 
-	next_info_timestamp : int
-	instance_info : dict
-	next_sysinfo_timestamp : int
-	sysinfo : dict
+	options_cache : Union[dict, None]
+	options_cache_expiry : float
+
+	sysinfo_cache : StaleWhileRevalidate
+	info_cache : StaleWhileRevalidate
+	rescan_pending : bool
 
 	headers : dict
 	cookies : dict
 
+	weight : int
+	max_concurrency : int
+	tags : list[str]
+	draining : bool
+
+	connection_limit : int
+	keepalive_timeout : float
+	session : Union[aiohttp.ClientSession, None]
+	metrics : Union[DistributorMetrics, None]
+
 	def __init__(
 		self,
 		endpoint : str,
 		headers : dict = None,
 		cookies : dict = None,
+		weight : int = 1,
+		max_concurrency : int = 1,
+		tags : list[str] = None,
+		connection_limit : int = 8,
+		keepalive_timeout : float = 60,
 	) -> None:
 		self.uuid = uuid4().hex
 		self.endpoint = endpoint
-		self.busy = False
+		self.running = 0
+		self.loaded_checkpoint = None
+
+		self.progress = None
+		self.progress_demand_until = -1
 
-		self.next_info_timestamp = -1
-		self.instance_info = None
-		self.next_sysinfo_timestamp = -1
-		self.sysinfo = None
+		self.options_cache = None
+		self.options_cache_expiry = -1
+
+		self.sysinfo_cache = StaleWhileRevalidate(self.fetch_system_info, SYSINFO_CACHE_TTL)
+		self.info_cache = StaleWhileRevalidate(self.fetch_instance_info, INSTANCE_INFO_CACHE_TTL)
+		self.rescan_pending = False
 
 		self.headers = headers
 		self.cookies = cookies
 
+		self.weight = weight # preferred over lower weight instances when several are idle
+		self.max_concurrency = max(1, max_concurrency) # operations sent to the instance at the same time
+		self.tags = tags if tags is not None else []
+		self.draining = False
+
+		self.connection_limit = connection_limit
+		self.keepalive_timeout = keepalive_timeout
+		self.session = None
+		self.metrics = None # set by the distributor the instance is added to
+
+	@property
+	def busy( self ) -> bool:
+		return self.running > 0
+
+	async def open_session( self ) -> aiohttp.ClientSession:
+		'''Open the persistent keep-alive connection pool for this instance (no-op if already open).'''
+		if self.session is None or self.session.closed is True:
+			connector = aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=self.keepalive_timeout)
+			self.session = aiohttp.ClientSession(headers=self.headers, cookies=self.cookies, connector=connector)
+		return self.session
+
+	async def close_session( self ) -> None:
+		'''Close the connection pool for this instance.'''
+		await self.sysinfo_cache.close()
+		await self.info_cache.close()
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+
+	async def internal_request(self, method : str, path : str, raw : bool = False, **kwargs) -> tuple[bool, Union[str, bytes]]:
+		start : float = time.perf_counter()
+		success, response = await self._internal_request(method, path, raw, **kwargs)
+		if self.metrics is not None:
+			endpoint : str = path.split('?')[0]
+			self.metrics.webui_request_time.observe(time.perf_counter() - start, self.endpoint, endpoint)
+			if success is False:
+				self.metrics.webui_request_failures.inc(self.endpoint, endpoint, failure_kind(response))
+		return success, response
+
+	async def _internal_request(self, method : str, path : str, raw : bool, **kwargs) -> tuple[bool, Union[str, bytes]]:
+		client = await self.open_session()
+		timeout = aiohttp.ClientTimeout(total=ENDPOINT_TIMEOUTS.get(path.split('?')[0], DEFAULT_REQUEST_TIMEOUT))
+		try:
+			# the response must be read inside the context so the connection is released back to the pool
+			async with client.request(method, f'{self.endpoint}{path}', timeout=timeout, **kwargs) as response:
+				if response.status != 200:
+					kind : str = FailureKind.SERVER_ERROR if response.status >= 500 else FailureKind.BAD_REQUEST
+					return False, InstanceError("Stable Diffusion Instance has errored: " + (response.reason or "No reason was given."), kind)
+				# raw keeps the body as the received bytes, without decoding multi-MB payloads into a str
+				return True, (await response.read() if raw is True else await response.text())
+		except asyncio.TimeoutError:
+			return False, InstanceError(APIErrors.INSTANCE_TIMED_OUT, FailureKind.TIMEOUT)
+		except Exception:
+			return False, InstanceError(APIErrors.INSTANCE_NOT_AVAILABLE, FailureKind.CONNECTION)
+
 	async def internal_get(self, path : str) -> tuple[bool, str]:
-		async with aiohttp.ClientSession(headers=self.headers, cookies=self.cookies) as client:
-			try:
-				response = await client.get(f'{self.endpoint}{path}')
-			except:
-				return False, APIErrors.INSTANCE_NOT_AVAILABLE
-			if response.status != 200:
-				return False, "Stable Diffusion Instance has errored: " + (response.reason or "No reason was given.")
-			return True, await response.text()
+		return await self.internal_request('GET', path)
 
-	async def internal_post(self, path : str, data : str = None, json : dict = None) -> tuple[bool, str]:
-		async with aiohttp.ClientSession(headers=self.headers, cookies=self.cookies) as client:
-			try:
-				response = await client.post(f'{self.endpoint}{path}', data=data, json=json)
-			except:
-				return False, APIErrors.INSTANCE_NOT_AVAILABLE
-			if response.status != 200:
-				return False, "Stable Diffusion Instance has errored: " + (response.reason or "No reason was given.")
-			return True, await response.text()
+	async def internal_post(self, path : str, data : str = None, json : dict = None, raw : bool = False) -> tuple[bool, Union[str, bytes]]:
+		return await self.internal_request('POST', path, raw=raw, data=data, json=json)
 
 	async def is_available( self ) -> bool:
 		'''Check if the stable diffusion instance is online.'''
 		success, _ = await self.internal_get( APIEndpoints.ping )
 		return success is True
 
-	async def get_system_info( self ) -> tuple[bool, Union[str, dict]]:
-		'''Get the system information for the instance.'''
-		timestamp = time.time()
-		if timestamp < self.next_info_timestamp:
-			return True, self.sysinfo
+	async def get_system_info( self, wait : bool = False ) -> tuple[bool, Union[str, dict]]:
+		'''Get the cached system information for the instance (only waits for it when `wait` is set and nothing is cached).'''
+		sysinfo : Union[dict, None] = await self.sysinfo_cache.get_async() if wait is True else self.sysinfo_cache.get()
+		if sysinfo is None:
+			return False, APIErrors.INFO_NOT_CACHED
+		return True, sysinfo
 
-		_, _ = await self.refresh_info()
+	async def fetch_system_info( self ) -> Union[dict, None]:
+		'''Fetch the system information for the instance.'''
 		success, sys_info_raw = await self.internal_get(
 			APIEndpoints.sysinfo
 		)
 
 		if success is False:
-			return False, sys_info_raw
+			return None
 
-		sys_info : dict = json.loads(sys_info_raw)
+		try:
+			sys_info : dict = json.loads(sys_info_raw)
+		except:
+			return None
 
 		torch_info = sys_info.get('Torch env info')
 		if isinstance(torch_info, dict) is True:
@@ -157,8 +362,7 @@ class StableDiffusionInstance:
 		else:
 			CPUINFO = "unknown"
 
-		self.next_sysinfo_timestamp = timestamp + 10 # 60 second interval
-		self.sysinfo = {
+		return {
 			"OS" : type(torch_info) == dict and torch_info.get('os') or 'Unknown',
 			"RAM" : sys_info.get('RAM'),
 			"CPU" : CPUINFO,
@@ -169,35 +373,46 @@ class StableDiffusionInstance:
 			# "Extensions" : [ext.get('name') for ext in sys_info.get('Extensions')],
 		}
 
-		return True, self.sysinfo
-
 	async def get_options( self ) -> tuple[bool, Union[str, dict]]:
+		'''Fetch the stable diffusion options and refresh the options cache.'''
 		success, response = await self.internal_get(APIEndpoints.options)
 		if success is False:
+			self.invalidate_options()
 			return False, APIErrors.INSTANCE_NOT_AVAILABLE
 
 		try:
 			data = json.loads(response)
 		except:
+			self.invalidate_options()
 			return False, APIErrors.JSON_DECODE_FAIL
 
+		self.options_cache = data
+		self.options_cache_expiry = time.time() + OPTIONS_CACHE_TTL
+		self.observe_checkpoint(data.get('sd_model_checkpoint'))
 		return True, data
 
+	def invalidate_options( self ) -> None:
+		'''Drop the cached options so the next update re-fetches them.'''
+		self.options_cache = None
+		self.options_cache_expiry = -1
+
 	async def update_options( self, options : dict ) -> tuple[bool, Union[str, dict]]:
-		'''Update the stable diffusion options:'''
-		success, data = await self.get_options()
-		if success is False:
-			return False, data
+		'''Update the stable diffusion options, only sending the keys that differ from the cached options.'''
+		if self.options_cache is None or time.time() > self.options_cache_expiry:
+			success, data = await self.get_options()
+			if success is False:
+				return False, data
 
-		try:
-			data.update( options )
-		except Exception as exception:
-			return False, f'Failed to update stable diffusion instance options due to exception:\n{exception}'
+		changed : dict = { key : value for key, value in options.items() if self.options_cache.get(key) != value }
+		if len(changed) == 0:
+			return True, 'Stable diffusion instance options are already up to date.'
 
-		success, response = await self.internal_post(APIEndpoints.options, json=data)
+		success, response = await self.internal_post(APIEndpoints.options, json=changed)
 		if success is False:
+			self.invalidate_options() # unknown what was applied
 			return False, f'Failed to update stable diffusion instance options due to error: {response}'
 
+		self.options_cache.update(changed)
 		return True, 'Stable diffusion instance options were updated.'
 
 	async def refresh_info( self ) -> tuple[bool, list]:
@@ -208,11 +423,11 @@ class StableDiffusionInstance:
 		- VAEs
 		- Embeddings
 		'''
-		# TODO: asyncio.gather?
+		paths = [ APIEndpoints.refresh_checkpoints, APIEndpoints.refresh_vae, APIEndpoints.refresh_loras, APIEndpoints.refresh_embeddings ]
+		responses = await asyncio.gather(*[ self.internal_post( path ) for path in paths ])
 		hasNotErrored : bool = True
 		errorList : list[Union[str, None]] = []
-		for path in [ APIEndpoints.refresh_checkpoints, APIEndpoints.refresh_vae, APIEndpoints.refresh_loras, APIEndpoints.refresh_embeddings ]:
-			success, response = await self.internal_post( path )
+		for success, response in responses:
 			if success is False:
 				hasNotErrored = False
 				errorList.append(response)
@@ -220,22 +435,54 @@ class StableDiffusionInstance:
 				errorList.append(None)
 		return hasNotErrored, errorList
 
-	async def get_instance_info( self ) -> Union[dict, None]:
+	async def get_instance_info( self, wait : bool = False ) -> Union[dict, None]:
+		'''Get the cached stable diffusion information (only waits for it when `wait` is set and nothing is cached).'''
+		return await self.info_cache.get_async() if wait is True else self.info_cache.get()
+
+	def invalidate_info( self, rescan : bool = False ) -> None:
+		'''Mark the cached information as stale, optionally rescanning the model folders on the next fetch.'''
+		self.rescan_pending = self.rescan_pending or rescan
+		self.info_cache.invalidate()
+		self.info_cache.revalidate()
+
+	def has_checkpoint( self, checkpoint : str ) -> Union[bool, None]:
+		'''Check the cached catalog for the checkpoint, None if the catalog is not cached yet.'''
+		info : Union[dict, None] = self.info_cache.value
+		if info is None or info.get('checkpoints') is None:
+			return None
+		return any( checkpoint in (chpt['title'], chpt['model_name']) for chpt in info['checkpoints'] )
+
+	def checkpoint_label( self, checkpoint : str ) -> str:
+		'''The checkpoint as a metrics label, checkpoints the catalog does not know are all `other` so clients cannot add series.'''
+		return checkpoint if self.has_checkpoint(checkpoint) is True else OTHER_LABEL
+
+	async def resolve_checkpoint_label( self, checkpoint : str ) -> str:
+		'''checkpoint_label, first waiting for the catalog when it has not been fetched yet (right after startup).'''
+		if self.has_checkpoint(checkpoint) is None:
+			_ = await self.get_instance_info(wait=True)
+		return self.checkpoint_label(checkpoint)
+
+	def observe_checkpoint( self, checkpoint : Union[str, None] ) -> None:
+		'''Record the loaded checkpoint, invalidating the catalog when it changes to one it does not know about.'''
+		if checkpoint is not None and checkpoint != self.loaded_checkpoint and self.has_checkpoint(checkpoint) is False:
+			self.invalidate_info(rescan=True)
+		self.loaded_checkpoint = checkpoint
+
+	async def fetch_instance_info( self ) -> Union[dict, None]:
 		'''
-		Get all the stable diffusion information, which includes:
+		Fetch all the stable diffusion information, which includes:
 		- Checkpoints
 		- LORAs (loras, embeddings)
 		- Samplers
 		'''
-
-		timestamp = time.time()
-		if timestamp < self.next_info_timestamp:
-			return self.instance_info
-
 		available : bool = await self.is_available()
 		if available is False:
 			return None
 
+		if self.rescan_pending is True:
+			self.rescan_pending = False
+			_, _ = await self.refresh_info()
+
 		base_info : dict[str, list] = {
 			"checkpoints" : None,
 			"embeddings" : None,
@@ -252,10 +499,14 @@ class StableDiffusionInstance:
 			except:
 				return None
 
-		# TODO: asyncio.gather?
+		checkpoints, embeddings, loras, samplers = await asyncio.gather(
+			parse_endpoint( APIEndpoints.get_checkpoints ),
+			parse_endpoint( APIEndpoints.get_embeddings ),
+			parse_endpoint( APIEndpoints.get_loras ),
+			parse_endpoint( APIEndpoints.get_samplers ),
+		)
 
 		# checkpoints
-		checkpoints : list[dict] = await parse_endpoint( APIEndpoints.get_checkpoints )
 		if checkpoints is not None:
 			base_info["checkpoints"] = [ {
 				'title' : chpt['title'],
@@ -263,23 +514,17 @@ class StableDiffusionInstance:
 			} for chpt in checkpoints ]
 
 		# embeddings
-		embeddings : dict = await parse_endpoint( APIEndpoints.get_embeddings )
 		if embeddings is not None:
 			base_info['embeddings'] = list( embeddings['loaded'].keys() )
 
 		# loras
-		loras : list[dict] = await parse_endpoint( APIEndpoints.get_loras )
 		if loras is not None:
 			base_info['loras'] = [ data['name'] for data in loras ]
 
 		# samplers
-		samplers : list[dict] = await parse_endpoint( APIEndpoints.get_samplers )
 		if samplers is not None:
 			base_info['samplers'] = [ data['name'] for data in samplers ]
 
-		self.next_info_timestamp = timestamp + 10
-		self.instance_info = base_info
-
 		return base_info
 
 	async def skip_operation( self ) -> bool:
@@ -305,6 +550,8 @@ class StableDiffusionInstance:
 	async def unload_active_checkpoint( self ) -> bool:
 		'''Unload the active checkpoint in memory.'''
 		success, _ = await self.internal_post( APIEndpoints.unload_active_checkpoint )
+		self.invalidate_options()
+		self.loaded_checkpoint = None
 		return success is True
 
 	async def get_progress( self ) -> tuple[bool, Union[str, dict]]:
@@ -335,30 +582,52 @@ class StableDiffusionInstance:
 		except:
 			return False, APIErrors.JSON_DECODE_FAIL
 
-	async def text2image( self, parameters : SDTxt2ImgParams ) -> tuple[bool, Union[str, dict]]:
-		'''Query a text2image generation with given parameters.'''
+	async def text2image( self, parameters : SDTxt2ImgParams, spans : Union[list[TimelineSpan], None] = None ) -> tuple[bool, Union[str, dict]]:
+		'''
+		Query a text2image generation with given parameters, the response images are decoded png bytes.
+		The checkpoint switch and the txt2img request are appended to `spans` when given.
+		'''
+		self.running += 1
+		try:
+			return await self._text2image(parameters, spans)
+		finally:
+			self.running -= 1
+
+	async def _text2image( self, parameters : SDTxt2ImgParams, spans : Union[list[TimelineSpan], None] = None ) -> tuple[bool, Union[str, dict]]:
 		params : dict = parameters.model_dump()
 		checkpoint : str = params.pop('checkpoint')
 
+		switching : bool = checkpoint != self.loaded_checkpoint
+		start : float = time.time()
 		success, response = await self.update_options({
 			'sd_model_checkpoint': checkpoint
 		})
+		duration : float = time.time() - start
+		if switching is True and self.metrics is not None:
+			label : str = self.checkpoint_label(checkpoint)
+			self.metrics.checkpoint_switches.inc(self.endpoint, label)
+			self.metrics.checkpoint_switch_time.observe(duration, self.endpoint, label)
+		if spans is not None:
+			spans.append(create_span('checkpoint_switch' if switching is True else 'options', start, duration, self.endpoint))
 
 		if success is False:
-			return False, f'Failed to load checkpoint {checkpoint} due to:\n{response}'
+			self.loaded_checkpoint = None
+			return False, InstanceError(f'Failed to load checkpoint {checkpoint} due to:\n{response}', failure_kind(response))
+		self.observe_checkpoint(checkpoint)
 
-		self.busy = True
-		print(params)
-		success, response = await self.internal_post(APIEndpoints.txt2img, json=params)
-		self.busy = False
+		start = time.time()
+		success, response = await self.internal_post(APIEndpoints.txt2img, json=params, raw=True)
+		if spans is not None:
+			spans.append(create_span('txt2img', start, time.time() - start, self.endpoint))
 
 		if success is False:
-			return False, f'Failed to queue txt2img request due to an error:\n{response}'
+			self.invalidate_options() # the instance may have restarted with different options
+			return False, InstanceError(f'Failed to queue txt2img request due to an error:\n{response}', failure_kind(response))
 
 		try:
-			return True, json.loads(response) # returns the images
+			return True, { 'images' : decode_images(response) }
 		except:
-			return False, APIErrors.JSON_DECODE_FAIL
+			return False, InstanceError(APIErrors.JSON_DECODE_FAIL, FailureKind.INVALID_RESPONSE)
 
 class OperationStatus(Enum):
 	IN_QUEUE = 0
@@ -367,10 +636,20 @@ class OperationStatus(Enum):
 	CANCELED = 3
 	ERRORED = 4
 
+FINAL_OPERATION_STATES : tuple[int, ...] = (OperationStatus.COMPLETED.value, OperationStatus.CANCELED.value, OperationStatus.ERRORED.value)
+
+TIMELINE_STATE_EVENTS : dict[OperationStatus, str] = {
+	OperationStatus.IN_QUEUE : 'requeued', # operations only go back to the queue after a failure
+	OperationStatus.IN_PROGRESS : 'dispatched',
+	OperationStatus.COMPLETED : 'completed',
+	OperationStatus.CANCELED : 'canceled',
+	OperationStatus.ERRORED : 'errored',
+}
+
 class SDImage(BaseModel):
 	'''A Generated Stable Diffusion Image.'''
 	size : tuple[int, int] = Field(None)
-	data : str = Field(None)
+	data : bytes = Field(None) # png, decoded from the webui's base64 once
 
 class Operation(BaseModel):
 	# base
@@ -380,37 +659,340 @@ class Operation(BaseModel):
 	error : str = Field(None)
 	# txt2img
 	params : SDTxt2ImgParams = Field(None)
-	results : list[SDImage] = Field(None)
 	sdinstance : str = Field(None)
+	# scheduling
+	user_id : Union[int, None] = Field(None)
+	affinity_skips : int = Field(0)
+	# retries
+	attempts : int = Field(0)
+	retry_at : Union[float, None] = Field(None)
+	last_error : Union[str, None] = Field(None) # failure of the latest retried attempt, `error` is only set when the operation errors
+	failed_instances : list[str] = Field(default_factory=list)
+	hedged : bool = Field(False)
+	# tracing
+	timeline : list[TimelineSpan] = Field(default_factory=list)
+	first_fetch_at : Union[float, None] = Field(None) # first client fetch of the results
+	last_fetch_at : Union[float, None] = Field(None) # latest client fetch, added to the timeline when the operation leaves
+
+	def mark( self, name : str, instance : Union[str, None] = None ) -> None:
+		'''Add an event to the timeline.'''
+		self.timeline.append(create_span(name, instance=instance))
+
+	def mark_fetch( self ) -> bool:
+		'''Record a client fetch of the results, returns True for the first one which is added to the timeline right away.'''
+		now : float = time.time()
+		self.last_fetch_at = now
+		if self.first_fetch_at is not None:
+			return False
+		self.first_fetch_at = now
+		self.timeline.append(create_span('first_fetch', now))
+		return True
+
+	def mark_last_fetch( self ) -> bool:
+		'''Add the latest fetch to the timeline, returns False if there was no fetch after the first or it was already added.'''
+		if self.last_fetch_at is None or self.last_fetch_at == self.first_fetch_at or self.timeline[-1].name == 'last_fetch':
+			return False
+		self.timeline.append(create_span('last_fetch', self.last_fetch_at))
+		return True
 
 class StableDiffusionDistributor:
 	instances : list[StableDiffusionInstance]
-	operations : dict[str, Operation]
-	queue : list[str]
+	store : OperationStore
+	operations : dict[str, Operation] # alias of store.operations
+	results : ResultStore
+	queue : OrderedDict[str, None] # alias of store.queue
+
+	coalesce : bool
+	hedge : bool
+	fair_share : bool
+	user_buckets : dict[Any, TokenBucket]
+	user_in_flight : dict[Any, int]
+	average_generation_time : Union[float, None]
+	result_cache : Union[ResultCache, None]
+	postprocessor : PostProcessor
+	scheduler_stats : dict[str, int]
+	health : dict[str, CircuitBreaker]
+	health_probe_interval : float
+
+	backend : MemoryBackend
+	owner_id : str
+	is_leader : bool
+	metrics : DistributorMetrics
+	timeline_exporter : Union[TimelineExporter, None]
 
 	_active : bool
-	_thread : Thread
+	_workers : dict[str, asyncio.Task] # keyed by worker id, one worker per instance concurrency slot
+	_idle_workers : dict[str, tuple[StableDiffusionInstance, asyncio.Event]]
+	_recovery_events : dict[str, asyncio.Event]
+	_health_task : Union[asyncio.Task, None]
+	_running : dict[str, tuple[StableDiffusionInstance, float, int]]
+	_hedged : dict[str, StableDiffusionInstance]
+	_hedge_task : Union[asyncio.Task, None]
+	_progress_pollers : dict[str, asyncio.Task]
+	_changed : asyncio.Event
+	_expiry_task : Union[asyncio.Task, None]
+	_sync_task : Union[asyncio.Task, None]
+	_metrics_task : Union[asyncio.Task, None]
+	_shared_status : dict
+	_background_tasks : set[asyncio.Task]
 
-	def __init__( self, instances : Union[list[StableDiffusionInstance], None] ) -> None:
-		self.instances = instances if instances is not None else None
-		self.operations = dict()
-		self.queue = list()
+	def __init__(
+		self,
+		instances : Union[list[StableDiffusionInstance], None],
+		coalesce : bool = False,
+		hedge : bool = False,
+		fair_share : bool = False,
+		health_probe_interval : float = HEALTH_PROBE_INTERVAL,
+		result_cache : Union[ResultCache, None] = None,
+		postprocessor : Union[PostProcessor, None] = None,
+		backend : Union[MemoryBackend, None] = None,
+		result_store : Union[ResultStore, None] = None,
+		timeline_exporter : Union[TimelineExporter, None] = None,
+		user_weights : Union[dict[int, int], None] = None,
+	) -> None:
+		self.instances = instances if instances is not None else []
+		self.metrics = DistributorMetrics()
+		self.timeline_exporter = timeline_exporter
+		self.store = OperationStore()
+		if user_weights is not None:
+			self.store.user_weights.update(user_weights)
+		for instance in self.instances:
+			instance.metrics = self.metrics
+			self.store.add_instance(instance)
+		self.operations = self.store.operations
+		self.queue = self.store.queue
+		self.coalesce = coalesce
+		self.hedge = hedge
+		self.fair_share = fair_share
+		self.user_buckets = dict()
+		self.user_in_flight = dict()
+		self.average_generation_time = None
+		self.result_cache = result_cache if result_cache is not None else ResultCache(RESULT_CACHE_MEMORY_BUDGET)
+		self.postprocessor = postprocessor if postprocessor is not None else PostProcessor()
+		self.scheduler_stats = {
+			"dispatched" : 0,
+			"affinity_hits" : 0, # dispatched to an instance that already had the checkpoint loaded
+			"checkpoint_swaps" : 0, # dispatched to an instance that had to load a different checkpoint
+			"swaps_avoided" : 0, # the head of the queue was passed over for a checkpoint match
+			"starvation_overrides" : 0, # the head of the queue was served regardless of affinity
+			"coalesced" : 0, # operations merged into another operation's webui batch
+			"rate_limited" : 0, # operations rejected by a user's rate limit or queue cap
+			"retried" : 0, # operations requeued after a transient failure
+			"hedged" : 0, # slow operations re-dispatched to a second instance
+			"hedge_wins" : 0, # hedged operations where the second instance finished first
+		}
+		self.health = dict()
+		self.health_probe_interval = health_probe_interval
+		self.backend = backend if backend is not None else MemoryBackend()
+		if result_store is None and self.backend.shared is True:
+			remove_stale_directories(RESULT_STORE_DIRECTORY)
+		if result_store is None:
+			# processes sharing a backend each spill to their own directory
+			result_store = ResultStore(directory=os.path.join(RESULT_STORE_DIRECTORY, str(os.getpid())) if self.backend.shared is True else RESULT_STORE_DIRECTORY)
+		self.results = result_store
+		self.owner_id = uuid4().hex
+		self.is_leader = self.backend.shared is False # without a shared backend this is the only process
 		self._active = False
-		self._thread = None
+		self._workers = dict()
+		self._idle_workers = dict()
+		self._recovery_events = dict()
+		self._health_task = None
+		self._running = dict()
+		self._hedged = dict()
+		self._hedge_task = None
+		self._progress_pollers = dict()
+		self._changed = asyncio.Event()
+		self._expiry_task = None
+		self._sync_task = None
+		self._metrics_task = None
+		self._shared_status = dict()
+		self._background_tasks = set()
+		self.metrics.gauge('sdhook_queue_length', 'Operations waiting to be dispatched.', function=lambda : { () : self.get_queue_length() })
+		self.metrics.gauge('sdhook_operations_in_flight', 'Operations being generated, by instance.', ('instance',), function=self._in_flight_by_instance)
+		self.metrics.counter('sdhook_results_evicted_total', 'Completed results deleted to stay within the result store budgets.', function=lambda : { () : self.results.stats["evictions"] })
+
+	def _in_flight_by_instance( self ) -> dict[tuple[str, ...], float]:
+		in_flight : dict[tuple[str, ...], float] = { (instance.endpoint,) : 0 for instance in self.instances }
+		for instance, _, _ in list(self._running.values()):
+			in_flight[(instance.endpoint,)] = in_flight.get((instance.endpoint,), 0) + 1
+		return in_flight
+
+	def get_instance_health( self, instance : StableDiffusionInstance ) -> CircuitBreaker:
+		if instance.uuid not in self.health:
+			# unknown until the first probe decides
+			self.health[instance.uuid] = CircuitBreaker(HEALTH_FAILURE_THRESHOLD, HEALTH_BACKOFF_BASE, HEALTH_BACKOFF_MAX, history_length=HEALTH_HISTORY_LENGTH, state=BREAKER_HALF_OPEN)
+		return self.health[instance.uuid]
+
+	def is_instance_healthy( self, instance : StableDiffusionInstance ) -> bool:
+		return self.get_instance_health(instance).is_closed()
+
+	def _on_instance_unhealthy( self, instance : StableDiffusionInstance ) -> None:
+		if self.get_instance_health(instance).consecutive_opens == 1:
+			print(f"Stable Diffusion Instance is unavailable: {instance.endpoint}")
+		for worker_id in self._worker_ids(instance):
+			idle = self._idle_workers.pop(worker_id, None)
+			if idle is not None:
+				idle[1].set() # the worker sees the instance is unhealthy and waits for it to recover
+
+	def _on_instance_recovered( self, instance : StableDiffusionInstance ) -> None:
+		print(f"Stable Diffusion Instance is available: {instance.endpoint}")
+		instance.invalidate_options() # it may have been restarted with other settings
+		for worker_id in self._worker_ids(instance):
+			event = self._recovery_events.pop(worker_id, None)
+			if event is not None:
+				event.set()
+
+	async def probe_instances( self ) -> None:
+		'''Health check every instance that is due a probe and update its circuit breaker.'''
+		due : list[StableDiffusionInstance] = [ instance for instance in self.instances if self.get_instance_health(instance).should_probe() is True ]
+		results : list[tuple[bool, str]] = await gather_bounded(
+			[ instance.internal_get(APIEndpoints.ping) for instance in due ],
+			default=(False, APIErrors.INSTANCE_TIMED_OUT)
+		)
+		for instance, (success, response) in zip(due, results):
+			breaker = self.get_instance_health(instance)
+			if success is True:
+				if breaker.record_success() is True:
+					self._on_instance_recovered(instance)
+			elif breaker.record_failure(response) is True:
+				self._on_instance_unhealthy(instance)
+
+	async def _health_loop( self ) -> None:
+		while self._active is True:
+			await self.probe_instances()
+			await asyncio.sleep(self.health_probe_interval)
 
 	async def find_unavailable_instances( self ) -> list[StableDiffusionInstance]:
-		unavailable : list[StableDiffusionInstance] = []
-		for instance in self.instances:
-			available = await instance.is_available()
-			if available is False:
-				print(f"Stable Diffusion Instance is unavailable: {instance.endpoint}")
-				unavailable.append( instance )
-				self.instances.remove( instance )
-		return unavailable
+		'''Probe the instances now and return the ones that are out of rotation (they are re-admitted once they recover).'''
+		await self.probe_instances()
+		return [ instance for instance in self.instances if self.is_instance_healthy(instance) is False ]
+
+	def get_instances_health( self ) -> list[dict]:
+		if self.is_leader is False:
+			return self._get_shared_status().get("health", [])
+		return [
+			{ "uuid" : instance.uuid, "endpoint" : instance.endpoint, **self.get_instance_health(instance).get_status() }
+			for instance in self.instances
+		]
+
+	def get_instance( self, instance_id : str ) -> Union[StableDiffusionInstance, None]:
+		return self.store.get_instance(instance_id)
+
+	async def add_instance( self, instance : StableDiffusionInstance ) -> None:
+		'''Add an instance to the pool, it starts taking operations once its first health probe succeeds.'''
+		self.instances.append(instance)
+		instance.metrics = self.metrics
+		self.store.add_instance(instance)
+		if self._active is True:
+			await instance.open_session()
+			self._start_worker(instance)
+			self._spawn( self.probe_instances() )
+			instance.sysinfo_cache.revalidate()
+			instance.info_cache.revalidate()
+
+	def drain_instance( self, instance : StableDiffusionInstance ) -> asyncio.Task:
+		'''
+		Stop giving the instance new operations and remove it once its in-flight operations have finished.
+		Returns the task that completes when it has been removed.
+		'''
+		instance.draining = True
+		for worker_id in self._worker_ids(instance):
+			idle = self._idle_workers.pop(worker_id, None)
+			if idle is not None:
+				idle[1].set()
+			event = self._recovery_events.pop(worker_id, None)
+			if event is not None:
+				event.set()
+		workers = [ self._workers[worker_id] for worker_id in self._worker_ids(instance) if worker_id in self._workers ]
+		return self._spawn( self._finish_drain(instance, workers) )
+
+	async def _finish_drain( self, instance : StableDiffusionInstance, workers : list[asyncio.Task] ) -> None:
+		await asyncio.gather(*workers, return_exceptions=True)
+		await self.remove_instance(instance)
+
+	async def remove_instance( self, instance : StableDiffusionInstance ) -> None:
+		'''Remove the instance immediately, operations it was generating are requeued.'''
+		instance.draining = True
+		if instance in self.instances:
+			self.instances.remove(instance)
+		self.store.remove_instance(instance)
+		running_ids : list[str] = [ uuid for uuid, entry in self._running.items() if entry[0] is instance ]
+		await self._stop_worker(instance)
+		for uuid in running_ids:
+			self._running.pop(uuid, None)
+		# operations that left the store meanwhile (expired, canceled and evicted) are skipped
+		running : list[Operation] = [ self.store.get(uuid) for uuid in running_ids ]
+		running = [ operation for operation in running if operation is not None and operation.state == OperationStatus.IN_PROGRESS.value and operation.sdinstance == instance.uuid ]
+		if len(running) > 0:
+			self._handle_failure(instance, running, InstanceError('Stable Diffusion Instance was removed.', FailureKind.REMOVED))
+		self.health.pop(instance.uuid, None)
+		await instance.close_session()
+
+	def _instance_config( self, instance : StableDiffusionInstance ) -> dict:
+		return {
+			"endpoint" : instance.endpoint,
+			"headers" : instance.headers,
+			"cookies" : instance.cookies,
+			"weight" : instance.weight,
+			"max_concurrency" : instance.max_concurrency,
+			"tags" : instance.tags,
+		}
+
+	async def request_add_instance( self, instance : StableDiffusionInstance ) -> str:
+		'''Add the instance, or ask the leader to when this process is a follower. Returns the instance id.'''
+		if self.is_leader is False:
+			await self.backend.call(self.backend.push_command, "add_instance", { "uuid" : instance.uuid, "config" : self._instance_config(instance) })
+		else:
+			await self.add_instance(instance)
+		return instance.uuid
+
+	async def request_drain_instance( self, instance_id : str ) -> bool:
+		'''Drain the instance, or ask the leader to. False if the instance does not exist.'''
+		if self.is_leader is False:
+			if instance_id not in [ item["uuid"] for item in self.list_instances() ]:
+				return False
+			await self.backend.call(self.backend.push_command, "drain_instance", { "instance_id" : instance_id })
+			return True
+		instance : Union[StableDiffusionInstance, None] = self.get_instance(instance_id)
+		if instance is None:
+			return False
+		self.drain_instance(instance)
+		return True
+
+	async def request_remove_instance( self, instance_id : str ) -> bool:
+		'''Remove the instance, or ask the leader to. False if the instance does not exist.'''
+		if self.is_leader is False:
+			if instance_id not in [ item["uuid"] for item in self.list_instances() ]:
+				return False
+			await self.backend.call(self.backend.push_command, "remove_instance", { "instance_id" : instance_id })
+			return True
+		instance : Union[StableDiffusionInstance, None] = self.get_instance(instance_id)
+		if instance is None:
+			return False
+		await self.remove_instance(instance)
+		return True
+
+	def list_instances( self ) -> list[dict]:
+		if self.is_leader is False:
+			return self._get_shared_status().get("instances", [])
+		return [
+			{
+				"uuid" : instance.uuid,
+				"endpoint" : instance.endpoint,
+				"weight" : instance.weight,
+				"max_concurrency" : instance.max_concurrency,
+				"tags" : instance.tags,
+				"draining" : instance.draining,
+				"running" : instance.running,
+				"health" : self.get_instance_health(instance).state,
+			}
+			for instance in self.instances
+		]
 
 	async def get_instances_infos( self ) -> list[dict]:
-		for instance in self.instances:
-			_, _ = await instance.refresh_info()
+		'''Answer from the instance caches, stale entries are revalidated in the background.'''
+		if self.is_leader is False:
+			return self._get_shared_status().get("infos", [])
 		infos : list[dict] = []
 		for instance in self.instances:
 			_, sysinfo = await instance.get_system_info()
@@ -418,45 +1000,383 @@ class StableDiffusionDistributor:
 			infos.append({ "sys_info" : sysinfo, "sd_info" : instinfo })
 		return infos
 
-	async def _internal_txt2img(self, instance : StableDiffusionInstance, operation : Operation) -> None:
-		instance.busy = True
-		operation.state = OperationStatus.IN_PROGRESS.value
-		operation.sdinstance = instance.uuid
+	def revalidate_instances_infos( self ) -> None:
+		'''Refresh every instance's cached information in the background.'''
+		for instance in self.instances:
+			instance.sysinfo_cache.revalidate()
+			instance.info_cache.revalidate()
+
+	async def _internal_txt2img(self, instance : StableDiffusionInstance, operations : list[Operation]) -> None:
+		'''Run the operations as a single webui batch and split the returned images back onto each operation.'''
+		start = time.time()
+		for operation in operations:
+			operation.attempts += 1
+			operation.sdinstance = instance.uuid
+			self._running[operation.uuid] = (instance, start, len(operations))
+			self._set_operation_state(operation, OperationStatus.IN_PROGRESS)
+
+		params = operations[0].params
+		if len(operations) > 1:
+			params = params.model_copy(update={'batch_size' : len(operations)})
+		spans : list[TimelineSpan] = []
+		try:
+			success, response = await instance.text2image(params, spans)
+		except Exception as exception:
+			success, response = False, f'Failed to run txt2img due to exception:\n{exception}'
+		for operation in operations:
+			operation.timeline.extend(spans)
+		if success is True:
+			duration : float = time.time() - start
+			self._record_generation_time(duration)
+			self.metrics.generation_time.observe(duration, instance.endpoint, instance.checkpoint_label(params.checkpoint))
+
+		if success is True and len(operations) > 1 and len(response['images']) < len(operations):
+			success, response = False, InstanceError(f'Expected {len(operations)} batched images but only received {len(response["images"])}.', FailureKind.INVALID_RESPONSE)
 
-		params = operation.params
-		success, response = await instance.text2image(params)
+		for operation in operations:
+			self._running.pop(operation.uuid, None)
+		# skip operations that were canceled, or that a hedged copy on another instance is still running or already finished
+		operations = [ operation for operation in operations if self._claim_result(operation, instance, success) is True ]
 
-		instance.busy = False
 		if success is False:
-			operation.error = response
-			operation.state = OperationStatus.ERRORED.value
+			self._handle_failure(instance, operations, response)
+			return
+
+		size = (params.width, params.height)
+		if len(operations) == 1:
+			batches = [ response['images'] ]
 		else:
-			size = (params.width, params.height)
-			results = [ SDImage(data=image_bs4, size=size) for image_bs4 in response['images'] ]
-			operation.results = results
-			operation.state = OperationStatus.COMPLETED.value
-
-	async def queue_txt2img( self, parameters : SDTxt2ImgParams ) -> Union[str, None]:
-		operation = Operation(params=parameters)
-		self.operations[operation.uuid] = operation
-		self.queue.append(operation.uuid)
+			# a grid image may be prepended to batches, the individual images are always last
+			batches = [ [image] for image in response['images'][-len(operations):] ]
+		del response
+		for operation, images in zip(operations, batches):
+			results = [ SDImage(data=image, size=size) for image in images ]
+			self._spawn( self._complete_operation(operation, results) )
+
+	def _claim_result( self, operation : Operation, instance : StableDiffusionInstance, success : bool ) -> bool:
+		'''Decide if this instance's result (or failure) is used for the operation, interrupting the losing hedge copy.'''
+		if operation.state != OperationStatus.IN_PROGRESS.value or operation.sdinstance != instance.uuid:
+			return False
+		hedge_instance : Union[StableDiffusionInstance, None] = self._hedged.get(operation.uuid)
+		if hedge_instance is None:
+			return True
+		if hedge_instance is instance:
+			self._hedged.pop(operation.uuid)
+			if success is False:
+				# the original dispatch still decides unless it has already finished
+				original = self._running.get(operation.uuid)
+				if original is None:
+					return True
+				operation.sdinstance = original[0].uuid
+				return False
+			if operation.uuid in self._running:
+				self._spawn( self._interrupt_if_alone(self._running[operation.uuid][0]) )
+			self.scheduler_stats["hedge_wins"] += 1
+			return True
+		if success is False:
+			return False # leave it to the hedge copy
+		self._hedged.pop(operation.uuid)
+		self._spawn( self._interrupt_if_alone(hedge_instance) )
+		return True
+
+	async def _interrupt_if_alone( self, instance : StableDiffusionInstance, skip : bool = False ) -> None:
+		'''
+		Interrupt the instance's generation, only when it is the instance's one request in flight since the webui
+		interrupts everything it is running. Otherwise the discarded operation is left to finish and its result is dropped.
+		'''
+		if instance.running != 1:
+			return
+		if skip is True:
+			_ = await instance.skip_operation()
+		_ = await instance.interrupt_operation()
+
+	def _handle_failure( self, instance : StableDiffusionInstance, operations : list[Operation], error : str ) -> None:
+		'''Requeue the operations after a transient failure (up to RETRY_MAX_ATTEMPTS), otherwise error them.'''
+		kind : str = failure_kind(error)
+		self.metrics.operations_failed.inc(instance.endpoint, kind, amount=len(operations))
+		if kind in INSTANCE_FAILURES and self.get_instance_health(instance).record_failure(error) is True:
+			self._on_instance_unhealthy(instance)
+		for operation in operations:
+			operation.last_error = error
+			if kind not in TRANSIENT_FAILURES or operation.attempts >= RETRY_MAX_ATTEMPTS:
+				operation.error = error
+				self._set_operation_state(operation, OperationStatus.ERRORED)
+				continue
+			backoff : float = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (operation.attempts - 1))
+			operation.retry_at = time.time() + backoff
+			operation.failed_instances.append(instance.uuid)
+			operation.sdinstance = None
+			self.scheduler_stats["retried"] += 1
+			self._set_operation_state(operation, OperationStatus.IN_QUEUE)
+			self._spawn( self._requeue_after(operation, backoff) )
+
+	async def _requeue_after( self, operation : Operation, delay : float ) -> None:
+		'''Put a failed operation back at the front of the queue once its backoff has passed.'''
+		await asyncio.sleep(delay)
+		if operation.uuid not in self.operations or operation.state != OperationStatus.IN_QUEUE.value:
+			return # canceled or expired while backing off
+		operation.retry_at = None
+		self.store.enqueue(operation, front=True)
+		self._wake_worker(operation)
+
+	async def _hedge_loop( self ) -> None:
+		while self._active is True:
+			self._hedge_slow_operations()
+			await asyncio.sleep(HEDGE_CHECK_INTERVAL)
+
+	def _hedge_slow_operations( self ) -> None:
+		'''Re-dispatch operations running far longer than expected to an idle instance, the first result wins.'''
+		if self.average_generation_time is None:
+			return
+		threshold : float = max(HEDGE_MIN_DELAY, HEDGE_DELAY_FACTOR * self.average_generation_time)
+		now = time.time()
+		for uuid, (instance, start, batch_size) in list(self._running.items()):
+			if len(self._idle_workers) == 0:
+				return
+			operation : Union[Operation, None] = self.store.get(uuid)
+			if operation is None or operation.hedged is True or batch_size > 1 or now - start < threshold:
+				continue # batches are never hedged as interrupting the loser would interrupt the whole batch
+			def preference( worker_id : str ) -> tuple[bool, bool, int]:
+				idle_instance = self._idle_workers[worker_id][0]
+				return ( idle_instance is not instance, idle_instance.loaded_checkpoint == operation.params.checkpoint, idle_instance.weight )
+			hedge_worker_id : str = max(self._idle_workers, key=preference)
+			hedge_instance, event = self._idle_workers[hedge_worker_id]
+			if hedge_instance is instance:
+				continue
+			del self._idle_workers[hedge_worker_id]
+			operation.hedged = True
+			operation.mark('hedged', hedge_instance.endpoint)
+			self._hedged[uuid] = hedge_instance
+			self.scheduler_stats["hedged"] += 1
+			self._spawn( self._run_hedge(hedge_instance, operation, event) )
+
+	async def _run_hedge( self, instance : StableDiffusionInstance, operation : Operation, event : asyncio.Event ) -> None:
+		'''Run a copy of the operation on an idle instance, its worker is woken again once it finishes.'''
+		try:
+			start : float = time.time()
+			spans : list[TimelineSpan] = []
+			try:
+				success, response = await instance.text2image(operation.params, spans)
+			except Exception as exception:
+				success, response = False, f'Failed to run txt2img due to exception:\n{exception}'
+			operation.timeline.extend(spans)
+			if self._hedged.get(operation.uuid) is not instance or operation.state != OperationStatus.IN_PROGRESS.value:
+				return # the original dispatch finished first or the operation was canceled
+			operation.sdinstance = instance.uuid
+			if self._claim_result(operation, instance, success) is False:
+				return
+			if success is False:
+				self._handle_failure(instance, [ operation ], response)
+				return
+			self.metrics.generation_time.observe(time.time() - start, instance.endpoint, instance.checkpoint_label(operation.params.checkpoint))
+			results = [ SDImage(data=image, size=(operation.params.width, operation.params.height)) for image in response['images'] ]
+			self._spawn( self._complete_operation(operation, results) )
+		finally:
+			event.set()
+
+	def _record_generation_time( self, duration : float ) -> None:
+		if self.average_generation_time is None:
+			self.average_generation_time = duration
+		else:
+			self.average_generation_time += GENERATION_TIME_SMOOTHING * (duration - self.average_generation_time)
+
+	def _notify_changed( self ) -> None:
+		'''Wake everything waiting on an operation state or progress change.'''
+		changed, self._changed = self._changed, asyncio.Event()
+		changed.set()
+
+	def _set_operation_state( self, operation : Operation, state : OperationStatus ) -> None:
+		operation.state = state.value
+		if state in (OperationStatus.IN_PROGRESS, OperationStatus.COMPLETED):
+			operation.error = None # a dispatched or completed operation has not errored, earlier failures stay in last_error
+		instance : Union[StableDiffusionInstance, None] = self.store.get_instance(operation.sdinstance)
+		operation.mark(TIMELINE_STATE_EVENTS[state], instance.endpoint if instance is not None else None)
+		if state.value in FINAL_OPERATION_STATES and operation.uuid in self.operations:
+			# only finished operations expire, queued and running ones are kept however long they take
+			self.store.set_expiry(operation.uuid, self._final_deadline(operation))
+		self._save_operation(operation)
+		self._notify_changed()
+
+	def _final_deadline( self, operation : Operation ) -> int:
+		'''Completed operations are kept for RESULT_RETENTION, canceled and errored ones for OPERATION_AUTO_EXPIRY.'''
+		return timestamp() + (RESULT_RETENTION if operation.state == OperationStatus.COMPLETED.value else OPERATION_AUTO_EXPIRY)
+
+	def _dump_operation( self, operation : Operation ) -> str:
+		# unset (None) fields are left out so loading falls back to the field defaults
+		return operation.model_dump_json(exclude_none=True)
+
+	def _save_operation( self, operation : Operation ) -> None:
+		if self.backend.persistent is True:
+			self.backend.post(self.backend.save_operation, operation.uuid, operation.timestamp, operation.state, self._dump_operation(operation))
+
+	def _results_value( self, images : list[SDImage], tiles : list[dict] ) -> dict:
+		'''Json-friendly results for the backend and the result cache, the only place images are base64 encoded again.'''
+		return { 'images' : [ { 'size' : image.size, 'data' : b64encode(image.data).decode('ascii') } for image in images ], 'tiles' : tiles }
+
+	def _store_results( self, operation : Operation, value : dict ) -> None:
+		'''Keep results read back from the backend or the result cache.'''
+		images = [ SDImage(size=image['size'], data=b64decode(image['data'])) for image in value['images'] ]
+		self.results.put(operation.uuid, images, value['tiles'])
+		self.store.set_expiry(operation.uuid, operation.timestamp + RESULT_RETENTION)
+
+	def _save_results( self, operation : Operation, images : list[SDImage], tiles : list[dict] ) -> None:
+		if self.backend.persistent is True:
+			self.backend.post(self.backend.save_results, operation.uuid, operation.timestamp, json.dumps(self._results_value(images, tiles)))
+
+	async def _load_operation( self, operation_id : str ) -> Union[Operation, None]:
+		'''
+		Read the operation from the backend, finished operations are kept locally until they expire.
+		The leader holds every unfinished operation, so one missing from its store is stale unless a follower just submitted it.
+		'''
+		data : Union[dict, None] = await self.backend.call(self.backend.load_operation, operation_id)
+		if data is None:
+			return None
+		operation = Operation(**data)
+		if self.is_leader is True and operation.state not in FINAL_OPERATION_STATES and await self.backend.call(self.backend.is_submitted, operation_id) is False:
+			return None
+		if operation.state in FINAL_OPERATION_STATES:
+			self.store.add(operation, timestamp() + OPERATION_AUTO_EXPIRY)
+		if operation.state == OperationStatus.COMPLETED.value:
+			await self._load_results(operation)
+		return operation
+
+	async def _load_results( self, operation : Operation ) -> bool:
+		'''Read the results back from a persistent backend, e.g. after the result store evicted them.'''
+		if self.backend.persistent is False:
+			return False
+		value : Union[dict, None] = await self.backend.call(self.backend.load_results, operation.uuid)
+		if value is None:
+			return False
+		self._store_results(operation, value)
+		return True
+
+	async def get_operation( self, operation_id : str ) -> Union[Operation, None]:
+		'''
+		The operation from memory, or for followers from the shared backend unless it has already finished.
+		The leader also looks up unknown operations in a persistent backend, they finished before a restart or takeover.
+		'''
+		operation : Union[Operation, None] = self.store.get(operation_id)
+		if operation is not None and (self.is_leader is True or operation.state in FINAL_OPERATION_STATES):
+			return operation
+		if self.backend.persistent is False:
+			return operation
+		return await self._load_operation(operation_id)
+
+	def _spawn( self, coroutine : Coroutine ) -> asyncio.Task:
+		'''Run a background task, keeping a reference so it is not garbage collected mid-run.'''
+		task = asyncio.create_task(coroutine)
+		self._background_tasks.add(task)
+		task.add_done_callback(self._background_tasks.discard)
+		return task
+
+	async def _encode_tiles( self, images : list[SDImage], encodings : tuple[str, ...] ) -> list[dict]:
+		'''Encode the tiles of each image in the post-processing pool, see compression.encode_image_tiles.'''
+		return await asyncio.gather(*[
+			self.postprocessor.run('encode_tiles', encode_png_image_tiles, image.data, IMAGE_TILE_SIZE, encodings)
+			for image in images
+		])
+
+	async def _complete_operation( self, operation : Operation, results : list[SDImage] ) -> None:
+		'''Pre-encode the image tiles (off the event loop) and then mark the operation as completed.'''
+		start : float = time.time()
+		try:
+			tiles : list[dict] = await self._encode_tiles(results, IMAGE_TILE_ENCODINGS)
+		except Exception as exception:
+			operation.timeline.append(create_span('postprocess', start, time.time() - start))
+			operation.error = f'Failed to encode the generated images due to exception:\n{exception}'
+			self._set_operation_state(operation, OperationStatus.ERRORED)
+			return
+		if operation.uuid not in self.operations or operation.state != OperationStatus.IN_PROGRESS.value:
+			return # canceled or expired while encoding
+		operation.timeline.append(create_span('postprocess', start, time.time() - start))
+		self.results.put(operation.uuid, results, tiles)
+		self._save_results(operation, results, tiles)
+		instance : Union[StableDiffusionInstance, None] = self.get_instance(operation.sdinstance)
+		self.metrics.operations_completed.inc(instance.endpoint if instance is not None else OTHER_LABEL)
+		self._set_operation_state(operation, OperationStatus.COMPLETED)
+		self._cache_results(operation, results, tiles)
+
+	def _cache_results( self, operation : Operation, images : list[SDImage], tiles : list[dict] ) -> None:
+		key : Union[str, None] = operation.params.result_key()
+		if key is None:
+			return
+		nbytes : int = sum( len(image.data) for image in images ) * 4 // 3 + sum( len(tile) for image in tiles for encoded in image['tiles'].values() for tile in encoded )
+		self.result_cache.put(key, self._results_value(images, tiles), nbytes)
+
+	def _check_user_limits( self, user_id : Any ) -> None:
+		'''Raise RateLimited if the user already has too many operations queued or has used up their token bucket.'''
+		if user_id is None:
+			return
+		if self.store.user_queue_length(user_id) >= USER_MAX_QUEUED:
+			self.scheduler_stats["rate_limited"] += 1
+			retry_after : float = self.average_generation_time if self.average_generation_time is not None else 1 / USER_RATE_LIMIT_REFILL
+			raise RateLimited(f'User {user_id} already has {USER_MAX_QUEUED} operations queued.', retry_after)
+		if user_id not in self.user_buckets:
+			self.user_buckets[user_id] = TokenBucket(USER_RATE_LIMIT_BURST, USER_RATE_LIMIT_REFILL)
+		retry_after : float = self.user_buckets[user_id].try_consume()
+		if retry_after > 0:
+			self.scheduler_stats["rate_limited"] += 1
+			raise RateLimited(f'User {user_id} is queueing operations too quickly.', retry_after)
+
+	def _is_user_blocked( self, user_id : Any ) -> bool:
+		'''The user has reached their in-flight cap and cannot be dispatched to right now.'''
+		return user_id is not None and self.user_in_flight.get(user_id, 0) >= USER_MAX_IN_FLIGHT
+
+	def _blocked_users( self ) -> set:
+		return { user_id for user_id in self.user_in_flight if self._is_user_blocked(user_id) }
+
+	def _acquire_user( self, operation : Operation ) -> None:
+		self.user_in_flight[operation.user_id] = self.user_in_flight.get(operation.user_id, 0) + 1
+
+	def _release_users( self, operations : list[Operation] ) -> None:
+		for operation in operations:
+			count : int = self.user_in_flight.get(operation.user_id, 0) - 1
+			if count > 0:
+				self.user_in_flight[operation.user_id] = count
+			else:
+				self.user_in_flight.pop(operation.user_id, None)
+		# operations of these users may have been held back by the in-flight cap while other workers went idle
+		head : Union[Operation, None] = self.store.peek()
+		if self.fair_share is True and head is not None:
+			self._wake_worker(head)
+
+	async def queue_txt2img( self, parameters : SDTxt2ImgParams, user_id : Union[int, None] = None ) -> Union[str, None]:
+		'''
+		Queue the txt2img operation and return its id.
+		In fair share mode raises RateLimited when the user is over their limits.
+		'''
+		operation = Operation(params=parameters, user_id=user_id)
+		operation.mark('queued')
+		key : Union[str, None] = parameters.result_key()
+		cached : Union[dict, None] = self.result_cache.get(key) if key is not None else None
+		if cached is not None:
+			# deterministic generation that has already been made, complete instantly
+			self.store.add(operation)
+			self._store_results(operation, cached)
+			if self.backend.persistent is True:
+				self.backend.post(self.backend.save_results, operation.uuid, operation.timestamp, json.dumps(cached))
+			self._set_operation_state(operation, OperationStatus.COMPLETED)
+			return operation.uuid
+		if self.fair_share is True:
+			self._check_user_limits(user_id)
+		if self.is_leader is False:
+			# picked up by the leader on its next sync
+			await self.backend.call(self.backend.submit_operation, operation.uuid, operation.timestamp, operation.state, self._dump_operation(operation))
+			return operation.uuid
+		self.store.add(operation)
+		self._save_operation(operation)
+		self.store.enqueue(operation)
+		self._wake_worker(operation)
 		return operation.uuid
 
 	async def get_operation_sdinstance( self, operation_id : str ) -> Union[StableDiffusionInstance, None]:
-		operation : Union[Operation, None] = self.operations.get(operation_id)
+		operation : Union[Operation, None] = self.store.get(operation_id)
 		if operation is None:
 			return None
-		uuid : Union[str, None] = operation.sdinstance
-		if uuid is None:
-			return None
-		for instance in self.instances:
-			if instance.uuid == uuid:
-				return instance
-		return None
+		return self.store.get_instance(operation.sdinstance)
 
 	async def get_operation_status( self, operation_id : str ) -> Union[int, None]:
-		operation : Union[Operation, None] = self.operations.get(operation_id, None)
-		print(operation_id, self.operations.keys())
+		operation : Union[Operation, None] = await self.get_operation(operation_id)
 		if operation is None:
 			return None
 		return operation.state
@@ -470,88 +1390,515 @@ class StableDiffusionDistributor:
 			status == OperationStatus.COMPLETED.value
 
 	async def get_operation_progress( self, operation_id : str ) -> Union[dict, str, None]:
-		instance : Union[StableDiffusionInstance, None] = await self.get_operation_sdinstance(operation_id)
+		'''Latest progress from the instance's shared poller, None unless the operation is running.'''
+		operation : Union[Operation, None] = await self.get_operation(operation_id)
+		if operation is None:
+			return None
+		return self._operation_progress(operation)
+
+	def _operation_progress( self, operation : Operation ) -> Union[dict, None]:
+		if operation.state != OperationStatus.IN_PROGRESS.value:
+			return None
+		if self.is_leader is False:
+			return self._get_shared_status().get("progress", {}).get(operation.sdinstance)
+		instance = self.store.get_instance(operation.sdinstance)
 		if instance is None:
 			return None
-		success, response = await instance.get_progress()
-		if success is True:
-			return response
-		return None
+		instance.progress_demand_until = time.time() + PROGRESS_DEMAND_WINDOW
+		return instance.progress
+
+	def _operation_snapshot( self, operation : Operation ) -> dict:
+		return { "state" : operation.state, "error" : operation.error, "progress" : self._operation_progress(operation), "attempts" : operation.attempts }
+
+	async def get_operations_status( self, operation_ids : list[str] ) -> dict[str, Union[dict, None]]:
+		'''
+		State, error, progress, queue position (0 = next) and eta in seconds for many operations at once.
+		Unknown (or expired) operations map to None.
+		'''
+		operation_ids = operation_ids[:BULK_STATUS_MAX_OPERATIONS]
+		if self.is_leader is True:
+			positions : dict[str, int] = self.store.positions() if len(operation_ids) > 0 else {}
+			capacity : int = self._get_capacity()
+			average_generation_time : Union[float, None] = self.average_generation_time
+		else:
+			shared_status : dict = self._get_shared_status()
+			positions : dict[str, int] = shared_status.get("positions", {})
+			capacity : int = shared_status.get("capacity", 1)
+			average_generation_time : Union[float, None] = shared_status.get("average_generation_time")
+		statuses : dict[str, Union[dict, None]] = {}
+		for operation_id in operation_ids:
+			operation : Union[Operation, None] = await self.get_operation(operation_id)
+			if operation is None:
+				statuses[operation_id] = None
+				continue
+			status : dict = self._operation_snapshot(operation)
+			status["queue_position"] = positions.get(operation_id)
+			status["eta"] = None
+			if status["progress"] is not None and status["progress"].get("eta") is not None:
+				status["eta"] = status["progress"]["eta"]
+			elif average_generation_time is not None and status["queue_position"] is not None:
+				# every instance takes a job from the queue per average generation
+				status["eta"] = round((status["queue_position"] // capacity + 1) * average_generation_time, 3)
+			statuses[operation_id] = status
+		return statuses
+
+	async def wait_operation( self, operation_id : str, last_state : Union[int, None] = None, last_progress : Union[float, None] = None, timeout : float = WAIT_OPERATION_MAX_TIMEOUT ) -> Union[dict, None]:
+		'''
+		Hold until the operation's state differs from `last_state`, its progress moves by at least
+		WAIT_OPERATION_PROGRESS_STEP from `last_progress`, or the timeout passes, then return its snapshot.
+		'''
+		loop = asyncio.get_running_loop()
+		deadline : float = loop.time() + max(0, min(timeout, WAIT_OPERATION_MAX_TIMEOUT))
+		while True:
+			operation : Union[Operation, None] = await self.get_operation(operation_id)
+			if operation is None:
+				return None
+			snapshot : dict = self._operation_snapshot(operation)
+			if snapshot["state"] != last_state:
+				return snapshot
+			progress : Union[float, None] = (snapshot["progress"] or {}).get("progress")
+			if progress is not None and (last_progress is None or abs(progress - last_progress) >= WAIT_OPERATION_PROGRESS_STEP):
+				return snapshot
+			remaining : float = deadline - loop.time()
+			if remaining <= 0:
+				return snapshot
+			if self.is_leader is False:
+				# changes happen in the leader process, check again after its next sync
+				await asyncio.sleep(min(remaining, SHARED_SYNC_INTERVAL))
+				continue
+			try:
+				await asyncio.wait_for(self._changed.wait(), remaining)
+			except asyncio.TimeoutError:
+				pass
+
+	async def _has_results( self, operation_id : str ) -> bool:
+		'''Make sure the results of a completed operation are in the result store, loading them from the backend if needed.'''
+		if self.results.has(operation_id) is True:
+			return True
+		operation : Union[Operation, None] = await self.get_operation(operation_id) # followers load finished operations with their results
+		if operation is None or operation.state != OperationStatus.COMPLETED.value:
+			return False
+		return self.results.has(operation_id) is True or await self._load_results(operation) is True
+
+	async def get_operation_images( self, operation_id : str ) -> Union[list[SDImage], None]:
+		if await self._has_results(operation_id) is False:
+			return None
+		return self.results.get(operation_id).images
+
+	def _mark_fetch( self, operation_id : str ) -> None:
+		# only the leader saves operations, fetches served by the other processes are not recorded
+		operation : Union[Operation, None] = self.store.get(operation_id)
+		if operation is not None and self.is_leader is True and operation.mark_fetch() is True:
+			self._save_operation(operation)
+
+	def _timeline_record( self, operation : Operation ) -> dict:
+		return {
+			"uuid" : operation.uuid,
+			"state" : operation.state,
+			"user_id" : operation.user_id,
+			"checkpoint" : operation.params.checkpoint if operation.params is not None else None,
+			"attempts" : operation.attempts,
+			"hedged" : operation.hedged,
+			"timeline" : describe_timeline(operation.timeline),
+		}
+
+	async def get_operation_timeline( self, operation_id : str ) -> Union[dict, None]:
+		'''Every step of the operation (queued, dispatched, checkpoint switch, txt2img, post-processing, fetches) with its offset from queueing.'''
+		operation : Union[Operation, None] = await self.get_operation(operation_id)
+		if operation is None:
+			return None
+		return self._timeline_record(operation)
+
+	def _export_timeline( self, operation : Union[Operation, None] ) -> None:
+		'''Close the timeline of an operation leaving the distributor (adding its last fetch) and export it.'''
+		if operation is None:
+			return
+		if operation.mark_last_fetch() is True:
+			self._save_operation(operation)
+		if self.timeline_exporter is not None:
+			self.timeline_exporter.export(self._timeline_record(operation))
+
+	async def get_operation_image( self, operation_id : str, image_index : int ) -> Union[bytes, None]:
+		'''The png bytes of a single image of a completed operation, served as is without re-encoding.'''
+		if await self._has_results(operation_id) is False:
+			return None
+		self._mark_fetch(operation_id)
+		return self.results.get_image(operation_id, image_index)
+
+	async def get_operation_tiles( self, operation_id : str ) -> Union[list[dict], None]:
+		'''Tile layout (size, tile size, columns and rows) of each image of a completed operation.'''
+		if await self._has_results(operation_id) is False:
+			return None
+		self._mark_fetch(operation_id)
+		return self.results.get_layout(operation_id)
 
-	async def get_operation_images( self, operation_id : str ) -> Union[list[Image.Image], None]:
-		if operation_id in self.operations.keys():
-			return self.operations[operation_id].results
-		return None
+	async def get_operation_tile( self, operation_id : str, image_index : int, tile_x : int, tile_y : int, encoding : str = ENCODING_LEGACY ) -> Union[str, None]:
+		'''
+		A single pre-encoded tile, None if the operation, image, tile or encoding does not exist.
+		Encodings that were not pre-encoded at completion are encoded for the whole image on first request.
+		'''
+		tiles : Union[list[dict], None] = await self.get_operation_tiles(operation_id)
+		if tiles is None or image_index < 0 or image_index >= len(tiles) or encoding not in IMAGE_ENCODINGS:
+			return None
+		image_tiles : dict = tiles[image_index]
+		if tile_x < 0 or tile_x >= image_tiles['columns'] or tile_y < 0 or tile_y >= image_tiles['rows']:
+			return None
+		index : int = tile_y * image_tiles['columns'] + tile_x
+		tile : Union[str, None] = self.results.get_tile(operation_id, image_index, encoding, index)
+		if tile is None:
+			images : Union[list[SDImage], None] = await self.get_operation_images(operation_id)
+			if images is None:
+				return None
+			encoded : list[dict] = await self._encode_tiles([ images[image_index] ], (encoding,))
+			self.results.add_encoding(operation_id, image_index, encoding, encoded[0]['tiles'][encoding])
+			tile = encoded[0]['tiles'][encoding][index]
+		return tile
 
 	async def cancel_operation( self, operation_id : str ) -> None:
-		if operation_id in self.queue:
-			self.queue.remove(operation_id)
-		operation : Operation = self.operations.get(operation_id)
+		if self.is_leader is False:
+			await self.backend.call(self.backend.push_command, "cancel", { "operation_id" : operation_id })
+			return
+		operation : Operation = self.store.get(operation_id)
 		if operation is None:
 			return
+		if self.store.dequeue(operation_id) is True or operation.state == OperationStatus.IN_QUEUE.value:
+			# queued, or waiting out a retry backoff
+			self._set_operation_state(operation, OperationStatus.CANCELED)
+			return
 		instance = await self.get_operation_sdinstance( operation_id )
-		if instance is None:
+		if instance is None or operation.state != OperationStatus.IN_PROGRESS.value:
 			return
-		operation.state = OperationStatus.CANCELED.value
 		operation.sdinstance = None
-		_ = await instance.skip_operation()
-		_ = await instance.interrupt_operation()
-		instance.busy = False
-
-	async def update_queue(self) -> None:
-		# find free instances
-		free_instances = [ instance for instance in self.instances if instance.busy is False ]
-		if len(free_instances) == 0:
-			return # no free instances, skip
-
-		# remove any missing queued operation mappings
-		index = 0
-		while index < len(self.queue):
-			operation_id : str = self.queue[index]
-			operation = self.operations.get(operation_id)
-			if operation is None:
-				self.queue.pop(index)
+		self._set_operation_state(operation, OperationStatus.CANCELED)
+		running = self._running.get(operation_id)
+		if running is not None and running[2] > 1:
+			# interrupting would stop the whole batch, the canceled operation's image is discarded when it returns
+			return
+		hedge_instance : Union[StableDiffusionInstance, None] = self._hedged.pop(operation_id, None)
+		if hedge_instance is not None:
+			await self._interrupt_if_alone(hedge_instance)
+		await self._interrupt_if_alone(instance, skip=True)
+
+	def _next_operation( self, instance : StableDiffusionInstance ) -> Union[Operation, None]:
+		'''
+		Pop the next operation for the instance to run.
+		Operations for the checkpoint the instance already has loaded are preferred, but the head of
+		the queue is only passed over AFFINITY_MAX_SKIPS times so other checkpoints are not starved.
+		In fair share mode the head is the next operation of the user whose turn it is in the weighted
+		round-robin, and users at their in-flight cap are skipped.
+		'''
+		blocked : Union[set, None] = self._blocked_users() if self.fair_share is True else None
+		head : Union[Operation, None] = self.store.peek_fair(blocked) if self.fair_share is True else self.store.peek()
+		if head is None:
+			return None
+
+		operation : Operation = head
+		if head.params.checkpoint != instance.loaded_checkpoint and instance.loaded_checkpoint is not None:
+			if head.affinity_skips < AFFINITY_MAX_SKIPS:
+				match : Union[Operation, None] = self.store.first_for_checkpoint(instance.loaded_checkpoint, blocked, AFFINITY_SCAN_DEPTH)
+				if match is not None:
+					operation = match
+					head.affinity_skips += 1
+					self.scheduler_stats["swaps_avoided"] += 1
 			else:
-				index += 1
-
-		# run batch of coroutines to generate images
-		coros = []
-		quantity = min(len(free_instances), len(self.queue))
-		while quantity > 0:
-			quantity -= 1
-			instance = free_instances.pop(0)
-			operation_id = self.queue.pop(0)
-			operation = self.operations[operation_id]
-			coros.append(self._internal_txt2img( instance, operation ))
-		await asyncio.gather(*coros)
+				self.scheduler_stats["starvation_overrides"] += 1
+
+		if self.fair_share is True:
+			self.store.charge_user(operation.user_id)
+		self._record_queue_wait(instance, operation)
+		self.store.dequeue(operation.uuid)
+		self._acquire_user(operation)
+		self.scheduler_stats["dispatched"] += 1
+		if operation.params.checkpoint == instance.loaded_checkpoint:
+			self.scheduler_stats["affinity_hits"] += 1
+		else:
+			self.scheduler_stats["checkpoint_swaps"] += 1
+		return operation
 
-	async def check_for_expired_operations(self) -> None:
-		now = timestamp()
-		for uuid in list(self.operations.keys()):
-			operation = self.operations.get(uuid)
+	def _coalesce_operations( self, instance : StableDiffusionInstance, operation : Operation ) -> list[Operation]:
+		'''
+		Pull queued operations that can share a webui batch with the given operation.
+		Random seed operations can always be merged, fixed seeds only when they continue the
+		batch's seed sequence since the webui uses seed + index for each batch item.
+		'''
+		batch : list[Operation] = [ operation ]
+		key = operation.params.coalesce_key()
+		if self.coalesce is False or key is None:
+			return batch
+		for index, candidate in enumerate(self.store.iter_checkpoint_queue(operation.params.checkpoint)):
+			if index >= COALESCE_SCAN_DEPTH or len(batch) >= COALESCE_MAX_BATCH_SIZE:
+				break
+			if self.fair_share is True and self._is_user_blocked(candidate.user_id):
+				continue
+			if candidate.params.coalesce_key() == key and (operation.params.seed == -1 or candidate.params.seed == operation.params.seed + len(batch)):
+				self._record_queue_wait(instance, candidate)
+				self.store.dequeue(candidate.uuid)
+				self._acquire_user(candidate)
+				batch.append(candidate)
+				self.scheduler_stats["coalesced"] += 1
+		return batch
+
+	def _record_queue_wait( self, instance : StableDiffusionInstance, operation : Operation ) -> None:
+		queued_at : Union[float, None] = self.store.queued_at(operation.uuid)
+		if queued_at is None:
+			return
+		if instance.has_checkpoint(operation.params.checkpoint) is None:
+			# cold start, label the wait once the instance's catalog is known rather than as `other`
+			self._spawn(self._observe_queue_wait(instance, operation.params.checkpoint, time.time() - queued_at))
+			return
+		self.metrics.queue_wait.observe(time.time() - queued_at, instance.endpoint, instance.checkpoint_label(operation.params.checkpoint))
+
+	async def _observe_queue_wait( self, instance : StableDiffusionInstance, checkpoint : str, duration : float ) -> None:
+		self.metrics.queue_wait.observe(duration, instance.endpoint, await instance.resolve_checkpoint_label(checkpoint))
+
+	def _wake_worker( self, operation : Operation ) -> None:
+		'''
+		Wake a single idle instance worker so it picks up the queued operation, preferring one
+		the operation has not already failed on, then one with its checkpoint loaded, then the highest weight.
+		'''
+		if len(self._idle_workers) == 0:
+			return
+		def preference( worker_id : str ) -> tuple[bool, bool, int]:
+			instance = self._idle_workers[worker_id][0]
+			return ( instance.uuid not in operation.failed_instances, instance.loaded_checkpoint == operation.params.checkpoint, instance.weight )
+		_, event = self._idle_workers.pop( max(self._idle_workers, key=preference) )
+		event.set()
+
+	def _worker_ids( self, instance : StableDiffusionInstance ) -> list[str]:
+		return [ f'{instance.uuid}:{slot}' for slot in range(instance.max_concurrency) ]
+
+	async def _instance_worker( self, instance : StableDiffusionInstance, worker_id : str ) -> None:
+		'''
+		Run queued operations on one of the instance's concurrency slots, sleeping while the queue is empty
+		or the instance is unhealthy. Exits once the instance is draining and its current operation is done.
+		'''
+		while self._active is True and instance.draining is False:
+			if self.is_instance_healthy(instance) is False:
+				event = asyncio.Event()
+				self._recovery_events[worker_id] = event
+				await event.wait()
+				continue
+			operation = self._next_operation(instance)
 			if operation is None:
+				event = asyncio.Event()
+				self._idle_workers[worker_id] = (instance, event)
+				await event.wait()
 				continue
-			if now - operation.timestamp > OPERATION_AUTO_EXPIRY:
-				print(f'Operation {operation.uuid} has expired.')
-				_ = self.operations.pop(uuid)
+			operations : list[Operation] = self._coalesce_operations(instance, operation)
+			try:
+				await self._internal_txt2img(instance, operations)
+			finally:
+				self._release_users(operations)
+
+	async def _progress_poller( self, instance : StableDiffusionInstance ) -> None:
+		'''
+		Poll the instance's progress while it is busy and someone is watching, so every progress request
+		and waiter for operations on this instance shares a single webui request per interval.
+		'''
+		while self._active is True:
+			# followers cannot signal demand, so with a shared backend busy instances are always polled
+			if instance.busy is True and (self.backend.shared is True or time.time() < instance.progress_demand_until):
+				success, response = await instance.get_progress()
+				instance.progress = response if success is True else None
+				self._notify_changed()
+			elif instance.progress is not None and instance.busy is False:
+				instance.progress = None
+			await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+
+	def _start_worker( self, instance : StableDiffusionInstance ) -> None:
+		for worker_id in self._worker_ids(instance):
+			if worker_id not in self._workers:
+				self._workers[worker_id] = asyncio.create_task(self._instance_worker(instance, worker_id))
+		if instance.uuid not in self._progress_pollers:
+			self._progress_pollers[instance.uuid] = asyncio.create_task(self._progress_poller(instance))
+
+	async def _stop_worker( self, instance : StableDiffusionInstance ) -> None:
+		tasks = [ self._progress_pollers.pop(instance.uuid, None) ]
+		for worker_id in self._worker_ids(instance):
+			self._idle_workers.pop(worker_id, None)
+			self._recovery_events.pop(worker_id, None)
+			tasks.append( self._workers.pop(worker_id, None) )
+		for task in tasks:
+			if task is not None:
+				task.cancel()
+		await asyncio.gather(*[ task for task in tasks if task is not None ], return_exceptions=True)
+
+	def _get_capacity( self ) -> int:
+		return max(1, sum( instance.max_concurrency for instance in self.instances if instance.draining is False ))
+
+	def _get_shared_status( self ) -> dict:
+		'''The status the leader last published, followers re-read it on every sync.'''
+		return self._shared_status
+
+	def get_queue_length( self ) -> int:
+		if self.is_leader is False:
+			return self._get_shared_status().get("queue_length", 0)
+		return self.store.queue_length()
+
+	def get_operation_count( self ) -> int:
+		if self.is_leader is False:
+			return self._get_shared_status().get("operation_count", 0)
+		return len(self.operations)
+
+	def get_instance_count( self ) -> int:
+		if self.is_leader is False:
+			return len(self._get_shared_status().get("instances", []))
+		return len(self.instances)
+
+	def get_scheduler_stats( self ) -> dict[str, int]:
+		if self.is_leader is False:
+			return self._get_shared_status().get("scheduler_stats", {})
+		return self.scheduler_stats
+
+	async def _publish_status( self ) -> None:
+		'''Everything followers answer from memory in a single process setup.'''
+		await self.backend.call(self.backend.set_value, "status", {
+			"positions" : self.store.positions(),
+			"progress" : { instance.uuid : instance.progress for instance in self.instances if instance.progress is not None },
+			"average_generation_time" : self.average_generation_time,
+			"capacity" : self._get_capacity(),
+			"queue_length" : self.store.queue_length(),
+			"operation_count" : len(self.operations),
+			"instances" : self.list_instances(),
+			"health" : self.get_instances_health(),
+			"infos" : await self.get_instances_infos(),
+			"scheduler_stats" : self.scheduler_stats,
+		})
+
+	async def _apply_command( self, kind : str, payload : dict ) -> None:
+		if kind == "cancel":
+			await self.cancel_operation(payload["operation_id"])
+		elif kind == "add_instance":
+			instance = StableDiffusionInstance(**payload["config"])
+			instance.uuid = payload["uuid"] # the id the follower already returned
+			await self.add_instance(instance)
+		elif kind == "drain_instance":
+			await self.request_drain_instance(payload["instance_id"])
+		elif kind == "remove_instance":
+			await self.request_remove_instance(payload["instance_id"])
+
+	async def _sync_shared( self ) -> None:
+		'''Renew (or try to take) the leadership, then as leader pick up submissions and commands and publish the status.'''
+		is_leader : bool = await self.backend.call(self.backend.acquire_leadership, self.owner_id)
+		if is_leader is True and self.is_leader is False:
+			await self._start_leader()
+		elif is_leader is False and self.is_leader is True:
+			print('Lost the scheduler leadership.')
+			await self._stop_leader()
+		if self.is_leader is False:
+			self._shared_status = await self.backend.call(self.backend.get_value, "status") or dict()
+			return
+		for data in await self.backend.call(self.backend.take_submissions):
+			operation = Operation(**data)
+			self.store.add(operation)
+			self.store.enqueue(operation)
+			self._wake_worker(operation)
+		for kind, payload in await self.backend.call(self.backend.take_commands):
+			await self._apply_command(kind, payload)
+		await self._publish_status()
+
+	async def _sync_loop( self ) -> None:
+		while self._active is True:
+			try:
+				await self._sync_shared()
+			except Exception as exception:
+				print(f'Shared state sync failed: {exception}')
+			await asyncio.sleep(SHARED_SYNC_INTERVAL)
+
+	async def _start_leader( self ) -> None:
+		'''Take over scheduling: requeue the unfinished operations and start the workers.'''
+		self.is_leader = True
+		for data in await self.backend.call(self.backend.take_unfinished):
+			operation = Operation(**data)
+			if operation.state == OperationStatus.IN_PROGRESS.value:
+				operation.sdinstance = None # the previous leader died mid generation
+				self._set_operation_state(operation, OperationStatus.IN_QUEUE)
+			self.store.add(operation) # no deadline until it finishes, however long ago it was queued
+			self.store.enqueue(operation)
+		for instance in self.instances:
+			await instance.open_session()
+		for instance in self.instances:
+			self._start_worker(instance)
+		self._health_task = asyncio.create_task(self._health_loop())
+		if self.hedge is True:
+			self._hedge_task = asyncio.create_task(self._hedge_loop())
+		self.revalidate_instances_infos()
+
+	async def _stop_leader( self ) -> None:
+		for instance in list(self.instances):
+			await self._stop_worker(instance)
+		for task in [ self._health_task, self._hedge_task ]:
+			if task is not None:
+				task.cancel()
+				await asyncio.gather(task, return_exceptions=True)
+		self._health_task = None
+		self._hedge_task = None
+		for instance in self.instances:
+			await instance.close_session()
+		if self.backend.shared is True:
+			# the new leader owns the unfinished operations, only finished ones are kept to serve reads
+			for operation in [ operation for operation in self.operations.values() if operation.state not in FINAL_OPERATION_STATES ]:
+				self.store.remove(operation.uuid)
+			self._running.clear()
+			self._hedged.clear()
+			self.user_in_flight.clear()
+			await self.backend.call(self.backend.release_leadership, self.owner_id)
+		self.is_leader = self.backend.shared is False
+
+	async def _expiry_loop( self ) -> None:
+		while self._active is True:
+			await self.check_for_expired_operations()
+			await asyncio.sleep(OPERATION_EXPIRY_INTERVAL)
+
+	async def check_for_expired_operations(self) -> None:
+		for operation in self.store.pop_expired(timestamp()):
+			self.metrics.operations_expired.inc()
+			self.results.remove(operation.uuid)
+			self._export_timeline(operation)
+		evicted : list[str] = self.results.pop_evicted()
+		if self.backend.persistent is False:
+			# without a backend to read them back from, operations whose results were evicted are gone
+			for operation_id in evicted:
+				self._export_timeline(self.store.remove(operation_id))
+		elif self.is_leader is True:
+			# evicted results are read back from the backend when requested, the ids are only drained
+			await self.backend.call(self.backend.delete_expired, timestamp() - RESULT_RETENTION)
+		if self.timeline_exporter is not None:
+			self.timeline_exporter.flush()
+		for user_id in [ user_id for user_id, bucket in self.user_buckets.items() if bucket.is_full() ]:
+			del self.user_buckets[user_id] # idle users start with a full bucket anyway
 
 	async def initialize(self) -> None:
-		def main_loop() -> None:
-			asyncio.new_event_loop()
-			while self._active is True:
-				asyncio.run(self.check_for_expired_operations())
-				asyncio.run(self.update_queue())
-				time.sleep(3)
+		'''
+		Start the distributor on the running event loop. With a shared backend only the process holding
+		the leadership runs the instance workers, the others follow until they can take it over.
+		'''
 		await self.shutdown()
+		self.postprocessor.start()
 		self._active = True
-		self._thread = Thread(target=main_loop)
-		self._thread.start()
+		self._expiry_task = asyncio.create_task(self._expiry_loop())
+		self._metrics_task = asyncio.create_task(self.metrics.monitor_event_loop())
+		if self.backend.shared is True:
+			await self._sync_shared()
+			self._sync_task = asyncio.create_task(self._sync_loop())
+		else:
+			await self._start_leader()
 
 	async def shutdown(self) -> None:
 		self._active = False
-		if self._thread is not None:
-			self._thread.join() # wait for closure
-			self._thread = None
+		for task in [ self._expiry_task, self._sync_task, self._metrics_task ]:
+			if task is not None:
+				task.cancel()
+				await asyncio.gather(task, return_exceptions=True)
+		self._expiry_task = None
+		self._sync_task = None
+		self._metrics_task = None
+		if self.is_leader is True:
+			await self._stop_leader()
+		await self.postprocessor.shutdown()
+		self.results.close()
+		if self.timeline_exporter is not None:
+			self.timeline_exporter.flush(force=True)
 
 async def test() -> None:
 	local_distributor = StableDiffusionDistributor([
@@ -560,7 +1907,7 @@ async def test() -> None:
 
 	await local_distributor.initialize()
 
-	print(await local_distributor.instances[0].get_instance_info())
+	print(await local_distributor.instances[0].get_instance_info(wait=True))
 
 	params : SDTxt2ImgParams = SDTxt2ImgParams(
 		checkpoint="analogmadnessrealisticmodel\\analogMadness_v70.safetensors [71652f47a2]",
@@ -0,0 +1,240 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Iterator, Union
+
+import itertools
+import heapq
+import time
+
+if TYPE_CHECKING:
+	from sdapi import Operation, StableDiffusionInstance
+
+class OperationStore:
+	'''
+	Operations indexed for constant time scheduling:
+	- `queue` is an insertion ordered dict (uuid -> enqueue time), so enqueue, dequeue of the head and cancel by uuid are O(1)
+	- `checkpoint_queues` mirrors the queue per checkpoint for O(1) checkpoint affinity lookups
+	- `user_queues` mirrors the queue per user, `user_rotation` holds the users with queued operations in
+	  weighted round-robin order along with how many turns they have left in the current round
+	- `instances` maps instance uuid to instance
+	- `_expiry` is a heap of (expires_at, uuid) so expiring only touches the expired operations,
+	  `expires_at` holds each operation's current deadline so superseded heap entries are skipped.
+	  Operations without a deadline (queued or running) never expire.
+	'''
+	operations : dict[str, Operation]
+	queue : OrderedDict[str, float]
+	checkpoint_queues : dict[Union[str, None], OrderedDict[str, None]]
+	user_queues : dict[Any, OrderedDict[str, None]]
+	user_rotation : OrderedDict[Any, int]
+	user_weights : dict[Any, int]
+	instances : dict[str, StableDiffusionInstance]
+	expires_at : dict[str, float]
+	_expiry : list[tuple[float, str]]
+
+	def __init__( self ) -> None:
+		self.operations = dict()
+		self.queue = OrderedDict()
+		self.checkpoint_queues = dict()
+		self.user_queues = dict()
+		self.user_rotation = OrderedDict()
+		self.user_weights = dict()
+		self.instances = dict()
+		self.expires_at = dict()
+		self._expiry = list()
+
+	# operations
+	def add( self, operation : Operation, expires_at : Union[float, None] = None ) -> None:
+		'''Add the operation, it is kept until removed unless given a deadline.'''
+		self.operations[operation.uuid] = operation
+		if expires_at is not None:
+			self.set_expiry(operation.uuid, expires_at)
+
+	def set_expiry( self, uuid : str, expires_at : float ) -> None:
+		self.expires_at[uuid] = expires_at
+		heapq.heappush(self._expiry, (expires_at, uuid))
+
+	def get( self, uuid : str ) -> Union[Operation, None]:
+		return self.operations.get(uuid)
+
+	def remove( self, uuid : str ) -> Union[Operation, None]:
+		'''Forget the operation entirely (its expiry entry is dropped lazily).'''
+		self.dequeue(uuid)
+		_ = self.expires_at.pop(uuid, None)
+		return self.operations.pop(uuid, None)
+
+	def pop_expired( self, now : float ) -> list[Operation]:
+		'''Remove and return every operation whose deadline has passed.'''
+		expired : list[Operation] = []
+		while len(self._expiry) > 0 and self._expiry[0][0] < now:
+			expires_at, uuid = heapq.heappop(self._expiry)
+			if self.expires_at.get(uuid) != expires_at:
+				continue # already removed or given a new deadline
+			expired.append( self.remove(uuid) )
+		return expired
+
+	# queue
+	def _checkpoint_queue( self, checkpoint : Union[str, None] ) -> OrderedDict[str, None]:
+		if checkpoint not in self.checkpoint_queues:
+			self.checkpoint_queues[checkpoint] = OrderedDict()
+		return self.checkpoint_queues[checkpoint]
+
+	def enqueue( self, operation : Operation, front : bool = False ) -> None:
+		'''Add the operation to the back of the queue (or the front, e.g. for retries).'''
+		checkpoint_queue = self._checkpoint_queue(operation.params.checkpoint)
+		if operation.user_id not in self.user_queues:
+			self.user_queues[operation.user_id] = OrderedDict()
+			self.user_rotation[operation.user_id] = self.get_user_weight(operation.user_id)
+		user_queue = self.user_queues[operation.user_id]
+		self.queue[operation.uuid] = time.time()
+		checkpoint_queue[operation.uuid] = None
+		user_queue[operation.uuid] = None
+		if front is True:
+			self.queue.move_to_end(operation.uuid, last=False)
+			checkpoint_queue.move_to_end(operation.uuid, last=False)
+			user_queue.move_to_end(operation.uuid, last=False)
+
+	def dequeue( self, uuid : str ) -> bool:
+		'''Remove the operation from the queue, False if it was not queued.'''
+		if uuid not in self.queue:
+			return False
+		del self.queue[uuid]
+		operation : Operation = self.operations[uuid]
+		checkpoint_queue = self.checkpoint_queues.get(operation.params.checkpoint)
+		if checkpoint_queue is not None:
+			checkpoint_queue.pop(uuid, None)
+			if len(checkpoint_queue) == 0:
+				del self.checkpoint_queues[operation.params.checkpoint]
+		user_queue = self.user_queues.get(operation.user_id)
+		if user_queue is not None:
+			user_queue.pop(uuid, None)
+			if len(user_queue) == 0:
+				del self.user_queues[operation.user_id]
+				self.user_rotation.pop(operation.user_id, None)
+		return True
+
+	def is_queued( self, uuid : str ) -> bool:
+		return uuid in self.queue
+
+	def queued_at( self, uuid : str ) -> Union[float, None]:
+		'''When the operation was last enqueued, None if it is not queued.'''
+		return self.queue.get(uuid)
+
+	def peek( self ) -> Union[Operation, None]:
+		'''The operation at the head of the queue.'''
+		if len(self.queue) == 0:
+			return None
+		return self.operations[next(iter(self.queue))]
+
+	def first_for_checkpoint( self, checkpoint : Union[str, None], exclude_users : Union[set, None] = None, limit : int = None ) -> Union[Operation, None]:
+		'''The oldest queued operation for the checkpoint, skipping operations of the excluded users (only `limit` are checked).'''
+		checkpoint_queue = self.checkpoint_queues.get(checkpoint)
+		if checkpoint_queue is None or len(checkpoint_queue) == 0:
+			return None
+		if not exclude_users:
+			return self.operations[next(iter(checkpoint_queue))]
+		for uuid in itertools.islice(checkpoint_queue, limit):
+			if self.operations[uuid].user_id not in exclude_users:
+				return self.operations[uuid]
+		return None
+
+	def iter_checkpoint_queue( self, checkpoint : Union[str, None] ) -> Iterator[Operation]:
+		'''Queued operations for the checkpoint in queue order (copy, safe to dequeue while iterating).'''
+		for uuid in list(self.checkpoint_queues.get(checkpoint, ())):
+			yield self.operations[uuid]
+
+	def peek_fair( self, exclude_users : Union[set, None] = None ) -> Union[Operation, None]:
+		'''The oldest operation of the user whose turn it is in the weighted round-robin, skipping excluded users.'''
+		for user_id in self.user_rotation:
+			if exclude_users and user_id in exclude_users:
+				continue
+			return self.operations[next(iter(self.user_queues[user_id]))]
+		return None
+
+	def charge_user( self, user_id : Any ) -> None:
+		'''Use one of the user's turns, moving them to the back of the rotation once their turns run out.'''
+		if user_id not in self.user_rotation:
+			return
+		self.user_rotation[user_id] -= 1
+		if self.user_rotation[user_id] <= 0:
+			self.user_rotation.move_to_end(user_id)
+			self.user_rotation[user_id] = self.get_user_weight(user_id)
+
+	def get_user_weight( self, user_id : Any ) -> int:
+		'''Operations the user may dispatch per round-robin turn (default 1).'''
+		return max(1, self.user_weights.get(user_id, 1))
+
+	def user_queue_length( self, user_id : Any ) -> int:
+		user_queue = self.user_queues.get(user_id)
+		return len(user_queue) if user_queue is not None else 0
+
+	def positions( self ) -> dict[str, int]:
+		'''Queue position of every queued operation (one O(n) pass, for bulk queries).'''
+		return { uuid : index for index, uuid in enumerate(self.queue) }
+
+	def queue_length( self ) -> int:
+		return len(self.queue)
+
+	# instances
+	def add_instance( self, instance : StableDiffusionInstance ) -> None:
+		self.instances[instance.uuid] = instance
+
+	def remove_instance( self, instance : StableDiffusionInstance ) -> None:
+		self.instances.pop(instance.uuid, None)
+
+	def get_instance( self, uuid : Union[str, None] ) -> Union[StableDiffusionInstance, None]:
+		return self.instances.get(uuid) if uuid is not None else None
+
+def benchmark( sizes : tuple[int, ...] = (10_000, 100_000) ) -> None:
+	'''Enqueue, cancel 10%, dispatch with affinity and expire at each size, against the previous list based queue.'''
+	from types import SimpleNamespace
+	import random
+
+	def make_operations( count : int ) -> list[Any]:
+		return [
+			SimpleNamespace(uuid=f'{index:032x}', timestamp=index, user_id=index % 100, params=SimpleNamespace(checkpoint=f'model-{index % 8}'))
+			for index in range(count)
+		]
+
+	for size in sizes:
+		operations = make_operations(size)
+		canceled = random.Random(0).sample(operations, size // 10)
+
+		store = OperationStore()
+		start = time.perf_counter()
+		for operation in operations:
+			store.add(operation, operation.timestamp)
+			store.enqueue(operation)
+		enqueue_time = time.perf_counter() - start
+		start = time.perf_counter()
+		for operation in canceled:
+			store.dequeue(operation.uuid)
+		cancel_time = time.perf_counter() - start
+		start = time.perf_counter()
+		while store.queue_length() > 0:
+			operation = store.first_for_checkpoint('model-3') or store.peek()
+			store.dequeue(operation.uuid)
+		dispatch_time = time.perf_counter() - start
+		start = time.perf_counter()
+		store.pop_expired(size // 2)
+		expire_time = time.perf_counter() - start
+
+		# previous implementation: list queue, queue.remove to cancel and pop(0) to dispatch
+		queue : list[str] = []
+		start = time.perf_counter()
+		for operation in operations:
+			queue.append(operation.uuid)
+		for operation in canceled:
+			queue.remove(operation.uuid)
+		while len(queue) > 0:
+			queue.pop(0)
+		list_time = time.perf_counter() - start
+
+		per_op = lambda seconds, count : seconds / count * 1e6
+		print(
+			f'{size} operations: enqueue {per_op(enqueue_time, size):.2f}us, cancel {per_op(cancel_time, len(canceled)):.2f}us, '
+			f'dispatch {per_op(dispatch_time, size - len(canceled)):.2f}us, expire half {expire_time * 1000:.1f}ms '
+			f'(store total {(enqueue_time + cancel_time + dispatch_time) * 1000:.1f}ms vs list queue {list_time * 1000:.1f}ms)'
+		)
+
+if __name__ == '__main__':
+	benchmark()
@@ -0,0 +1,87 @@
+from __future__ import annotations
+from aiohttp import web
+from base64 import b64encode
+from io import BytesIO
+from PIL import Image
+from typing import Union
+
+import asyncio
+
+from sdapi import FINAL_OPERATION_STATES, StableDiffusionDistributor
+
+class StubWebUI:
+	'''
+	A stable diffusion webui answering just enough of the api for the distributor, on a free local port.
+	txt2img sleeps `delay` seconds and answers 503 while `failures` is above zero.
+	'''
+	delay : float
+	failures : int
+	checkpoints : list[str]
+	requests : dict[str, int]
+	options : dict
+	endpoint : Union[str, None]
+	_runner : Union[web.AppRunner, None]
+
+	def __init__( self, delay : float = 0.05, checkpoints : Union[list[str], None] = None ) -> None:
+		self.delay = delay
+		self.failures = 0
+		self.checkpoints = checkpoints if checkpoints is not None else [ 'a' ]
+		self.requests = dict()
+		self.endpoint = None
+		self._runner = None
+		self.options = { 'sd_model_checkpoint' : self.checkpoints[0] }
+
+	def count( self, path : str ) -> int:
+		return self.requests.get(path, 0)
+
+	def _image( self, width : int, height : int ) -> str:
+		buffer = BytesIO()
+		Image.new('RGB', (width, height), (120, 60, 30)).save(buffer, 'PNG')
+		return b64encode(buffer.getvalue()).decode('ascii')
+
+	async def _handle( self, request : web.Request ) -> web.Response:
+		path : str = request.path
+		self.requests[path] = self.requests.get(path, 0) + 1
+		if path == '/sdapi/v1/txt2img':
+			if self.failures > 0:
+				self.failures -= 1
+				return web.Response(status=503, reason='busy')
+			body : dict = await request.json()
+			await asyncio.sleep(self.delay)
+			images : list[str] = [ self._image(body['width'], body['height']) for _ in range(body.get('batch_size', 1)) ]
+			return web.json_response({ 'images' : images, 'parameters' : body, 'info' : '{}' })
+		if path == '/sdapi/v1/options':
+			if request.method == 'POST':
+				self.options.update(await request.json())
+				return web.json_response(None)
+			return web.json_response(self.options)
+		if path == '/sdapi/v1/sd-models':
+			return web.json_response([ { 'title' : f'{name}.safetensors', 'model_name' : name } for name in self.checkpoints ])
+		if path == '/sdapi/v1/progress':
+			return web.json_response({ 'progress' : 0.5, 'eta_relative' : 1.0, 'state' : {}, 'current_image' : None, 'textinfo' : None })
+		if path == '/sdapi/v1/embeddings':
+			return web.json_response({ 'loaded' : {} })
+		if path in ('/sdapi/v1/loras', '/sdapi/v1/samplers'):
+			return web.json_response([])
+		return web.json_response({})
+
+	async def __aenter__( self ) -> StubWebUI:
+		app = web.Application()
+		app.router.add_route('*', '/{tail:.*}', self._handle)
+		self._runner = web.AppRunner(app)
+		await self._runner.setup()
+		site = web.TCPSite(self._runner, '127.0.0.1', 0)
+		await site.start()
+		port : int = self._runner.addresses[0][1]
+		self.endpoint = f'http://127.0.0.1:{port}'
+		return self
+
+	async def __aexit__( self, *_ ) -> None:
+		await self._runner.cleanup()
+
+async def wait_finished( distributor : StableDiffusionDistributor, operation_ids : list[str], timeout : float = 10 ) -> None:
+	'''Wait until every operation is completed, canceled or errored.'''
+	async def finished() -> None:
+		while any( distributor.operations[uuid].state not in FINAL_OPERATION_STATES for uuid in operation_ids ):
+			await asyncio.sleep(0.02)
+	await asyncio.wait_for(finished(), timeout)
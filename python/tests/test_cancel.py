@@ -0,0 +1,89 @@
+import asyncio
+
+from results import ResultStore
+from sdapi import OperationStatus, SDTxt2ImgParams, StableDiffusionDistributor, StableDiffusionInstance
+from stub_webui import StubWebUI, wait_finished
+
+INTERRUPT : str = '/sdapi/v1/interrupt'
+SKIP : str = '/sdapi/v1/skip'
+
+def create_distributor( webui : StubWebUI, max_concurrency : int = 1, coalesce : bool = False ) -> StableDiffusionDistributor:
+	instance = StableDiffusionInstance(webui.endpoint, max_concurrency=max_concurrency)
+	return StableDiffusionDistributor([ instance ], coalesce=coalesce, result_store=ResultStore(directory=None))
+
+async def queue( distributor : StableDiffusionDistributor, prompt : str ) -> str:
+	return await distributor.queue_txt2img(SDTxt2ImgParams(checkpoint='a', prompt=prompt, width=64, height=64))
+
+async def wait_running( distributor : StableDiffusionDistributor, operation_ids : list[str] ) -> None:
+	while any( distributor.operations[uuid].state != OperationStatus.IN_PROGRESS.value for uuid in operation_ids ):
+		await asyncio.sleep(0.02)
+
+def test_cancel_alone_interrupts() -> None:
+	async def main() -> None:
+		async with StubWebUI(delay=1) as webui:
+			distributor = create_distributor(webui)
+			await distributor.initialize()
+			await distributor.find_unavailable_instances()
+			operation_id : str = await queue(distributor, 'alone')
+			await asyncio.wait_for(wait_running(distributor, [ operation_id ]), 5)
+			await distributor.cancel_operation(operation_id)
+			assert distributor.operations[operation_id].state == OperationStatus.CANCELED.value
+			assert webui.count(SKIP) == 1
+			assert webui.count(INTERRUPT) == 1
+			await distributor.shutdown()
+	asyncio.run(main())
+
+def test_cancel_shared_instance_does_not_interrupt() -> None:
+	async def main() -> None:
+		async with StubWebUI(delay=0.5) as webui:
+			distributor = create_distributor(webui, max_concurrency=2)
+			await distributor.initialize()
+			await distributor.find_unavailable_instances()
+			canceled : str = await queue(distributor, 'canceled')
+			other : str = await queue(distributor, 'other')
+			await asyncio.wait_for(wait_running(distributor, [ canceled, other ]), 5)
+			await distributor.cancel_operation(canceled)
+			await wait_finished(distributor, [ other ])
+			assert webui.count(SKIP) == 0
+			assert webui.count(INTERRUPT) == 0
+			assert distributor.operations[canceled].state == OperationStatus.CANCELED.value
+			assert distributor.operations[other].state == OperationStatus.COMPLETED.value
+			assert distributor.results.has(canceled) is False
+			await distributor.shutdown()
+	asyncio.run(main())
+
+def test_cancel_queued_never_dispatches() -> None:
+	async def main() -> None:
+		async with StubWebUI(delay=0.3) as webui:
+			distributor = create_distributor(webui)
+			await distributor.initialize()
+			await distributor.find_unavailable_instances()
+			running : str = await queue(distributor, 'running')
+			queued : str = await queue(distributor, 'queued')
+			await distributor.cancel_operation(queued)
+			await wait_finished(distributor, [ running ])
+			await asyncio.sleep(0.1)
+			assert distributor.operations[queued].state == OperationStatus.CANCELED.value
+			assert distributor.operations[queued].attempts == 0
+			assert webui.count('/sdapi/v1/txt2img') == 1
+			await distributor.shutdown()
+	asyncio.run(main())
+
+def test_cancel_batch_member_keeps_batch_running() -> None:
+	async def main() -> None:
+		async with StubWebUI(delay=0.5) as webui:
+			distributor = create_distributor(webui, coalesce=True)
+			await distributor.initialize()
+			await distributor.find_unavailable_instances()
+			blocker : str = await queue(distributor, 'blocker')
+			await asyncio.wait_for(wait_running(distributor, [ blocker ]), 5)
+			batch : list[str] = [ await queue(distributor, 'batch') for _ in range(2) ]
+			await asyncio.wait_for(wait_running(distributor, batch), 5)
+			await distributor.cancel_operation(batch[0])
+			await wait_finished(distributor, [ blocker ] + batch)
+			assert distributor.scheduler_stats['coalesced'] == 1
+			assert webui.count(INTERRUPT) == 0
+			assert distributor.operations[batch[0]].state == OperationStatus.CANCELED.value
+			assert distributor.operations[batch[1]].state == OperationStatus.COMPLETED.value
+			await distributor.shutdown()
+	asyncio.run(main())
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+
+import pytest
+
+import sdapi
+from backend import SQLiteBackend
+from journal import JournalBackend
+from results import ResultStore
+from sdapi import OperationStatus, SDTxt2ImgParams, StableDiffusionDistributor, StableDiffusionInstance
+from stub_webui import StubWebUI, wait_finished
+
+QUEUED, IN_PROGRESS, COMPLETED, ERRORED = OperationStatus.IN_QUEUE.value, OperationStatus.IN_PROGRESS.value, OperationStatus.COMPLETED.value, OperationStatus.ERRORED.value
+LATER : int = 10 ** 7 # seconds from now, past every retention
+
+def save_operations( backend ) -> None:
+	'''One queued, one running and two finished operations, the completed one with results.'''
+	backend.save_operation('queued', 1, QUEUED, '{}')
+	backend.save_operation('running', 1, IN_PROGRESS, '{}')
+	backend.save_operation('completed', 1, QUEUED, '{}')
+	backend.save_operation('completed', 1, COMPLETED, '{"done":true}')
+	backend.save_results('completed', 1, json.dumps({ 'images' : [], 'tiles' : [] }))
+	backend.save_operation('errored', 1, ERRORED, '{}')
+
+def test_distributor_only_expires_finished_operations( monkeypatch : pytest.MonkeyPatch ) -> None:
+	async def main() -> None:
+		async with StubWebUI() as webui:
+			distributor = StableDiffusionDistributor([ StableDiffusionInstance(webui.endpoint) ], result_store=ResultStore(directory=None))
+			await distributor.initialize()
+			await distributor.find_unavailable_instances()
+			completed : str = await distributor.queue_txt2img(SDTxt2ImgParams(checkpoint='a', prompt='done', width=64, height=64))
+			await wait_finished(distributor, [ completed ])
+			await distributor.shutdown()
+			queued : str = await distributor.queue_txt2img(SDTxt2ImgParams(checkpoint='a', prompt='waiting', width=64, height=64))
+			now : int = sdapi.timestamp()
+			monkeypatch.setattr(sdapi, 'timestamp', lambda : now + LATER)
+			await distributor.check_for_expired_operations()
+			assert completed not in distributor.operations
+			assert distributor.results.has(completed) is False
+			assert distributor.operations[queued].state == QUEUED
+	asyncio.run(main())
+
+def test_evicted_results_are_drained() -> None:
+	async def main() -> None:
+		async with StubWebUI() as webui:
+			results = ResultStore(directory=None)
+			distributor = StableDiffusionDistributor([ StableDiffusionInstance(webui.endpoint) ], result_store=results)
+			await distributor.initialize()
+			await distributor.find_unavailable_instances()
+			first : str = await distributor.queue_txt2img(SDTxt2ImgParams(checkpoint='a', prompt='first', width=64, height=64))
+			await wait_finished(distributor, [ first ])
+			results.memory_budget = results.memory_bytes # room for a single result
+			second : str = await distributor.queue_txt2img(SDTxt2ImgParams(checkpoint='a', prompt='second', width=64, height=64))
+			await wait_finished(distributor, [ second ])
+			assert results.evicted == [ first ]
+			await distributor.check_for_expired_operations()
+			# without a persistent backend the operation cannot be served anymore
+			assert results.evicted == []
+			assert first not in distributor.operations
+			assert distributor.operations[second].state == COMPLETED
+			await distributor.shutdown()
+	asyncio.run(main())
+
+def test_evicted_results_are_read_back_from_journal( tmp_path ) -> None:
+	async def main() -> None:
+		async with StubWebUI() as webui:
+			results = ResultStore(directory=None)
+			distributor = StableDiffusionDistributor([ StableDiffusionInstance(webui.endpoint) ], backend=JournalBackend(str(tmp_path / 'journal.jsonl')), result_store=results)
+			await distributor.initialize()
+			await distributor.find_unavailable_instances()
+			first : str = await distributor.queue_txt2img(SDTxt2ImgParams(checkpoint='a', prompt='first', width=64, height=64))
+			await wait_finished(distributor, [ first ])
+			results.memory_budget = results.memory_bytes
+			second : str = await distributor.queue_txt2img(SDTxt2ImgParams(checkpoint='a', prompt='second', width=64, height=64))
+			await wait_finished(distributor, [ second ])
+			await distributor.check_for_expired_operations()
+			assert results.evicted == []
+			assert await distributor.get_operation_tile(first, 0, 0, 0) is not None
+			await distributor.shutdown()
+			distributor.backend.close()
+	asyncio.run(main())
+
+def test_sqlite_only_expires_finished_operations( tmp_path ) -> None:
+	backend = SQLiteBackend(str(tmp_path / 'state.db'))
+	save_operations(backend)
+	backend.delete_expired(time.time() - 3600)
+	assert backend.load_results('completed') is not None
+	backend.delete_expired(time.time() + 1)
+	assert sorted( row[0] for row in backend.connection.execute('SELECT uuid FROM operations') ) == [ 'queued', 'running' ]
+	assert backend.load_results('completed') is None
+	backend.close()
+
+def test_sqlite_migrates_finished_at( tmp_path ) -> None:
+	filepath : str = str(tmp_path / 'state.db')
+	connection = sqlite3.connect(filepath)
+	connection.execute('CREATE TABLE operations (uuid TEXT PRIMARY KEY, timestamp INTEGER, state INTEGER, submitted INTEGER DEFAULT 0, data TEXT)')
+	connection.execute("INSERT INTO operations VALUES ('old_completed', 1, 2, 0, '{}'), ('old_queued', 1, 0, 0, '{}')")
+	connection.commit()
+	connection.close()
+	backend = SQLiteBackend(filepath)
+	backend.delete_expired(time.time())
+	assert [ row[0] for row in backend.connection.execute('SELECT uuid FROM operations') ] == [ 'old_queued' ]
+	backend.close()
+
+def test_journal_only_expires_finished_operations( tmp_path ) -> None:
+	filepath : str = str(tmp_path / 'journal.jsonl')
+	journal = JournalBackend(filepath)
+	save_operations(journal)
+	journal.delete_expired(time.time() - 3600)
+	journal.delete_expired(time.time() + 1)
+	journal.close()
+	live_size : int = journal.live_size
+	journal = JournalBackend(filepath)
+	assert sorted(journal.operations) == [ 'queued', 'running' ]
+	assert journal.load_results('completed') is None
+	# the live size kept while running, the one replayed and what compaction keeps all agree
+	assert journal.live_size == live_size
+	journal.compact()
+	assert journal.size == live_size == os.path.getsize(filepath)
+	journal.close()
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+import sdapi
+from results import ResultStore
+from sdapi import OperationStatus, SDTxt2ImgParams, StableDiffusionDistributor, StableDiffusionInstance
+from stub_webui import StubWebUI, wait_finished
+
+@pytest.fixture(autouse=True)
+def fast_retries( monkeypatch : pytest.MonkeyPatch ) -> None:
+	monkeypatch.setattr(sdapi, 'RETRY_BACKOFF_BASE', 0.01)
+
+async def run_operation( failures : int ) -> sdapi.Operation:
+	async with StubWebUI() as webui:
+		webui.failures = failures
+		distributor = StableDiffusionDistributor([ StableDiffusionInstance(webui.endpoint) ], result_store=ResultStore(directory=None))
+		await distributor.initialize()
+		await distributor.find_unavailable_instances()
+		try:
+			operation_id : str = await distributor.queue_txt2img(SDTxt2ImgParams(checkpoint='a', prompt='retry', width=64, height=64))
+			await wait_finished(distributor, [ operation_id ])
+			return distributor.operations[operation_id]
+		finally:
+			await distributor.shutdown()
+
+def test_retry_success_clears_error() -> None:
+	operation = asyncio.run(run_operation(failures=1))
+	assert operation.state == OperationStatus.COMPLETED.value
+	assert operation.attempts == 2
+	assert operation.error is None
+	assert operation.last_error is not None
+
+def test_retries_exhausted_errors_operation() -> None:
+	operation = asyncio.run(run_operation(failures=sdapi.RETRY_MAX_ATTEMPTS))
+	assert operation.state == OperationStatus.ERRORED.value
+	assert operation.attempts == sdapi.RETRY_MAX_ATTEMPTS
+	assert operation.error is not None
@@ -0,0 +1,63 @@
+from __future__ import annotations
+from pydantic import BaseModel, Field
+from typing import Union
+
+import json
+import time
+
+TIMELINE_EXPORT_FLUSH_INTERVAL : float = 5 # exported timelines are written to the file at most this often
+
+def round_time( value : float ) -> float:
+	return round(value, 3)
+
+class TimelineSpan(BaseModel):
+	'''A step of an operation, an event when it has no duration. Times are unix seconds to the millisecond.'''
+	name : str = Field(None)
+	start : float = Field(None)
+	duration : Union[float, None] = Field(None)
+	instance : Union[str, None] = Field(None) # endpoint of the instance the step ran on
+
+def create_span( name : str, start : Union[float, None] = None, duration : Union[float, None] = None, instance : Union[str, None] = None ) -> TimelineSpan:
+	return TimelineSpan(
+		name=name,
+		start=round_time(start if start is not None else time.time()),
+		duration=round_time(duration) if duration is not None else None,
+		instance=instance,
+	)
+
+def describe_timeline( timeline : list[TimelineSpan] ) -> list[dict]:
+	'''The spans with their offset in seconds from the first one, for reading a timeline at a glance.'''
+	if len(timeline) == 0:
+		return []
+	origin : float = timeline[0].start
+	return [ { **span.model_dump(exclude_none=True), 'offset' : round_time(span.start - origin) } for span in timeline ]
+
+class TimelineExporter:
+	'''
+	Appends the timeline of each operation leaving the distributor to a json lines file, one operation per line.
+	Lines are buffered and written at most every `flush_interval` seconds, so exporting costs building the line.
+	'''
+	filepath : str
+	flush_interval : float
+	pending : list[str]
+	last_flush : float
+
+	def __init__( self, filepath : str, flush_interval : float = TIMELINE_EXPORT_FLUSH_INTERVAL ) -> None:
+		self.filepath = filepath
+		self.flush_interval = flush_interval
+		self.pending = list()
+		self.last_flush = time.time()
+
+	def export( self, record : dict ) -> None:
+		self.pending.append(json.dumps(record, separators=(',', ':')) + '\n')
+
+	def flush( self, force : bool = False ) -> None:
+		if len(self.pending) == 0 or (force is False and time.time() - self.last_flush < self.flush_interval):
+			return
+		lines, self.pending = self.pending, list()
+		self.last_flush = time.time()
+		try:
+			with open(self.filepath, 'a', encoding='utf-8') as file:
+				file.write(''.join(lines))
+		except OSError as exception:
+			print(f'Failed to export {len(lines)} operation timelines: {exception}')
@@ -0,0 +1,93 @@
+-- Reference decoder for the compact image tile format (see python/compression.py encode_compact_tile).
+-- data = base64( zlib( payload ) ), payload is little-endian:
+--   u8 version (1), u8 mode (0 = palette, 1 = rgb565), u16 width, u16 height
+--   palette mode: u16 color count N, N * (u8 r, u8 g, u8 b), then width * height u8 palette indexes
+--   rgb565 mode: width * height u16 pixels (r5 g6 b5, red in the high bits)
+
+local zlib = require(script.Parent.zlib)
+
+local FORMAT_VERSION = 1
+local MODE_PALETTE = 0
+local MODE_RGB565 = 1
+
+local BASE64_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+local BASE64_LOOKUP = {}
+for index = 1, #BASE64_ALPHABET do
+	BASE64_LOOKUP[string.byte(BASE64_ALPHABET, index)] = index - 1
+end
+
+local Module = {}
+
+function Module.Base64Decode( value : string ) : string
+	local padding = 0
+	if string.sub(value, -2) == '==' then
+		padding = 2
+	elseif string.sub(value, -1) == '=' then
+		padding = 1
+	end
+
+	local output = buffer.create( (#value // 4) * 3 )
+	local offset = 0
+	for index = 1, #value, 4 do
+		local a, b, c, d = string.byte(value, index, index + 3)
+		local n = bit32.bor(
+			bit32.lshift(BASE64_LOOKUP[a], 18),
+			bit32.lshift(BASE64_LOOKUP[b], 12),
+			bit32.lshift(BASE64_LOOKUP[c] or 0, 6),
+			BASE64_LOOKUP[d] or 0
+		)
+		buffer.writeu8(output, offset, bit32.rshift(n, 16))
+		buffer.writeu8(output, offset + 1, bit32.band(bit32.rshift(n, 8), 255))
+		buffer.writeu8(output, offset + 2, bit32.band(n, 255))
+		offset += 3
+	end
+	return buffer.readstring(output, 0, buffer.len(output) - padding)
+end
+
+-- returns width, height and an RGBA8 buffer (ready for EditableImage:WritePixelsBuffer)
+function Module.DecodeCompactImage( data : string ) : (number, number, buffer)
+	local payload = buffer.fromstring( zlib.Zlib.Decompress( Module.Base64Decode(data) ) )
+
+	local version = buffer.readu8(payload, 0)
+	if version ~= FORMAT_VERSION then
+		error(string.format('Unsupported compact image format version %d.', version))
+	end
+
+	local mode = buffer.readu8(payload, 1)
+	local width = buffer.readu16(payload, 2)
+	local height = buffer.readu16(payload, 4)
+	local total = width * height
+	local pixels = buffer.create(total * 4)
+
+	if mode == MODE_PALETTE then
+		local count = buffer.readu16(payload, 6)
+		local paletteOffset = 8
+		local indexOffset = paletteOffset + count * 3
+		for index = 0, total - 1 do
+			local colorOffset = paletteOffset + buffer.readu8(payload, indexOffset + index) * 3
+			local pixelOffset = index * 4
+			buffer.writeu8(pixels, pixelOffset, buffer.readu8(payload, colorOffset))
+			buffer.writeu8(pixels, pixelOffset + 1, buffer.readu8(payload, colorOffset + 1))
+			buffer.writeu8(pixels, pixelOffset + 2, buffer.readu8(payload, colorOffset + 2))
+			buffer.writeu8(pixels, pixelOffset + 3, 255)
+		end
+	elseif mode == MODE_RGB565 then
+		for index = 0, total - 1 do
+			local value = buffer.readu16(payload, 6 + index * 2)
+			local red = bit32.band(bit32.rshift(value, 11), 31)
+			local green = bit32.band(bit32.rshift(value, 5), 63)
+			local blue = bit32.band(value, 31)
+			local pixelOffset = index * 4
+			buffer.writeu8(pixels, pixelOffset, bit32.bor(bit32.lshift(red, 3), bit32.rshift(red, 2)))
+			buffer.writeu8(pixels, pixelOffset + 1, bit32.bor(bit32.lshift(green, 2), bit32.rshift(green, 4)))
+			buffer.writeu8(pixels, pixelOffset + 2, bit32.bor(bit32.lshift(blue, 3), bit32.rshift(blue, 2)))
+			buffer.writeu8(pixels, pixelOffset + 3, 255)
+		end
+	else
+		error(string.format('Unknown compact image mode %d.', mode))
+	end
+
+	return width, height, pixels
+end
+
+return Module
@@ -7,6 +7,7 @@ Module.zlib = zlib.Zlib :: {Compress : (string, { level : number }?) -> string,
 Module.Event = require(script.Event)
 Module.Maid = require(script.Maid)
 Module.RemoteService = require(script.RemoteService)
+Module.ImageCodec = require(script.ImageCodec)
 
 Module.OperationStatusEnums = {
 	IN_QUEUE = 0,
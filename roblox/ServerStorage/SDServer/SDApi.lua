@@ -3,6 +3,10 @@ export type InstanceInfo = { sys_info : { [string] : any }, sd_info : { [string]
 
 export type OperationMetaData = { state : number, timestamp : number, error : string? }
 export type OperationProgress = { eta : number }
+export type OperationStatus = { state : number, error : string?, attempts : number, progress : { progress : number, eta : number }?, queue_position : number?, eta : number? }
+export type OperationSnapshot = { state : number, error : string?, attempts : number, progress : { progress : number, eta : number }? }
+export type ImageTileLayout = { size : {number}, tile_size : number, columns : number, rows : number }
+export type ImageTile = { tile_x : number, tile_y : number, data : string, encoding : string?, width : number?, height : number?, pixels : buffer? }
 
 export type Txt2ImgParameters = {
 	roblox_user : { user_id : number, player_name : string, }?,
@@ -43,13 +47,19 @@ local function PrepareBody(body : any?) : string?
 	return body and HttpService:JSONEncode(body)
 end
 
-local function PrepareHeaders() : {}
-	return { ["Content-Type"] = "application/json", }
+local function PrepareHeaders( extraHeaders : { [string] : string }? ) : {}
+	local headers = { ["Content-Type"] = "application/json", }
+	if extraHeaders then
+		for name, value in extraHeaders do
+			headers[name] = value
+		end
+	end
+	return headers
 end
 
-local function RequestAsync( method : 'POST' | 'GET', url : string, body : any?) : (boolean, { [string] : any })
+local function RequestAsync( method : 'POST' | 'GET', url : string, body : any?, extraHeaders : { [string] : string }? ) : (boolean, { [string] : any })
 	local success, data = pcall(function()
-		return HttpService:RequestAsync({Url = url, Method = method, Headers = PrepareHeaders(), Body = PrepareBody(body),})
+		return HttpService:RequestAsync({Url = url, Method = method, Headers = PrepareHeaders(extraHeaders), Body = PrepareBody(body),})
 	end)
 
 	if not success or not data.Success then
@@ -60,7 +70,8 @@ local function RequestAsync( method : 'POST' | 'GET', url : string, body : any?)
 	local decodedBody = HttpService:JSONDecode(data.Body)
 
 	if typeof(decodedBody) == "table" then
-		if decodedBody['data'] then
+		-- compact encodings are base64 and decoded by SDShared.ImageCodec instead
+		if decodedBody['data'] and not decodedBody['encoding'] then
 			local hexDecoded : string, _ = SDShared.FromHex( decodedBody['data'] )
 			decodedBody['data'] = SDShared.zlib.Decompress(hexDecoded)
 		end
@@ -86,8 +97,8 @@ local function InternalGET( path : string ) : boolean
 	return RequestAsync('GET', ServerURL .. path, nil)
 end
 
-local function InternalPOST( path : string, body : any? ) : (boolean, string)
-	return RequestAsync('POST', ServerURL .. path, body)
+local function InternalPOST( path : string, body : any?, extraHeaders : { [string] : string }? ) : (boolean, string)
+	return RequestAsync('POST', ServerURL .. path, body, extraHeaders)
 end
 
 -- local function EncodeRSA()
@@ -218,6 +229,16 @@ function Module.GetOperationMetaData( operation_id : string ) : OperationMetaDat
 	return response
 end
 
+-- '/get_operations_status'
+function Module.GetOperationsStatus( operation_ids : { string } ) : { [string] : OperationStatus? }?
+	typeAssertion('operation_ids', operation_ids, 'table')
+	local success, response = InternalPOST('/get_operations_status', {operation_ids = operation_ids})
+	if not success then
+		return nil
+	end
+	return response
+end
+
 -- '/get_operation_progress'
 function Module.GetOperationProgress( operation_id : string ) : OperationProgress?
 	typeAssertion('operation_id', operation_id, 'string')
@@ -228,6 +249,20 @@ function Module.GetOperationProgress( operation_id : string ) : OperationProgres
 	return response
 end
 
+-- '/wait_operation'
+-- holds until the state differs from last_state, the progress moves, or timeout seconds pass
+function Module.WaitOperation( operation_id : string, last_state : number?, last_progress : number?, timeout : number? ) : OperationSnapshot?
+	typeAssertion('operation_id', operation_id, 'string')
+	typeAssertion('last_state', last_state, 'number', 'nil')
+	typeAssertion('last_progress', last_progress, 'number', 'nil')
+	typeAssertion('timeout', timeout, 'number', 'nil')
+	local success, response = InternalPOST('/wait_operation', {operation_id = operation_id, last_state = last_state, last_progress = last_progress, timeout = timeout or 20})
+	if not success then
+		return nil
+	end
+	return response
+end
+
 -- '/cancel_operation'
 function Module.CancelOperation( operation_id : string ) : nil
 	typeAssertion('operation_id', operation_id, 'string')
@@ -235,7 +270,7 @@ function Module.CancelOperation( operation_id : string ) : nil
 end
 
 -- '/get_operation_images'
-function Module.GetOperationImages( operation_id : string ) : { {size : {number}, data : string | number} }
+function Module.GetOperationImages( operation_id : string ) : { ImageTileLayout }?
 	typeAssertion('operation_id', operation_id, 'string')
 	local success, response = InternalPOST('/get_operation_images', {operation_id = operation_id})
 	if not success then
@@ -244,8 +279,29 @@ function Module.GetOperationImages( operation_id : string ) : { {size : {number}
 	return response
 end
 
+-- '/get_operation_tile'
+-- encoding is 'legacy' (default, data is the decoded palette string) or 'palette' / 'rgb565',
+-- in which case the tile also has width, height and an RGBA8 pixels buffer.
+function Module.GetOperationTile( operation_id : string, image_index : number, tile_x : number, tile_y : number, encoding : string? ) : ImageTile?
+	typeAssertion('operation_id', operation_id, 'string')
+	typeAssertion('image_index', image_index, 'number')
+	typeAssertion('tile_x', tile_x, 'number')
+	typeAssertion('tile_y', tile_y, 'number')
+	typeAssertion('encoding', encoding, 'string', 'nil')
+	local headers = encoding and { ["X-Image-Encoding"] = encoding } or nil
+	local success, response = InternalPOST('/get_operation_tile', {operation_id = operation_id, image_index = image_index, tile_x = tile_x, tile_y = tile_y}, headers)
+	if not success or not response then
+		return nil
+	end
+	if response.encoding then
+		response.width, response.height, response.pixels = SDShared.ImageCodec.DecodeCompactImage(response.data)
+	end
+	return response -- legacy data is already hex/zlib decoded by RequestAsync
+end
+
 -- '/queue_txt2img'
-function Module.QueueTxt2Img( params : Txt2ImgParameters ) : string?
+-- when the player is rate limited returns nil and the seconds to wait before queueing again
+function Module.QueueTxt2Img( params : Txt2ImgParameters ) : (string?, number?)
 	typeAssertion('roblox_user', params.roblox_user, 'table', 'nil')
 	typeAssertion('timestamp', params.timestamp, 'number', 'nil')
 	typeAssertion('checkpoint', params.checkpoint, 'string')
@@ -259,6 +315,9 @@ function Module.QueueTxt2Img( params : Txt2ImgParameters ) : string?
 	local success, response = InternalPOST('/queue_txt2img', params)
 	if not success then
 		warn(response)
+		if typeof(response) == 'table' and response.StatusCode == 429 then
+			return nil, tonumber(response.Headers['retry-after'])
+		end
 		return nil
 	end
 	return response -- response is the operation id